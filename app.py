@@ -4,15 +4,29 @@ import pandas as pd
 import talib
 from talib import STOCH
 import os
+import shutil
 import sys
 import json
+import threading
+import uuid
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import count, islice
 from datetime import datetime, timedelta, time as dtime
-from kiteconnect import KiteConnect, exceptions
+from kiteconnect import KiteConnect, KiteTicker, exceptions
+from twisted.internet import reactor
+from kite_simulator import KiteSimulator
 import numpy as np
 import base64
 from cryptography.fernet import Fernet
 import hashlib
+import heapq
+import sqlite3
+import mmap
+import struct
+import signal as os_signal
 
 warnings.filterwarnings('ignore')
 
@@ -222,16 +236,71 @@ class Config:
     MCX_ENTRY_END = dtime(22, 0)  # Last entry time for MCX
     MCX_SQUARE_OFF_TIME = dtime(23, 00)  # Square off before MCX close
     
+    # Instrument dumps are refreshed in the background at these times, ahead of the open
+    INSTRUMENT_REFRESH_TIME = {"NSE": dtime(8, 30), "MCX": dtime(8, 30)}
+    # Daily trade-count and loss limits start over at these times
+    RISK_DAY_START = {"NSE": dtime(9, 0), "MCX": dtime(9, 0)}
+    
+    # Exchange-resident protection for open legs: "OFF", "SL" (stop-limit), "SL-M", or
+    # "GTT" (OCO stop + target; GTTs need NRML, so entries are then placed as NRML)
+    PROTECTIVE_ORDER_MODE = "OFF"
+    PROTECTIVE_LIMIT_BUFFER = 5  # points between trigger and limit price for SL / GTT stop legs
+    PROTECTIVE_MIN_STEP = 2  # trailing stop must move this many points before the order is modified
+    PROTECTIVE_MIN_INTERVAL = 3  # seconds between modifications of one protective order
+    GTT_POLL_SECONDS = 5  # how often an open leg's GTTs are checked for having fired
+    
     # Cooldown settings (in seconds)
     COOLDOWN_AFTER_ORDER = 30  # 30 seconds cooldown after placing an order
     COOLDOWN_AFTER_SIGNAL = 10  # 10 seconds cooldown after receiving a signal
     
+    # Live prices come from the KiteTicker websocket; REST ltp() is only a fallback
+    USE_TICKER = True
+    TICKER_ROOT = None  # e.g. "ws://127.0.0.1:8765" to use fake_ticker.py
+    QUOTE_CACHE_TTL = 1.0  # seconds a REST price is shared between callers
+    
+    # Client-side request rates (per second) for each Kite endpoint group
+    API_RATE_LIMITS = {"quote": 1, "historical": 3, "orders": 10, "default": 10}
+    
+    # Paper trading runs against the local simulator in kite_simulator.py; its logs and
+    # instrument cache are kept under PAPER_DATA_DIR, apart from the live account's
+    PAPER_FILL_LATENCY = 0.2  # seconds
+    PAPER_SLIPPAGE_TICKS = 1
+    PAPER_REJECT_RATE = 0.0
+    PAPER_DATA_DIR = "paper"
+    # The simulator has no server-side limits; lower these to rehearse live pacing
+    PAPER_API_RATE_LIMITS = {"quote": 1000, "historical": 1000, "orders": 10000, "default": 10000}
+    
     TOKEN_FILE = "access_token.txt"
     CREDENTIALS_FILE = "credentials.enc"
     TRADES_FILE = "trades_log.json"
     ORDERS_FILE = "orders_log.json"
-    INSTRUMENTS_FILE = "instruments.csv"
+    # Orders and trades go to "sqlite" (DATABASE_FILE) or a "journal" next to the JSON logs;
+    # the first SQLite run imports the JSON logs once
+    RECORD_STORE = "sqlite"
+    DATABASE_FILE = "trading.db"
+    RISK_FILE = "daily_risk.json"
+    INSTRUMENTS_DIR = "instruments_cache"
     CONFIG_FILE = "bot_config.json"
+    # A headless engine (python app.py --engine [--paper]) publishes its state here and takes
+    # commands from the dashboard; kept outside PAPER_DATA_DIR so a paper engine is found too
+    ENGINE_FILE = "engine.db"
+    # The engine's state snapshot for dashboards, memory-backed where /dev/shm exists
+    SNAPSHOT_FILE = (f"/dev/shm/options_bot_{hashlib.md5(os.getcwd().encode()).hexdigest()[:8]}"
+                     if os.path.isdir("/dev/shm") else "engine_state.mmap")
+    
+    # Engine job cadences. The signal is evaluated once per closed bar, SIGNAL_CLOSE_DELAY
+    # seconds after the close on the exchange clock; open positions are checked on every tick
+    # (or every MONITOR_SECONDS without a tick feed) and orders reconciled with kite.orders()
+    SIGNAL_INTERVAL = 300
+    SIGNAL_CLOSE_DELAY = 2.0
+    MONITOR_SECONDS = 0.5
+    ORDER_RECONCILE_SECONDS = 5
+    COMMAND_POLL_SECONDS = 0.25
+    PUBLISH_SECONDS = 1.0
+    # On, the engine evaluates every INDEX_MAP instrument on each bar close (one open position per
+    # instrument), fetching their data on SCAN_WORKERS threads; off, it trades the selected one
+    SCAN_ALL_INDICES = False
+    SCAN_WORKERS = 4
     
     # Index mapping
     INDEX_MAP = {
@@ -242,6 +311,7 @@ class Config:
             "tick_size": 0.05,
             "name": "BANKNIFTY",
             "default_lot_size": 30,
+            "freeze_quantity": 900,  # largest single order the exchange accepts
             "exchange": "NFO",
             "segment": "NSE"
         },
@@ -252,6 +322,7 @@ class Config:
             "tick_size": 0.05,
             "name": "NIFTY",
             "default_lot_size": 75,
+            "freeze_quantity": 1800,
             "exchange": "NFO",
             "segment": "NSE"
         },
@@ -261,6 +332,7 @@ class Config:
             "tick_size": 0.1,
             "name": "CRUDEOIL",
             "default_lot_size": 1,
+            "freeze_quantity": 100,  # MCX quantities are in lots
             "exchange": "MCX",
             "segment": "MCX"
         }
@@ -275,9 +347,11 @@ def init_session_state():
         'last_signal': None,
         'signal_cooldown': 0,
         'market_data': {},
+        'market_data_by_index': {},  # index_name -> market data, when the engine scans every instrument
         'active_trades': [],
         'trade_history': [],
         'order_history': [],
+        'order_index': {},  # order_id -> order_history record
         'auth_status': False,
         'selected_index': Config.INDEX,
         'today_trades_count': 0,
@@ -289,9 +363,12 @@ def init_session_state():
         'login_step': 'initial',
         'api_key': '',
         'api_secret': '',
-        'last_order_time': None,  # Track last order placement time
-        'last_signal_time': None,  # Track last signal generation time
-        'square_off_triggered': False  # Track if square off has been triggered
+        'last_order_time': {},  # index_name -> last order placement time
+        'last_signal_time': {},  # index_name -> last signal generation time
+        'square_off_triggered': {},  # index_name -> squared off before today's close
+        'last_square_off': None,  # Per-leg report of the last square off
+        'engine_pid': None,  # Headless engine this dashboard is following, if any
+        'trade_manager': None  # Kept across reruns, see get_trade_manager()
     }
     
     for key, value in defaults.items():
@@ -315,27 +392,32 @@ def load_config():
         pass
     return False
 
+def config_values():
+    """The user-editable settings, as saved to CONFIG_FILE and sent to a running engine"""
+    return {
+        'INDEX': st.session_state.selected_index,
+        'OTM_DISTANCE': Config.OTM_DISTANCE,
+        'NUMBER_OF_LOTS': Config.NUMBER_OF_LOTS,
+        'OVERRIDE_QUANTITY': Config.OVERRIDE_QUANTITY,
+        'TOTAL_QUANTITY': Config.TOTAL_QUANTITY,
+        'SL_POINTS': Config.SL_POINTS,
+        'TP_POINTS': Config.TP_POINTS,
+        'TSL_ENABLED': Config.TSL_ENABLED,
+        'TSL_TRIGGER': Config.TSL_TRIGGER,
+        'TSL_STEP': Config.TSL_STEP,
+        'PROTECTIVE_ORDER_MODE': Config.PROTECTIVE_ORDER_MODE,
+        'PROTECTIVE_MIN_STEP': Config.PROTECTIVE_MIN_STEP,
+        'MAX_TRADES_PER_DAY': Config.MAX_TRADES_PER_DAY,
+        'MAX_LOSS_PER_DAY': Config.MAX_LOSS_PER_DAY,
+        'COOLDOWN_AFTER_ORDER': Config.COOLDOWN_AFTER_ORDER,
+        'COOLDOWN_AFTER_SIGNAL': Config.COOLDOWN_AFTER_SIGNAL,
+        'SCAN_ALL_INDICES': Config.SCAN_ALL_INDICES
+    }
+
 def save_config():
     try:
-        config_data = {
-            'INDEX': st.session_state.selected_index,
-            'OTM_DISTANCE': Config.OTM_DISTANCE,
-            'NUMBER_OF_LOTS': Config.NUMBER_OF_LOTS,
-            'OVERRIDE_QUANTITY': Config.OVERRIDE_QUANTITY,
-            'TOTAL_QUANTITY': Config.TOTAL_QUANTITY,
-            'SL_POINTS': Config.SL_POINTS,
-            'TP_POINTS': Config.TP_POINTS,
-            'TSL_ENABLED': Config.TSL_ENABLED,
-            'TSL_TRIGGER': Config.TSL_TRIGGER,
-            'TSL_STEP': Config.TSL_STEP,
-            'MAX_TRADES_PER_DAY': Config.MAX_TRADES_PER_DAY,
-            'MAX_LOSS_PER_DAY': Config.MAX_LOSS_PER_DAY,
-            'COOLDOWN_AFTER_ORDER': Config.COOLDOWN_AFTER_ORDER,
-            'COOLDOWN_AFTER_SIGNAL': Config.COOLDOWN_AFTER_SIGNAL
-        }
-        
         with open(Config.CONFIG_FILE, 'w') as f:
-            json.dump(config_data, f, indent=2)
+            json.dump(config_values(), f, indent=2)
         return True
     except:
         return False
@@ -399,6 +481,34 @@ def clear_access_token():
     except:
         return False
 
+def restore_session(api_key):
+    """Reconnect with the saved access token; returns the client and the user's profile"""
+    with open(Config.TOKEN_FILE, "r") as f:
+        kite = get_kite_client(api_key, f.read().strip())
+    return kite, kite.profile()
+
+def end_session():
+    """Log out: forget the saved token, this account's cached client and this session's TradeManager"""
+    clear_access_token()
+    kite = st.session_state.kite
+    if kite is not None and getattr(kite, 'access_token', None):
+        # Other accounts logged in on this server keep their clients
+        get_kite_client.clear(kite.api_key, kite.access_token)
+    st.session_state.trade_manager = None
+    st.session_state.kite = None
+    st.session_state.auth_status = False
+
+def start_paper_trading():
+    """Return a client for the local simulator and point the log files at the paper directory"""
+    os.makedirs(Config.PAPER_DATA_DIR, exist_ok=True)
+    for name in ('TRADES_FILE', 'ORDERS_FILE', 'DATABASE_FILE', 'RISK_FILE', 'INSTRUMENTS_DIR'):
+        setattr(Config, name, os.path.join(Config.PAPER_DATA_DIR, os.path.basename(getattr(Config, name))))
+    
+    simulator = KiteSimulator(fill_latency=Config.PAPER_FILL_LATENCY,
+                              slippage_ticks=Config.PAPER_SLIPPAGE_TICKS,
+                              reject_rate=Config.PAPER_REJECT_RATE)
+    return KiteGateway(simulator.start(), ApiLimiter(Config.PAPER_API_RATE_LIMITS))
+
 # --- UTILITY FUNCTIONS ---
 def format_full_number(num, decimals=2):
     """Display full numbers with proper formatting"""
@@ -460,20 +570,23 @@ def round_to_tick(price, index_name):
         multiplier = 1 / tick_size
         return round(price * multiplier) / multiplier
 
-def is_cooldown_active():
-    """Check if cooldown period is active"""
+def is_cooldown_active(index_name=None):
+    """Check if cooldown period is active for an instrument (the selected one by default)"""
     now = datetime.now()
+    index_name = index_name or st.session_state.selected_index
+    last_order_time = st.session_state.last_order_time.get(index_name)
+    last_signal_time = st.session_state.last_signal_time.get(index_name)
     
     # Check order cooldown
-    if st.session_state.last_order_time:
-        order_cooldown_end = st.session_state.last_order_time + timedelta(seconds=Config.COOLDOWN_AFTER_ORDER)
+    if last_order_time:
+        order_cooldown_end = last_order_time + timedelta(seconds=Config.COOLDOWN_AFTER_ORDER)
         if now < order_cooldown_end:
             time_left = (order_cooldown_end - now).seconds
             return True, f"Order cooldown active: {time_left}s remaining"
     
     # Check signal cooldown
-    if st.session_state.last_signal_time:
-        signal_cooldown_end = st.session_state.last_signal_time + timedelta(seconds=Config.COOLDOWN_AFTER_SIGNAL)
+    if last_signal_time:
+        signal_cooldown_end = last_signal_time + timedelta(seconds=Config.COOLDOWN_AFTER_SIGNAL)
         if now < signal_cooldown_end:
             time_left = (signal_cooldown_end - now).seconds
             return True, f"Signal cooldown active: {time_left}s remaining"
@@ -498,215 +611,641 @@ def should_square_off_before_close(index_name):
         five_min_before = (datetime.combine(now.date(), square_off_time) - timedelta(minutes=5)).time()
         return now_time >= five_min_before and now_time <= square_off_time
 
-# --- INSTRUMENTS ---
-def load_instruments(kite, exchange="ALL"):
-    """Load instruments for all exchanges or specific exchange"""
+def slice_quantity(quantity, lot_size, freeze_quantity):
+    """Split an order quantity into whole-lot child quantities no larger than the freeze limit"""
+    if not freeze_quantity or quantity <= freeze_quantity:
+        return [quantity]
+    
+    lot_size = max(1, int(lot_size or 1))
+    largest = max(lot_size, freeze_quantity // lot_size * lot_size)
+    children = [largest] * (quantity // largest)
+    if quantity % largest:
+        children.append(quantity % largest)
+    return children
+
+# --- API GATEWAY ---
+# Request priorities, lowest value served first. Exits always jump the queue.
+PRIORITY_EXIT = 0
+PRIORITY_ORDER = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BACKGROUND = 3
+
+_api_context = threading.local()
+
+@contextmanager
+def api_priority(priority):
+    """Run the Kite calls made inside the block (on this thread) at the given priority"""
+    previous = getattr(_api_context, 'priority', None)
+    _api_context.priority = priority
     try:
-        file_name = f"instruments_{exchange}.csv" if exchange != "ALL" else Config.INSTRUMENTS_FILE
-        
-        if os.path.exists(file_name):
+        yield
+    finally:
+        _api_context.priority = previous
+
+class TokenBucket:
+    """Token bucket for one Kite endpoint; waiting callers are served by priority, then arrival"""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = []  # heap of (priority, sequence)
+        self.sequence = count()
+        self.cond = threading.Condition()
+        self.granted = 0
+        self.throttled = 0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def acquire(self, priority=PRIORITY_NORMAL):
+        with self.cond:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, ticket)
+            granted = False
             try:
-                if exchange == "MCX":
-                    df = pd.read_csv(file_name, header=None)
-                    df.columns = ['instrument_token', 'exchange_token', 'tradingsymbol', 'name', 
-                                  'last_price', 'expiry', 'strike', 'tick_size', 'lot_size', 
-                                  'instrument_type', 'segment', 'exchange']
-                else:
-                    df = pd.read_csv(file_name)
-                
-                file_time = datetime.fromtimestamp(os.path.getmtime(file_name))
-                if (datetime.now() - file_time).days < 1:
-                    return df
-            except Exception as e:
-                print(f"Error reading existing instruments file: {e}")
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.waiters[0] == ticket and now >= self.paused_until and self.tokens >= 1:
+                        heapq.heappop(self.waiters)
+                        self.tokens -= 1
+                        self.granted += 1
+                        granted = True
+                        return
+                    self.cond.wait(max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001))
+            finally:
+                if not granted:
+                    self.waiters.remove(ticket)
+                    heapq.heapify(self.waiters)
+                self.cond.notify_all()
+    
+    def penalize(self, seconds):
+        """Stop granting tokens for a while after the server answered 429"""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.throttled += 1
+            self.cond.notify_all()
+
+class ApiLimiter:
+    """Per-endpoint token buckets shared by every session using the same API key"""
+    def __init__(self, limits):
+        self.buckets = {endpoint: TokenBucket(rate) for endpoint, rate in limits.items()}
+    
+    def bucket(self, endpoint):
+        return self.buckets.get(endpoint) or self.buckets['default']
+    
+    def stats(self):
+        return {endpoint: {'granted': b.granted, 'throttled': b.throttled, 'waiting': len(b.waiters)}
+                for endpoint, b in self.buckets.items()}
+
+@st.cache_resource
+def get_api_limiter():
+    return ApiLimiter(Config.API_RATE_LIMITS)
+
+class KiteGateway:
+    """Drop-in wrapper around KiteConnect that sends every API call through the shared limiter.
+    
+    Constants and client-side helpers are passed straight through, so callers keep
+    using `kite.ORDER_TYPE_MARKET`, `kite.login_url()` etc. unchanged.
+    """
+    ENDPOINTS = {
+        'ltp': 'quote', 'quote': 'quote', 'ohlc': 'quote',
+        'historical_data': 'historical',
+        'place_order': 'orders', 'modify_order': 'orders', 'cancel_order': 'orders', 'exit_order': 'orders',
+    }
+    ORDER_METHODS = {'place_order', 'modify_order', 'cancel_order', 'exit_order'}
+    LOCAL_METHODS = {'login_url', 'set_access_token', 'set_session_expiry_hook'}
+    MAX_RETRIES = 3
+    BACKOFF_SECONDS = 1.0
+    
+    def __init__(self, kite, limiter=None):
+        self.kite = kite
+        self.limiter = limiter or get_api_limiter()
+    
+    def __getattr__(self, name):
+        attr = getattr(self.kite, name)
+        if name.startswith('_') or name in self.LOCAL_METHODS or not callable(attr):
+            return attr
+        
+        def call(*args, **kwargs):
+            return self._call(name, attr, args, kwargs)
+        return call
+    
+    def _priority(self, name):
+        priority = getattr(_api_context, 'priority', None)
+        if name in self.ORDER_METHODS:
+            return PRIORITY_ORDER if priority is None else min(priority, PRIORITY_ORDER)
+        return PRIORITY_NORMAL if priority is None else priority
+    
+    def _call(self, name, method, args, kwargs):
+        bucket = self.limiter.bucket(self.ENDPOINTS.get(name, 'default'))
+        priority = self._priority(name)
         
-        if exchange == "ALL":
-            nfo_instruments = kite.instruments("NFO")
-            mcx_instruments = kite.instruments("MCX")
-            instruments = nfo_instruments + mcx_instruments
+        for attempt in range(self.MAX_RETRIES + 1):
+            bucket.acquire(priority)
+            try:
+                return method(*args, **kwargs)
+            except exceptions.KiteException as e:
+                # A 429 means the request was refused, so retrying (even an order) is safe
+                if e.code != 429 or attempt == self.MAX_RETRIES:
+                    raise
+                delay = self.BACKOFF_SECONDS * 2 ** attempt
+                bucket.penalize(delay)
+                print(f"Rate limited on {name}, retrying in {delay:.1f}s")
+
+@st.cache_resource
+def get_kite_client(api_key, access_token):
+    """One rate-limited client per account session, shared by every rerun and browser tab"""
+    kite = KiteGateway(KiteConnect(api_key=api_key))
+    kite.set_access_token(access_token)
+    return kite
+
+# --- INSTRUMENTS ---
+# Column layout of the on-disk instrument cache. Each column is stored as its own
+# .npy file so a load is a set of memory maps rather than a CSV parse.
+INSTRUMENT_SCHEMA = [
+    ('instrument_token', 'int64'),
+    ('exchange_token', 'int64'),
+    ('tradingsymbol', 'U'),
+    ('name', 'U'),
+    ('last_price', 'float64'),
+    ('expiry', 'datetime64[D]'),
+    ('strike', 'float64'),
+    ('tick_size', 'float64'),
+    ('lot_size', 'int64'),
+    ('instrument_type', 'U'),
+    ('segment', 'U'),
+    ('exchange', 'U')
+]
+INSTRUMENT_SCHEMA_VERSION = 1
+
+def build_instrument_columns(instruments):
+    """Convert kite.instruments() rows into typed column arrays"""
+    columns = {}
+    for name, dtype in INSTRUMENT_SCHEMA:
+        values = [row.get(name) for row in instruments]
+        if dtype == 'U':
+            columns[name] = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        elif dtype == 'datetime64[D]':
+            columns[name] = np.array([v if v else None for v in values], dtype='datetime64[D]')
         else:
-            instruments = kite.instruments(exchange)
+            columns[name] = np.array([v if v not in (None, '') else 0 for v in values], dtype=dtype)
+    return columns
+
+def save_instrument_columns(columns, cache_dir, trading_date=None):
+    """Write column arrays plus a schema header, swapping the directory in atomically"""
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    old_dir = f"{cache_dir}.old-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    
+    for name, _ in INSTRUMENT_SCHEMA:
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), columns[name], allow_pickle=False)
+    
+    schema = {
+        'version': INSTRUMENT_SCHEMA_VERSION,
+        'rows': int(len(columns['instrument_token'])),
+        'columns': {name: str(columns[name].dtype) for name, _ in INSTRUMENT_SCHEMA},
+        'created_at': datetime.now().isoformat(),
+        'trading_date': (trading_date or datetime.now().date()).isoformat()
+    }
+    with open(os.path.join(tmp_dir, "schema.json"), 'w') as f:
+        json.dump(schema, f, indent=2)
+    
+    if os.path.exists(cache_dir):
+        os.rename(cache_dir, old_dir)
+    os.rename(tmp_dir, cache_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return schema
+
+def read_instrument_schema(cache_dir):
+    schema_file = os.path.join(cache_dir, "schema.json")
+    if not os.path.exists(schema_file):
+        return None
+    with open(schema_file, 'r') as f:
+        schema = json.load(f)
+    if schema.get('version') != INSTRUMENT_SCHEMA_VERSION:
+        return None
+    return schema
+
+def load_instrument_columns(cache_dir):
+    """Memory-map every column of a cached instrument dump"""
+    schema = read_instrument_schema(cache_dir)
+    if schema is None:
+        return None, None
+    
+    columns = {}
+    for name, _ in INSTRUMENT_SCHEMA:
+        columns[name] = np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+        if len(columns[name]) != schema['rows']:
+            raise ValueError(f"Column {name} has {len(columns[name])} rows, schema says {schema['rows']}")
+    return columns, schema
+
+def get_exchange_trading_date(exchange, now=None, day_start=None):
+    """Trading date whose instrument dump is current for an exchange.
+    
+    The date advances at the segment's pre-open refresh time (or the times in
+    day_start) rather than at midnight, and weekends roll back to the previous Friday.
+    """
+    now = now or datetime.now()
+    segment = "MCX" if exchange == "MCX" else "NSE"
+    refresh_time = (day_start or Config.INSTRUMENT_REFRESH_TIME).get(segment, dtime(8, 30))
+    
+    trading_date = now.date()
+    if now.time() < refresh_time:
+        trading_date -= timedelta(days=1)
+    while trading_date.weekday() >= 5:
+        trading_date -= timedelta(days=1)
+    return trading_date
+
+def download_instruments(kite, exchange="ALL"):
+    """Download a fresh instrument dump and write it to the columnar cache"""
+    if exchange == "ALL":
+        nfo_instruments = kite.instruments("NFO")
+        mcx_instruments = kite.instruments("MCX")
+        instruments = nfo_instruments + mcx_instruments
+    else:
+        instruments = kite.instruments(exchange)
+    
+    trading_date = get_exchange_trading_date(exchange)
+    columns = build_instrument_columns(instruments)
+    save_instrument_columns(columns, os.path.join(Config.INSTRUMENTS_DIR, exchange), trading_date)
+    return columns, trading_date
+
+def load_instruments(kite, exchange="ALL", allow_stale=False):
+    """Load instrument columns and their trading date for all exchanges or specific exchange.
+    
+    A cache from an earlier trading date is re-downloaded unless allow_stale is set.
+    """
+    cache_dir = os.path.join(Config.INSTRUMENTS_DIR, exchange)
+    try:
+        try:
+            columns, schema = load_instrument_columns(cache_dir)
+            if columns is not None:
+                trading_date = datetime.fromisoformat(schema['trading_date']).date()
+                if allow_stale or trading_date == get_exchange_trading_date(exchange):
+                    return columns, trading_date
+        except Exception as e:
+            print(f"Error reading existing instruments cache: {e}")
         
-        df = pd.DataFrame(instruments)
-        df.to_csv(file_name, index=False)
-        return df
+        return download_instruments(kite, exchange)
         
     except Exception as e:
         print(f"Error loading instruments: {e}")
-        if os.path.exists(file_name):
-            try:
-                if exchange == "MCX":
-                    df = pd.read_csv(file_name, header=None)
-                    df.columns = ['instrument_token', 'exchange_token', 'tradingsymbol', 'name', 
-                                  'last_price', 'expiry', 'strike', 'tick_size', 'lot_size', 
-                                  'instrument_type', 'segment', 'exchange']
-                else:
-                    df = pd.read_csv(file_name)
-                return df
-            except:
-                pass
-        return None
+        try:
+            columns, schema = load_instrument_columns(cache_dir)
+            if columns is not None:
+                return columns, datetime.fromisoformat(schema['trading_date']).date()
+        except:
+            pass
+        return None, None
+
+# --- INSTRUMENT INDEX ---
+class InstrumentIndex:
+    """In-memory lookup tables built from one exchange's instrument columns.
+    
+    Option chains are keyed by (underlying, instrument_type, expiry) and hold
+    strike-sorted arrays, so lookups never touch the cache files or scan a table.
+    """
+    def __init__(self, columns, exchange, trading_date=None):
+        self.exchange = exchange
+        self.trading_date = trading_date or get_exchange_trading_date(exchange)
+        self.option_chains = {}
+        self.option_expiries = {}
+        self.futures = {}
+        self.lot_sizes = {}
+        self.tokens = {}
+        self._build(columns)
+    
+    def _build(self, columns):
+        tokens = np.asarray(columns['instrument_token'], dtype=np.int64)
+        symbols = np.asarray(columns['tradingsymbol'])
+        names = np.char.upper(np.asarray(columns['name']))
+        types = np.asarray(columns['instrument_type'])
+        expiries = np.asarray(columns['expiry'], dtype='datetime64[D]')
+        strikes = np.asarray(columns['strike'], dtype=np.float64)
+        lot_sizes = np.asarray(columns['lot_size'], dtype=np.int64)
+        
+        self.tokens = dict(zip(symbols.tolist(), tokens.tolist()))
+        has_expiry = ~np.isnat(expiries)
+        
+        # Group options by (name, type, expiry) with strikes ascending inside each group
+        rows = np.flatnonzero(np.isin(types, ['CE', 'PE']) & has_expiry & ~np.isnan(strikes))
+        rows = rows[np.lexsort((strikes[rows], expiries[rows], types[rows], names[rows]))]
+        for group in self._split_groups(rows, names, types, expiries):
+            first = group[0]
+            name, option_type, expiry = str(names[first]), str(types[first]), expiries[first].item()
+            self.option_chains[(name, option_type, expiry)] = {
+                'strikes': strikes[group],
+                'symbols': symbols[group].astype(object),
+                'tokens': tokens[group]
+            }
+            self.option_expiries.setdefault(name, set()).add(expiry)
+            self.lot_sizes.setdefault(name, int(lot_sizes[first]))
+        self.option_expiries = {name: sorted(dates) for name, dates in self.option_expiries.items()}
+        
+        rows = np.flatnonzero((types == 'FUT') & has_expiry)
+        rows = rows[np.lexsort((expiries[rows], names[rows]))]
+        for group in self._split_groups(rows, names):
+            name = str(names[group[0]])
+            self.futures[name] = [{
+                'instrument_token': int(tokens[i]),
+                'tradingsymbol': str(symbols[i]),
+                'name': name,
+                'expiry': expiries[i].item(),
+                'lot_size': int(lot_sizes[i])
+            } for i in group]
+            self.lot_sizes.setdefault(name, int(lot_sizes[group[0]]))
+    
+    @staticmethod
+    def _split_groups(rows, *keys):
+        """Split sorted row indices wherever any of the key columns changes value"""
+        if len(rows) == 0:
+            return []
+        change = np.zeros(len(rows) - 1, dtype=bool)
+        for key in keys:
+            values = key[rows]
+            change |= values[1:] != values[:-1]
+        return np.split(rows, np.flatnonzero(change) + 1)
+    
+    def nearest_expiry(self, name, trading_date=None):
+        """Earliest option expiry on or after the exchange's current trading date; a dump loaded
+        before an expiry day still lists the contracts that expired on it"""
+        trading_date = trading_date or get_exchange_trading_date(self.exchange)
+        return next((expiry for expiry in self.option_expiries.get(name, []) if expiry >= trading_date), None)
+    
+    def nearest_future(self, name):
+        contracts = self.futures.get(name)
+        return contracts[0] if contracts else None
+    
+    def lot_size(self, name):
+        return self.lot_sizes.get(name)
+    
+    def option_chain(self, name, expiry, option_type):
+        return self.option_chains.get((name, option_type, expiry))
+    
+    def nearest_option(self, name, expiry, option_type, target_strike):
+        """Return (symbol, strike, token) of the listed strike closest to target_strike"""
+        chain = self.option_chain(name, expiry, option_type)
+        if chain is None or len(chain['strikes']) == 0:
+            return None
+        
+        strikes = chain['strikes']
+        pos = int(np.searchsorted(strikes, target_strike))
+        if pos == len(strikes) or (pos > 0 and target_strike - strikes[pos - 1] <= strikes[pos] - target_strike):
+            pos -= 1
+        
+        return chain['symbols'][pos], float(strikes[pos]), int(chain['tokens'][pos])
+    
+    def nearest_options(self, name, expiry, option_type, target_strikes):
+        """Vectorised nearest_option: return (symbols, strikes, tokens) arrays, one per target"""
+        chain = self.option_chain(name, expiry, option_type)
+        if chain is None or len(chain['strikes']) == 0:
+            return None
+        
+        strikes = chain['strikes']
+        targets = np.asarray(target_strikes, dtype=np.float64)
+        if len(strikes) == 1:
+            pos = np.zeros(targets.shape, dtype=np.intp)
+        else:
+            # Compare the neighbours on either side of the insertion point; ties go to the lower strike
+            pos = np.clip(np.searchsorted(strikes, targets), 1, len(strikes) - 1)
+            pos -= (targets - strikes[pos - 1]) <= (strikes[pos] - targets)
+        
+        return chain['symbols'][pos], strikes[pos], chain['tokens'][pos]
+
+class InstrumentRegistry:
+    """Process-wide holder of one InstrumentIndex per exchange.
+    
+    Lookups always return the current snapshot immediately. New dumps are downloaded
+    by a background InstrumentRefresher and swapped in by replacing the dict entry,
+    so a reader sees either the old index or the new one, never a partial build.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self.refresher = None
+    
+    def get(self, kite, exchange):
+        index = self._indexes.get(exchange)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(exchange)
+                if index is None:
+                    # Cold start: a stale cache is better than blocking on a download
+                    columns, trading_date = load_instruments(kite, exchange, allow_stale=True)
+                    if columns is None:
+                        return None
+                    index = InstrumentIndex(columns, exchange, trading_date)
+                    self._indexes[exchange] = index
+        
+        if not self.is_fresh(exchange):
+            self.start_refresher(kite, [exchange])
+        return index
+    
+    def is_fresh(self, exchange):
+        index = self._indexes.get(exchange)
+        return index is not None and index.trading_date == get_exchange_trading_date(exchange)
+    
+    def refresh(self, kite, exchange):
+        """Download and build a new snapshot, then swap it in"""
+        try:
+            columns, trading_date = download_instruments(kite, exchange)
+            index = InstrumentIndex(columns, exchange, trading_date)
+            with self._lock:
+                self._indexes[exchange] = index
+            return True
+        except Exception as e:
+            print(f"Error refreshing instruments for {exchange}: {e}")
+            return False
+    
+    def start_refresher(self, kite, exchanges):
+        with self._lock:
+            if self.refresher is None or not self.refresher.is_alive():
+                self.refresher = InstrumentRefresher(self)
+                self.refresher.kite = kite
+                self.refresher.exchanges.update(exchanges)
+                self.refresher.start()
+                return
+            
+            self.refresher.kite = kite
+            new_exchanges = set(exchanges) - self.refresher.exchanges
+            if new_exchanges:
+                self.refresher.exchanges.update(new_exchanges)
+                self.refresher.wake()
+    
+    def invalidate(self, exchange=None):
+        with self._lock:
+            if exchange is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(exchange, None)
+
+class InstrumentRefresher(threading.Thread):
+    """Background thread that refreshes each exchange's dump once per trading day, before the open"""
+    RETRY_SECONDS = 60
+    
+    def __init__(self, registry):
+        super().__init__(name="instrument-refresher", daemon=True)
+        self.registry = registry
+        self.kite = None
+        self.exchanges = set()
+        self._wake = threading.Event()
+    
+    def wake(self):
+        self._wake.set()
+    
+    def run(self):
+        while True:
+            failed = False
+            for exchange in list(self.exchanges):
+                if self.kite is not None and not self.registry.is_fresh(exchange):
+                    # Instrument dumps are large and never urgent; let trading calls go first
+                    with api_priority(PRIORITY_BACKGROUND):
+                        failed |= not self.registry.refresh(self.kite, exchange)
+            
+            self._wake.wait(self.RETRY_SECONDS if failed else self._seconds_until_next_refresh())
+            self._wake.clear()
+    
+    def _seconds_until_next_refresh(self):
+        now = datetime.now()
+        next_runs = []
+        for exchange in self.exchanges:
+            segment = "MCX" if exchange == "MCX" else "NSE"
+            run_at = datetime.combine(now.date(), Config.INSTRUMENT_REFRESH_TIME.get(segment, dtime(8, 30)))
+            if run_at <= now:
+                run_at += timedelta(days=1)
+            next_runs.append(run_at)
+        if not next_runs:
+            return self.RETRY_SECONDS
+        return max(1.0, (min(next_runs) - now).total_seconds())
+
+@st.cache_resource
+def get_instrument_registry():
+    return InstrumentRegistry()
+
+def start_instrument_refresher(kite):
+    """Keep every configured exchange's instruments refreshed in the background"""
+    exchanges = {info.get("exchange", "NFO") for info in Config.INDEX_MAP.values()}
+    get_instrument_registry().start_refresher(kite, exchanges)
+
+def get_instrument_index(kite, index_name):
+    """Get the instrument index for the exchange an index trades on"""
+    exchange = Config.INDEX_MAP.get(index_name, {}).get("exchange", "NFO")
+    return get_instrument_registry().get(kite, exchange)
 
 def get_base_lot_size(kite, index_name):
     """Get base lot size for index"""
     try:
         index_info = Config.INDEX_MAP.get(index_name, {})
-        exchange = index_info.get("exchange", "NFO")
         
-        df = load_instruments(kite, exchange)
-        if df is None:
+        index = get_instrument_index(kite, index_name)
+        if index is None:
             return index_info.get("default_lot_size", 50)
         
-        if index_name == "CRUDEOIL":
-            if 'instrument_type' in df.columns:
-                options = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df['instrument_type'].isin(['CE', 'PE']))]
-            else:
-                options = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df.iloc[:, 9].isin(['CE', 'PE']))]
-            
-            if len(options) > 0:
-                if 'lot_size' in options.columns:
-                    return int(options.iloc[0]['lot_size'])
-                else:
-                    return int(options.iloc[0].iloc[8])
-            
-            if 'instrument_type' in df.columns:
-                futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df['instrument_type'] == 'FUT')]
-            else:
-                futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df.iloc[:, 9] == 'FUT')]
-            
-            if len(futures) > 0:
-                if 'lot_size' in futures.columns:
-                    return int(futures.iloc[0]['lot_size'])
-                else:
-                    return int(futures.iloc[0].iloc[8])
-        else:
-            futures = df[(df['name'] == index_name) & (df['instrument_type'] == 'FUT')]
-            if len(futures) > 0:
-                return int(futures.iloc[0]['lot_size'])
+        lot_size = index.lot_size(index_name)
+        if lot_size:
+            return lot_size
         
         return index_info.get("default_lot_size", 50)
     except Exception as e:
         print(f"Error getting base lot size: {e}")
         return Config.INDEX_MAP.get(index_name, {}).get("default_lot_size", 50)
 
+def get_target_strikes(index_name, reference_prices, option_type="CE", otm_distances=None):
+    """ATM strike moved OTM by otm_distances steps; accepts scalars or arrays"""
+    step_size = Config.INDEX_MAP.get(index_name, {}).get("step_size", 100)
+    if otm_distances is None:
+        otm_distances = Config.OTM_DISTANCE
+    
+    atm_strikes = np.round(np.asarray(reference_prices, dtype=np.float64) / step_size) * step_size
+    offsets = np.asarray(otm_distances, dtype=np.float64) * step_size
+    
+    if option_type == "CE":
+        return atm_strikes + offsets
+    else:
+        return atm_strikes - offsets
+
 def get_option_symbol(kite, index_name, reference_price, option_type="CE"):
     """Get OTM option symbol"""
     try:
-        index_info = Config.INDEX_MAP.get(index_name, {})
-        exchange = index_info.get("exchange", "NFO")
-        step_size = index_info.get("step_size", 100)
-        
-        df = load_instruments(kite, exchange)
-        if df is None:
+        index = get_instrument_index(kite, index_name)
+        if index is None:
             return None, None, None
         
-        if index_name == "CRUDEOIL":
-            if 'instrument_type' in df.columns:
-                options = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df['instrument_type'].isin(['CE', 'PE']))]
-                symbol_col = 'tradingsymbol'
-                strike_col = 'strike'
-                expiry_col = 'expiry'
-                type_col = 'instrument_type'
-            else:
-                options = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df.iloc[:, 9].isin(['CE', 'PE']))]
-                symbol_col = df.columns[2]
-                strike_col = df.columns[6]
-                expiry_col = df.columns[5]
-                type_col = df.columns[9]
-        else:
-            options = df[(df['name'] == index_name) & 
-                        (df['instrument_type'].isin(['CE', 'PE']))]
-            symbol_col = 'tradingsymbol'
-            strike_col = 'strike'
-            expiry_col = 'expiry'
-            type_col = 'instrument_type'
-        
-        if len(options) == 0:
+        latest_expiry = index.nearest_expiry(index_name)
+        if latest_expiry is None:
             return None, None, None
         
-        options = options.copy()
+        target_strike = float(get_target_strikes(index_name, reference_price, option_type))
         
-        try:
-            options['expiry'] = pd.to_datetime(options[expiry_col])
-        except:
+        closest = index.nearest_option(index_name, latest_expiry, option_type, target_strike)
+        if closest is None:
             return None, None, None
         
-        latest_expiry = options['expiry'].min().date()
-        
-        filtered = options[
-            (options['expiry'].dt.date == latest_expiry) &
-            (options[type_col] == option_type)
-        ].copy()
-        
-        if len(filtered) == 0:
+        symbol, strike, _ = closest
+        return symbol, strike, latest_expiry
+    
+    except Exception as e:
+        print(f"Error getting option symbol: {e}")
+        return None, None, None
+
+def get_option_symbols(kite, index_name, reference_prices, option_type="CE", otm_distances=None, expiry=None):
+    """Resolve OTM option symbols for many reference prices and/or OTM distances in one call.
+    
+    reference_prices and otm_distances broadcast against each other, so a backtest can
+    pass one price per bar, or one price with a range of distances. Returns
+    (symbols, strikes, expiry) with symbols/strikes as arrays of the broadcast shape.
+    """
+    try:
+        index = get_instrument_index(kite, index_name)
+        if index is None:
             return None, None, None
         
-        atm_strike = round(reference_price / step_size) * step_size
-        
-        if option_type == "CE":
-            target_strike = atm_strike + (Config.OTM_DISTANCE * step_size)
-        else:
-            target_strike = atm_strike - (Config.OTM_DISTANCE * step_size)
-        
-        filtered['strike_diff'] = abs(filtered[strike_col].astype(float) - target_strike)
+        expiry = expiry or index.nearest_expiry(index_name)
+        if expiry is None:
+            return None, None, None
         
-        closest_idx = filtered['strike_diff'].idxmin()
-        closest = filtered.loc[closest_idx]
+        target_strikes = get_target_strikes(index_name, reference_prices, option_type, otm_distances)
         
-        return closest[symbol_col], float(closest[strike_col]), latest_expiry
+        closest = index.nearest_options(index_name, expiry, option_type, target_strikes)
+        if closest is None:
+            return None, None, None
         
+        symbols, strikes, _ = closest
+        return symbols, strikes, expiry
+    
     except Exception as e:
-        print(f"Error getting option symbol: {e}")
+        print(f"Error getting option symbols: {e}")
         return None, None, None
 
-def get_reference_price(kite, index_name):
+def get_reference_instrument(kite, index_name):
+    """Return the ("EXCHANGE:SYMBOL", instrument_token) pair whose price drives strike selection"""
+    index_info = Config.INDEX_MAP.get(index_name, {})
+    
+    if index_name == "CRUDEOIL":
+        index = get_instrument_index(kite, index_name)
+        nearest_fut = index.nearest_future(index_name) if index is not None else None
+        
+        if nearest_fut is not None:
+            return f"MCX:{nearest_fut['tradingsymbol']}", int(nearest_fut['instrument_token'])
+        return "MCX:CRUDEOIL", None
+    
+    return index_info.get("spot_symbol"), index_info.get("spot_token")
+
+def get_reference_price(kite, index_name, quotes=None):
     """Get reference price for strike calculation"""
     try:
-        index_info = Config.INDEX_MAP.get(index_name, {})
+        key, token = get_reference_instrument(kite, index_name)
+        price = quotes.ltp(key, token) if quotes is not None else get_ltp(kite, key, token)
         
         if index_name == "CRUDEOIL":
-            exchange = "MCX"
-            df = load_instruments(kite, exchange)
-            
-            if df is not None:
-                if 'instrument_type' in df.columns:
-                    futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                                (df['instrument_type'] == 'FUT')].copy()
-                else:
-                    futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                                (df.iloc[:, 9] == 'FUT')].copy()
-                
-                if len(futures) > 0:
-                    if 'expiry' in futures.columns:
-                        futures['expiry_dt'] = pd.to_datetime(futures['expiry'])
-                    else:
-                        futures['expiry_dt'] = pd.to_datetime(futures.iloc[:, 5])
-                    
-                    nearest_fut = futures.loc[futures['expiry_dt'].idxmin()]
-                    
-                    if 'tradingsymbol' in nearest_fut:
-                        symbol = nearest_fut['tradingsymbol']
-                    else:
-                        symbol = nearest_fut.iloc[2]
-                    
-                    ltp_data = kite.ltp(f"{exchange}:{symbol}")
-                    price = list(ltp_data.values())[0]['last_price']
-                    return round_to_tick(price, index_name)
-            
-            symbol = "MCX:CRUDEOIL"
-            ltp_data = kite.ltp(symbol)
-            price = list(ltp_data.values())[0]['last_price']
             return round_to_tick(price, index_name)
-        else:
-            spot_symbol = index_info.get("spot_symbol")
-            ltp_data = kite.ltp(spot_symbol)
-            return list(ltp_data.values())[0]['last_price']
+        return price
     except Exception as e:
         print(f"Error getting reference price: {e}")
         # if index_name == "CRUDEOIL":
@@ -716,100 +1255,1208 @@ def get_reference_price(kite, index_name):
         # else:
         #     return 48000.0
 
-# --- TRADE MANAGER ---
-class TradeManager:
-    def __init__(self, kite):
-        self.kite = kite
-        self.load_trades()
-        self.load_orders()
-        self.update_stats()
+# --- MARKET FEED ---
+class MarketFeed:
+    """Live last-price table fed by a KiteTicker websocket.
     
-    def load_trades(self):
-        if os.path.exists(Config.TRADES_FILE):
-            try:
-                with open(Config.TRADES_FILE, 'r') as f:
-                    trades = json.load(f)
-                st.session_state.trade_history = trades
-                st.session_state.active_trades = [t for t in trades if t.get('status') == 'ACTIVE']
-            except:
-                st.session_state.trade_history = []
-                st.session_state.active_trades = []
+    Prices are held per instrument token; "EXCHANGE:SYMBOL" keys are mapped to
+    tokens when they are watched. Reads never go over the network: while the
+    socket is down ltp() returns None so callers can fall back to REST.
+    Instruments stream in full mode, the only one whose ticks carry the
+    exchange timestamp the engine's clock is set from.
+    """
+    def __init__(self, api_key, access_token, root=None):
+        self.access_token = access_token
+        self.ticker = KiteTicker(api_key, access_token, root=root,
+                                 reconnect_max_tries=KiteTicker._maximum_reconnect_max_tries)
+        self.ticker.on_ticks = self._on_ticks
+        self.ticker.on_connect = self._on_connect
+        self.ticker.on_close = self._on_close
+        self.ticker.on_reconnect = self._on_reconnect
+        self.ticker.on_order_update = self._on_order_update
+        self._lock = threading.Lock()
+        self.prices = {}
+        self.tokens = {}
+        self.connected = False
+        self.connections = 0
+        self.reconnects = 0
+        self.started = False
+        self.listeners = []
+        self.order_listeners = []
+        self.connect_listeners = []
     
-    def load_orders(self):
-        if os.path.exists(Config.ORDERS_FILE):
-            try:
-                with open(Config.ORDERS_FILE, 'r') as f:
-                    orders = json.load(f)
-                st.session_state.order_history = orders
-            except:
-                st.session_state.order_history = []
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        if reactor.running:
+            # Another feed already owns the reactor thread; connect through it
+            reactor.callFromThread(self.ticker.connect)
+        else:
+            self.ticker.connect(threaded=True)
     
-    def save_orders(self):
-        try:
-            with open(Config.ORDERS_FILE, 'w') as f:
-                json.dump(st.session_state.order_history, f, indent=2, default=str)
-        except Exception as e:
-            print(f"Error saving orders: {e}")
+    def stop(self):
+        self.connected = False
+        if self.started:
+            reactor.callFromThread(self.ticker.close)
     
-    def update_stats(self):
-        today = datetime.now().date()
-        today_trades = []
-        for trade in st.session_state.trade_history:
-            try:
-                entry_time = datetime.fromisoformat(trade['entry_time'])
-                if entry_time.date() == today:
-                    today_trades.append(trade)
-            except:
-                continue
+    def watch(self, key, token):
+        """Start streaming an instrument; safe to call repeatedly"""
+        if token is None:
+            return
+        token = int(token)
+        with self._lock:
+            if self.tokens.get(key) == token:
+                return
+            self.tokens[key] = token
+        self._send(self._subscribe, [token])
+    
+    def set_watchlist(self, instruments):
+        """Stream exactly the given {"EXCHANGE:SYMBOL": token} instruments"""
+        instruments = {key: int(token) for key, token in instruments.items() if token is not None}
+        with self._lock:
+            added = set(instruments.values()) - set(self.tokens.values())
+            removed = set(self.tokens.values()) - set(instruments.values())
+            self.tokens = instruments
+            for token in removed:
+                self.prices.pop(token, None)
         
-        st.session_state.today_trades_count = len(today_trades)
-        st.session_state.today_loss = sum(abs(t.get('pnl', 0)) for t in today_trades if t.get('status') == 'CLOSED' and t.get('pnl', 0) < 0)
+        if added:
+            self._send(self._subscribe, sorted(added))
+        if removed:
+            self._send(self.ticker.unsubscribe, sorted(removed))
     
-    def save_trades(self):
-        try:
-            with open(Config.TRADES_FILE, 'w') as f:
-                json.dump(st.session_state.trade_history, f, indent=2, default=str)
-        except:
-            pass
+    def ltp(self, key):
+        """Last traded price for a token or "EXCHANGE:SYMBOL" key, or None when unknown or the feed is down"""
+        if not self.connected:
+            return None
+        token = key if isinstance(key, int) else self.tokens.get(key)
+        tick = self.prices.get(token)
+        return tick[0] if tick else None
     
-    def calculate_quantity(self, index_name):
-        base_lot = get_base_lot_size(self.kite, index_name)
-        Config.BASE_LOT_SIZE = base_lot
+    def _send(self, method, tokens):
+        # Socket writes have to happen on the reactor thread
+        if self.connected:
+            reactor.callFromThread(method, tokens)
+    
+    def _subscribe(self, tokens):
+        self.ticker.subscribe(tokens)
+        self.ticker.set_mode(self.ticker.MODE_FULL, tokens)
+    
+    def add_listener(self, callback):
+        """Call callback(ticks) from the feed thread for every batch of ticks"""
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+    
+    def add_order_listener(self, callback):
+        """Call callback(order) from the feed thread for every order update"""
+        if callback not in self.order_listeners:
+            self.order_listeners.append(callback)
+    
+    def add_connect_listener(self, callback):
+        """Call callback() from the feed thread after every (re)connect"""
+        if callback not in self.connect_listeners:
+            self.connect_listeners.append(callback)
+    
+    def _on_connect(self, ws, response):
+        self.connected = True
+        self.connections += 1
+        with self._lock:
+            tokens = sorted(set(self.tokens.values()))
+        if tokens:
+            self._subscribe(tokens)
         
-        if Config.OVERRIDE_QUANTITY:
-            return Config.TOTAL_QUANTITY
-        else:
-            return base_lot * Config.NUMBER_OF_LOTS
+        for callback in self.connect_listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in connect listener: {e}")
     
-    def can_trade(self):
-        if not st.session_state.bot_running:
-            return False, "Bot stopped"
+    def _on_ticks(self, ws, ticks):
+        received_at = time.time()
+        for tick in ticks:
+            self.prices[tick['instrument_token']] = (tick['last_price'], received_at)
         
-        index_name = st.session_state.selected_index
-        trade_start, entry_end, square_off_time = get_trading_hours(index_name)
+        for callback in self.listeners:
+            try:
+                callback(ticks)
+            except Exception as e:
+                print(f"Error in tick listener: {e}")
+    
+    def _on_order_update(self, ws, order):
+        for callback in self.order_listeners:
+            try:
+                callback(order)
+            except Exception as e:
+                print(f"Error in order listener: {e}")
+    
+    def _on_close(self, ws, code, reason):
+        self.connected = False
+    
+    def _on_reconnect(self, ws, attempts_count):
+        self.reconnects += 1
+
+@st.cache_resource
+def get_market_feed_holder():
+    return {'feed': None}
+
+def get_market_feed():
+    return get_market_feed_holder()['feed']
+
+def start_market_feed(kite):
+    """Start (or reuse) the process-wide tick feed for the logged-in session"""
+    simulator = getattr(kite, 'kite', kite)
+    if getattr(simulator, 'is_simulator', False):
+        # Paper trading: prices come from the simulator's ltp() and it pushes its own order updates
+        tracker = get_order_tracker()
+        if tracker.stream is not simulator:
+            tracker.attach(kite, simulator)
+        return None
+    
+    if not Config.USE_TICKER:
+        return None
+    
+    holder = get_market_feed_holder()
+    feed = holder['feed']
+    if feed is not None and feed.access_token == kite.access_token:
+        return feed
+    
+    if feed is not None:
+        feed.stop()
+    try:
+        feed = MarketFeed(kite.api_key, kite.access_token, root=Config.TICKER_ROOT)
+        feed.add_listener(get_bar_builder().on_ticks)
+        get_order_tracker().attach(kite, feed)
+        feed.start()
+        holder['feed'] = feed
+    except Exception as e:
+        print(f"Error starting market feed: {e}")
+        holder['feed'] = None
+    return holder['feed']
+
+def sync_market_feed(kite):
+    """Stream the reference instrument of every index plus every open option leg"""
+    feed = get_market_feed()
+    if feed is None:
+        return
+    
+    instruments = {}
+    for index_name in Config.INDEX_MAP:
+        key, token = get_reference_instrument(kite, index_name)
+        instruments[key] = token
+    
+    for trade in st.session_state.active_trades:
+        key, token = get_trade_instrument(kite, trade)
+        instruments[key] = token
+    
+    feed.set_watchlist(instruments)
+
+class QuoteCache:
+    """REST prices shared for a short TTL; concurrent misses on a key share one in-flight request"""
+    WAIT_SECONDS = 10
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.prices = {}  # key -> (price, fetched_at)
+        self.inflight = {}  # key -> Event set when the claiming caller's request returns
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    def get_many(self, keys, fetch):
+        """Prices for keys; fetch(keys) -> {key: price} runs once for the keys nobody is already fetching"""
+        result = {}
+        claimed = []
+        waiting = {}
+        now = time.monotonic()
         
-        now_time = datetime.now().time()
+        with self.lock:
+            for key in keys:
+                cached = self.prices.get(key)
+                if cached is not None and now - cached[1] < self.ttl:
+                    result[key] = cached[0]
+                    self.hits += 1
+                elif key in self.inflight:
+                    waiting[key] = self.inflight[key]
+                    self.coalesced += 1
+                else:
+                    self.inflight[key] = threading.Event()
+                    claimed.append(key)
+                    self.misses += 1
         
-        # Check if we're within trading hours for new entries
-        if not (trade_start <= now_time <= entry_end):
-            return False, f"Outside entry hours ({trade_start.strftime('%H:%M')}-{entry_end.strftime('%H:%M')})"
+        if claimed:
+            fetched = {}
+            try:
+                fetched = fetch(claimed)
+                result.update(fetched)
+            finally:
+                with self.lock:
+                    fetched_at = time.monotonic()
+                    for key in claimed:
+                        if key in fetched:
+                            self.prices[key] = (fetched[key], fetched_at)
+                        self.inflight.pop(key).set()
         
-        # Check cooldown periods
-        cooldown_active, cooldown_msg = is_cooldown_active()
+        for key, event in waiting.items():
+            event.wait(self.WAIT_SECONDS)
+            with self.lock:
+                cached = self.prices.get(key)
+            if cached is not None:
+                result[key] = cached[0]
+        return result
+    
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.prices.clear()
+            else:
+                self.prices.pop(key, None)
+    
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'size': len(self.prices)}
+
+@st.cache_resource
+def get_quote_cache():
+    return QuoteCache(Config.QUOTE_CACHE_TTL)
+
+def fetch_ltps(kite, keys):
+    """One REST ltp() request for a list of "EXCHANGE:SYMBOL" keys"""
+    ltp_data = kite.ltp(keys)
+    return {key: data['last_price'] for key, data in ltp_data.items()}
+
+def get_ltp(kite, key, token=None):
+    """Last price for an "EXCHANGE:SYMBOL" key from the live feed, falling back to a REST call.
+    Raises if neither has a price, e.g. an expired or mistyped symbol the quote reply leaves out."""
+    feed = get_market_feed()
+    if feed is not None:
+        if token is not None:
+            feed.watch(key, token)
+        price = feed.ltp(key)
+        if price is not None:
+            return price
+    
+    prices = get_quote_cache().get_many([key], lambda keys: fetch_ltps(kite, keys))
+    if prices.get(key) is None:
+        raise Exception(f"No last price for {key}")
+    return prices[key]
+
+def get_ltps(kite, instruments):
+    """Last prices for {"EXCHANGE:SYMBOL": token} in one go: live feed first, one REST call for the rest"""
+    prices = {}
+    missing = []
+    feed = get_market_feed()
+    
+    for key, token in instruments.items():
+        price = None
+        if feed is not None:
+            if token is not None:
+                feed.watch(key, token)
+            price = feed.ltp(key)
+        if price is not None:
+            prices[key] = price
+        else:
+            missing.append(key)
+    
+    if missing:
+        prices.update(get_quote_cache().get_many(missing, lambda keys: fetch_ltps(kite, keys)))
+    return prices
+
+def get_trade_instrument(kite, trade):
+    """Return the ("EXCHANGE:SYMBOL", instrument_token) pair of an open option leg"""
+    exchange = trade.get('exchange', 'NFO')
+    token = trade.get('instrument_token')
+    if token is None:
+        index = get_instrument_index(kite, trade['index'])
+        token = index.tokens.get(trade['symbol']) if index is not None else None
+    return f"{exchange}:{trade['symbol']}", token
+
+class QuoteBatch:
+    """Every price one bot iteration needs, fetched together instead of one request per leg"""
+    def __init__(self, kite):
+        self.kite = kite
+        self.instruments = {}
+        self.prices = {}
+    
+    def add(self, key, token=None):
+        if key and (token is not None or key not in self.instruments):
+            self.instruments[key] = token
+        return self
+    
+    def add_trades(self, trades):
+        for trade in trades:
+            self.add(*get_trade_instrument(self.kite, trade))
+        return self
+    
+    def fetch(self):
+        pending = {key: token for key, token in self.instruments.items() if key not in self.prices}
+        if pending:
+            try:
+                self.prices.update(get_ltps(self.kite, pending))
+            except Exception as e:
+                print(f"Error fetching batched quotes: {e}")
+        return self
+    
+    def ltp(self, key, token=None):
+        """Price from the batch; anything not batched (or missing from the reply) is fetched singly"""
+        price = self.prices.get(key)
+        if price is None:
+            price = get_ltp(self.kite, key, token)
+            self.prices[key] = price
+        return price
+
+def build_iteration_quotes(kite, index_name):
+    """Batch the reference instrument of the selected index and every open leg"""
+    quotes = QuoteBatch(kite)
+    quotes.add(*get_reference_instrument(kite, index_name))
+    quotes.add_trades(st.session_state.active_trades)
+    
+    # With open legs these prices drive exits, so they must not queue behind anything else
+    with api_priority(PRIORITY_EXIT if st.session_state.active_trades else PRIORITY_NORMAL):
+        return quotes.fetch()
+
+# --- BAR BUILDER ---
+class BarRing:
+    """The last `capacity` OHLCV bars of one timeframe, in fixed NumPy ring buffers.
+    
+    Bar times are seconds since the epoch on the local (exchange) clock, so
+    bars line up with the 09:15 / 09:00 session opens exactly as Kite's do.
+    """
+    def __init__(self, seconds, capacity):
+        self.seconds = seconds
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.ohlc = np.zeros((capacity, 4), dtype=np.float64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+    
+    @property
+    def size(self):
+        return min(self.count, self.capacity)
+    
+    @staticmethod
+    def to_seconds(dt):
+        return int((dt - datetime(1970, 1, 1)).total_seconds())
+    
+    @staticmethod
+    def to_datetime(seconds):
+        return datetime(1970, 1, 1) + timedelta(seconds=int(seconds))
+    
+    def append(self, bar_time, open_, high, low, close, volume=0):
+        """Add a bar, or replace the last one if it has the same start time"""
+        if self.count and bar_time == self.times[(self.count - 1) % self.capacity]:
+            pos = (self.count - 1) % self.capacity
+        else:
+            pos = self.count % self.capacity
+            self.count += 1
+        self.times[pos] = bar_time
+        self.ohlc[pos] = (open_, high, low, close)
+        self.volume[pos] = volume
+    
+    def update(self, timestamp, price, volume=0):
+        """Fold one trade price into the bar containing timestamp"""
+        bar_time = timestamp - timestamp % self.seconds
+        if self.count:
+            pos = (self.count - 1) % self.capacity
+            last_time = self.times[pos]
+            if bar_time == last_time:
+                bar = self.ohlc[pos]
+                if price > bar[1]:
+                    bar[1] = price
+                if price < bar[2]:
+                    bar[2] = price
+                bar[3] = price
+                self.volume[pos] += volume
+                return
+            if bar_time < last_time:
+                return
+        self.append(bar_time, price, price, price, price, volume)
+    
+    def _positions(self, n=None):
+        size = self.size if n is None else min(n, self.size)
+        return np.arange(self.count - size, self.count) % self.capacity
+    
+    def arrays(self, n=None):
+        """(times, ohlc, volume) copies of the last n bars in chronological order"""
+        pos = self._positions(n)
+        return self.times[pos], self.ohlc[pos], self.volume[pos]
+    
+    def candles(self, since=None):
+        """Bars as candle dicts, oldest first, starting at the bar that opened at `since` if given"""
+        pos = self._positions()
+        if since is not None and len(pos):
+            start = int(np.searchsorted(self.times[pos], self.to_seconds(since)))
+            pos = pos[start:]
+        return [{
+            'date': self.to_datetime(self.times[p]),
+            'open': float(self.ohlc[p, 0]),
+            'high': float(self.ohlc[p, 1]),
+            'low': float(self.ohlc[p, 2]),
+            'close': float(self.ohlc[p, 3]),
+            'volume': float(self.volume[p])
+        } for p in pos]
+
+class BarBuilder:
+    """Builds 1m/3m/5m/15m bars per token from live ticks.
+    
+    Each token's rings are seeded from historical_data the first time they are
+    asked for, and again only after the feed reconnects (ticks may have been
+    missed). Between those points, bars come from ticks alone, with no REST calls.
+    Ticks are placed by exchange time and a bar's volume is the growth of the
+    day's cumulative volume_traded, so trades between two ticks are not lost.
+    """
+    TIMEFRAMES = {"minute": 60, "3minute": 180, "5minute": 300, "15minute": 900}
+    
+    def __init__(self, capacity=500):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.rings = {}
+        self.seeded_for = {}
+        self.volume_traded = {}  # token -> cumulative day volume at its last tick
+    
+    def _volume(self, token, tick):
+        """Volume traded since the token's previous tick"""
+        total = tick.get('volume_traded')
+        if total is None:
+            return 0
+        last = self.volume_traded.get(token)
+        self.volume_traded[token] = total
+        if last is None:
+            return 0  # the seeded bars already hold everything up to now
+        return total - last if total >= last else total  # the count restarts each day
+    
+    def on_ticks(self, ticks):
+        now = BarRing.to_seconds(datetime.now())
+        with self._lock:
+            for tick in ticks:
+                token = tick['instrument_token']
+                rings = self.rings.get(token)
+                if rings is None:
+                    continue
+                timestamp = tick.get('exchange_timestamp') or tick.get('last_trade_time')
+                timestamp = BarRing.to_seconds(timestamp) if timestamp else now
+                volume = self._volume(token, tick)
+                for ring in rings.values():
+                    ring.update(timestamp, tick['last_price'], volume)
+    
+    def seed(self, kite, token, connection):
+        """Load every timeframe's ring for a token from historical_data"""
+        rings = {}
+        now = datetime.now()
+        for interval, seconds in self.TIMEFRAMES.items():
+            # Roughly one NSE session (22,500s) per day, plus slack for weekends and holidays
+            days = min(60, int(self.capacity * seconds / 22500) + 4)
+            hist = fetch_historical_candles(kite, token, now - timedelta(days=days), now, interval)
+            if hist is None:
+                return False
+            
+            ring = BarRing(seconds, self.capacity)
+            for candle in hist[-self.capacity:]:
+                ring.append(BarRing.to_seconds(candle['date']), candle['open'], candle['high'],
+                            candle['low'], candle['close'], candle.get('volume', 0))
+            rings[interval] = ring
+        
+        with self._lock:
+            self.rings[token] = rings
+            self.seeded_for[token] = connection
+            self.volume_traded.pop(token, None)
+        return True
+    
+    def get_candles(self, kite, token, interval="5minute", since=None):
+        """Candles for a token from the tick-built ring, or None when the live feed is unavailable"""
+        feed = get_market_feed()
+        if feed is None or not feed.connected:
+            return None
+        
+        if self.seeded_for.get(token) != feed.connections:
+            if not self.seed(kite, token, feed.connections):
+                return None
+        
+        with self._lock:
+            return self.rings[token][interval].candles(since)
+    
+    def get_bars(self, token, interval="5minute", n=None):
+        """(times, ohlc, volume) arrays of the last n bars, for multi-timeframe checks"""
+        with self._lock:
+            rings = self.rings.get(token)
+            if rings is None:
+                return None
+            return rings[interval].arrays(n)
+
+@st.cache_resource
+def get_bar_builder():
+    return BarBuilder()
+
+# --- ORDER TRACKING ---
+class OrderTracker(threading.Thread):
+    """Follows placed orders to a terminal status in the background.
+    
+    Updates normally arrive on the KiteTicker order channel; order_history() is
+    polled only while that stream is down, and one kite.orders() pass
+    reconciles anything missed whenever the stream (re)connects. Status
+    transitions are queued and applied by the trading loop through drain(), so
+    placing an order never blocks waiting for its fill. The tracker is shared
+    by every session; each drains only the updates it claims and leaves the
+    rest queued for their owner.
+    """
+    TERMINAL_STATUSES = {'COMPLETE', 'REJECTED', 'CANCELLED'}
+    POLL_SECONDS = 1.0
+    UNMATCHED_LIMIT = 100
+    UNCLAIMED_SECONDS = 300
+    
+    def __init__(self):
+        super().__init__(name="order-tracker", daemon=True)
+        self.kite = None
+        self.stream = None
+        self.pending = {}  # order_id -> last status seen
+        self.unmatched = {}  # updates that arrived before their order id was tracked
+        self.finished = {}  # recent terminal updates, for wait_for()
+        self.updates = deque()  # (queued_at, update)
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self._reconcile = False
+        self._wake = threading.Event()
+    
+    def attach(self, kite, stream):
+        """Take order updates from a MarketFeed and reconcile each time it connects"""
+        with self.lock:
+            self.kite = kite
+            self.stream = stream
+            self._ensure_started()
+        stream.add_order_listener(self.on_order_update)
+        stream.add_connect_listener(self.request_reconcile)
+        if stream.connected:
+            self.request_reconcile()
+    
+    def track(self, kite, order_id, status=None):
+        if not order_id:
+            return
+        order_id = str(order_id)
+        with self.lock:
+            self.kite = kite
+            if order_id in self.pending or order_id in self.finished:
+                return
+            self.pending[order_id] = status
+            self._ensure_started()
+            early = self.unmatched.pop(order_id, None)
+        if early is not None:
+            self.on_order_update(early)
+        self._wake.set()
+    
+    def _ensure_started(self):
+        if not self.is_alive():
+            self.start()
+    
+    def pending_ids(self):
+        """Snapshot of the order ids still being followed"""
+        with self.lock:
+            return list(self.pending)
+    
+    def is_pending(self, order_id):
+        with self.lock:
+            return str(order_id) in self.pending
+    
+    def status(self, order_id):
+        """Last status seen for an order still pending or recently finished, else None"""
+        order_id = str(order_id)
+        with self.lock:
+            if order_id in self.pending:
+                return self.pending[order_id]
+            return self.finished.get(order_id, {}).get('status')
+    
+    def request_reconcile(self):
+        self._reconcile = True
+        self._wake.set()
+    
+    def on_order_update(self, kite_order, live=True):
+        """Record the latest known state of an order if its status changed"""
+        order_id = str(kite_order.get('order_id'))
+        status = kite_order.get('status')
+        with self.lock:
+            if order_id not in self.pending:
+                # A streamed update can beat place_order() returning the id; keep it for track()
+                if live:
+                    self.unmatched[order_id] = kite_order
+                    while len(self.unmatched) > self.UNMATCHED_LIMIT:
+                        self.unmatched.pop(next(iter(self.unmatched)))
+                return
+            if self.pending[order_id] == status:
+                return
+            if status in self.TERMINAL_STATUSES:
+                del self.pending[order_id]
+                self.finished[order_id] = kite_order
+                while len(self.finished) > self.UNMATCHED_LIMIT:
+                    self.finished.pop(next(iter(self.finished)))
+                self.done.notify_all()
+            else:
+                self.pending[order_id] = status
+            self.updates.append((time.monotonic(), kite_order))
+    
+    def wait_for(self, order_id, timeout):
+        """Block until a tracked order reaches a terminal status; its last update, or None on timeout"""
+        order_id = str(order_id)
+        with self.done:
+            self.done.wait_for(lambda: order_id in self.finished, timeout)
+            return self.finished.get(order_id)
+    
+    def drain(self, claim=None):
+        """Pop the queued updates claim(update) accepts (all by default); the others stay
+        queued, in order, until they are UNCLAIMED_SECONDS old"""
+        now = time.monotonic()
+        claimed = []
+        kept = []
+        with self.lock:
+            while self.updates:
+                queued_at, kite_order = self.updates.popleft()
+                if claim is None or claim(kite_order):
+                    claimed.append(kite_order)
+                elif now - queued_at < self.UNCLAIMED_SECONDS:
+                    kept.append((queued_at, kite_order))
+                else:
+                    print(f"Dropping unclaimed update for order {kite_order.get('order_id')}")
+            self.updates.extend(kept)
+        return claimed
+    
+    def run(self):
+        while True:
+            with self.lock:
+                order_ids = list(self.pending)
+                kite = self.kite
+                streaming = self.stream is not None and self.stream.connected
+            
+            if self._reconcile and kite is not None:
+                self._reconcile = False
+                self._reconcile_orders(kite)
+            elif order_ids and not streaming:
+                self._poll_orders(kite, order_ids)
+            
+            self._wake.wait(self.POLL_SECONDS if order_ids else None)
+            self._wake.clear()
+    
+    def _reconcile_orders(self, kite):
+        try:
+            for kite_order in kite.orders():
+                self.on_order_update(kite_order, live=False)
+        except Exception as e:
+            print(f"Error reconciling orders: {e}")
+            self._reconcile = True
+    
+    def _poll_orders(self, kite, order_ids):
+        for order_id in order_ids:
+            try:
+                history = kite.order_history(order_id)
+                if history:
+                    self.on_order_update(history[-1], live=False)
+            except Exception as e:
+                print(f"Error polling order {order_id}: {e}")
+
+@st.cache_resource
+def get_order_tracker():
+    return OrderTracker()
+
+# --- RECORD STORE ---
+# Records in one of these states are finished; everything else stays in the session's working set
+RECORD_DONE_STATUSES = {'COMPLETE', 'REJECTED', 'CANCELLED', 'CLOSED'}
+
+def in_working_set(record, since):
+    """True for records entered on or after the `since` ISO date, or still open"""
+    return str(record.get('entry_time') or '')[:10] >= since or record.get('status') not in RECORD_DONE_STATUSES
+
+class JournalStore:
+    """Order or trade records kept as a JSON snapshot plus an append-only JSON-lines journal.
+    
+    save() appends one line per new or changed record instead of rewriting the
+    whole file. Lines are flushed at once but fsynced in batches, at most
+    FSYNC_SECONDS after they were written. Once the journal is longer than both
+    COMPACT_RECORDS and the number of live records, the records are written out
+    as a new snapshot and the journal starts over, so compaction costs stay
+    proportional to the appends that paid for them. load() reads the snapshot and
+    replays the journal tail over it; the last line for a record_id wins.
+    """
+    KEY_FIELD = 'record_id'
+    FSYNC_SECONDS = 1.0
+    COMPACT_RECORDS = 1000
+    
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.records = {}
+        self.journal_lines = 0
+        self.lock = threading.Lock()
+        self._journal = None
+        self._sync_timer = None
+        self.file_stat = None  # sizes and mtimes as this process last left the files
+        self.external_changes = 0
+    
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.journal_path)
+    
+    def _stat(self):
+        stat = []
+        for path in (self.path, self.journal_path):
+            try:
+                info = os.stat(path)
+                stat.append((info.st_size, info.st_mtime_ns))
+            except OSError:
+                stat.append(None)
+        return tuple(stat)
+    
+    def version(self):
+        """A number that changes whenever another process has written the files"""
+        with self.lock:
+            stat = self._stat()
+            if stat != self.file_stat:
+                self.file_stat = stat
+                self.external_changes += 1
+            return self.external_changes
+    
+    def load(self, since=None):
+        """Rebuild the records from the snapshot and the journal tail; with `since` (an ISO date),
+        only those entered from that day on or still open"""
+        with self.lock:
+            records = {}
+            missing_keys = False
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    for i, record in enumerate(json.load(f)):
+                        if self.KEY_FIELD not in record:
+                            record[self.KEY_FIELD] = f"legacy-{i}"
+                            missing_keys = True
+                        records[record[self.KEY_FIELD]] = record
+            
+            lines = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # a line torn by a crash mid-write
+                        records[record[self.KEY_FIELD]] = record
+                        lines += 1
+            
+            self.records = records
+            self.journal_lines = lines
+            if missing_keys or self._compaction_due():
+                self._compact()
+            self.file_stat = self._stat()
+            return [r for r in records.values() if since is None or in_working_set(r, since)]
+    
+    def recent(self, limit):
+        """The last `limit` records, newest first"""
+        with self.lock:
+            return list(islice(reversed(self.records.values()), limit))
+    
+    def save(self, records):
+        """Append the given new or changed records to the journal"""
+        with self.lock:
+            batch = {}
+            for record in records:
+                # Random, so records of one batch never share a key
+                key = record.setdefault(self.KEY_FIELD, uuid.uuid4().hex)
+                batch[key] = record
+            if not batch:
+                return
+            
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write("".join(json.dumps(record, default=str) + "\n" for record in batch.values()))
+            self._journal.flush()
+            self.records.update(batch)
+            self.journal_lines += len(batch)
+            
+            if self._compaction_due():
+                self._compact()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(self.FSYNC_SECONDS, self.sync)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+            self.file_stat = self._stat()
+    
+    def sync(self):
+        with self.lock:
+            self._sync_timer = None
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+    
+    def _compaction_due(self):
+        return self.journal_lines > max(self.COMPACT_RECORDS, len(self.records))
+    
+    def _compact(self):
+        """Write the current records as the snapshot, then empty the journal (lock held).
+        
+        A crash between the two steps only leaves lines that replay to the same state.
+        """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self.records.values()), f, indent=2, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        open(self.journal_path, 'w').close()
+        self.journal_lines = 0
+
+class SqliteStore:
+    """Order or trade records in an SQLite database in WAL mode, one row per record.
+    
+    The whole record is stored as JSON, with the fields that reports filter on
+    copied into indexed columns, so the session loads only its working set and
+    the daily totals and order log are queries. Saving an order record also
+    upserts one fills row per child order. Commits do not fsync (synchronous =
+    NORMAL); WAL checkpoints do, which batches the syncs.
+    """
+    COLUMNS = {
+        'orders': ['order_id', 'entry_date', 'entry_time', 'index_name', 'symbol', 'signal', 'status', 'is_open'],
+        'trades': ['order_id', 'entry_date', 'entry_time', 'index_name', 'symbol', 'status', 'is_open', 'pnl', 'exit_time']
+    }
+    INDEXED = ['order_id', 'entry_date', 'index_name', 'status', 'is_open']
+    
+    def __init__(self, path, table):
+        self.table = table
+        self.columns = self.COLUMNS[table]
+        self.db, self.lock = open_database(path)
+        with self.lock, self.db:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            f"record_id TEXT UNIQUE NOT NULL, {', '.join(self.columns)}, data TEXT NOT NULL)")
+            for column in self.INDEXED:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table}({column})")
+            self.db.execute("CREATE TABLE IF NOT EXISTS fills (order_id TEXT PRIMARY KEY, record_id TEXT NOT NULL, "
+                            "quantity INTEGER, filled_quantity INTEGER, average_price REAL, status TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS fills_record_id ON fills(record_id)")
+    
+    def _row(self, record):
+        entry_time = str(record.get('entry_time') or '') or None
+        values = {
+            'order_id': str(record['order_id']) if record.get('order_id') else None,
+            'entry_date': entry_time[:10] if entry_time else None,
+            'entry_time': entry_time,
+            'index_name': record.get('index'),
+            'is_open': int(record.get('status') not in RECORD_DONE_STATUSES),
+            'pnl': record.get('pnl'),
+            'exit_time': record.get('exit_time')
+        }
+        row = [values[c] if c in values else record.get(c) for c in self.columns]
+        return [record['record_id']] + row + [json.dumps(record, default=str)]
+    
+    def exists(self):
+        with self.lock:
+            return self.db.execute(f"SELECT 1 FROM {self.table} LIMIT 1").fetchone() is not None
+    
+    def version(self):
+        """A number that changes whenever another connection (another process) has committed"""
+        with self.lock:
+            return self.db.execute("PRAGMA data_version").fetchone()[0]
+    
+    def load(self, since=None):
+        """Records in insertion order; with `since` (an ISO date), only those entered from that
+        day on or still open"""
+        query = f"SELECT data FROM {self.table}"
+        params = ()
+        if since is not None:
+            query += " WHERE entry_date >= ? OR is_open = 1"
+            params = (since,)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY seq", params).fetchall()
+        return [json.loads(data) for data, in rows]
+    
+    def save(self, records):
+        """Insert or update the given new or changed records in one transaction"""
+        rows = []
+        fills = []
+        for record in records:
+            record.setdefault('record_id', uuid.uuid4().hex)
+            rows.append(self._row(record))
+            if self.table == 'orders':
+                for order_id, child in (record.get('children') or {}).items():
+                    fills.append((order_id, record['record_id'], child.get('quantity'), child.get('filled_quantity'),
+                                  child.get('average_price'), child.get('status')))
+        if not rows:
+            return
+        
+        columns = ['record_id'] + self.columns + ['data']
+        updates = ', '.join(f"{c} = excluded.{c}" for c in columns[1:])
+        with self.lock, self.db:
+            self.db.executemany(f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                                f"ON CONFLICT(record_id) DO UPDATE SET {updates}", rows)
+            self.db.executemany("INSERT OR REPLACE INTO fills VALUES (?, ?, ?, ?, ?, ?)", fills)
+    
+    def recent(self, limit):
+        """The last `limit` records, newest first"""
+        with self.lock:
+            rows = self.db.execute(f"SELECT data FROM {self.table} ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+def migrate_json_log(store, path):
+    """One-time import of a JSON log (snapshot plus journal) into an empty SQLite table.
+    The imported files are kept, renamed to *.migrated."""
+    legacy = JournalStore(path)
+    if not legacy.exists() or store.exists():
+        return 0
+    records = legacy.load()
+    store.save(records)
+    for imported in (path, legacy.journal_path):
+        if os.path.exists(imported):
+            os.replace(imported, f"{imported}.migrated")
+    print(f"Migrated {len(records)} records from {path} to SQLite")
+    return len(records)
+
+@st.cache_resource
+def open_database(path):
+    """One connection per database file, shared by its tables, with the lock that serialises it"""
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db, threading.Lock()
+
+@st.cache_resource
+def open_journal_store(path):
+    return JournalStore(path)
+
+@st.cache_resource
+def open_sqlite_store(db_path, table, legacy_path):
+    store = SqliteStore(db_path, table)
+    try:
+        migrate_json_log(store, legacy_path)
+    except Exception as e:
+        print(f"Error migrating {legacy_path}: {e}")
+    return store
+
+def get_record_store(table):
+    """The configured store for the 'orders' or 'trades' records"""
+    path = Config.ORDERS_FILE if table == 'orders' else Config.TRADES_FILE
+    if Config.RECORD_STORE == "sqlite":
+        return open_sqlite_store(Config.DATABASE_FILE, table, path)
+    return open_journal_store(path)
+
+# --- DAILY RISK ---
+class DailyRisk:
+    """Running trade count and realised loss of the current trading day, per segment.
+    
+    Updated on every trade open and close instead of being recomputed from the
+    trade log, so limit checks cost the same however long the log gets. Each
+    segment starts a new day at its Config.RISK_DAY_START time; the counters are
+    rewritten to RISK_FILE on every change so a restart carries on from them, and
+    read again whenever another process (the engine or a dashboard) has written it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.days = {}  # segment -> {'date', 'trades', 'loss'}
+        self.loaded = False
+        self.file_stat = None
+        with self.lock:
+            self._refresh()
+    
+    def _stat(self):
+        try:
+            info = os.stat(self.path)
+            return info.st_size, info.st_mtime_ns
+        except OSError:
+            return None
+    
+    def _refresh(self):
+        """Load the counters again if the file changed since we last read or wrote it (lock held)"""
+        stat = self._stat()
+        if stat is None or stat == self.file_stat:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.days = json.load(f)
+            self.file_stat = stat
+            self.loaded = True
+        except Exception as e:
+            print(f"Error loading daily risk: {e}")
+    
+    @staticmethod
+    def segment(index_name):
+        return Config.INDEX_MAP.get(index_name, {}).get('segment', 'NSE')
+    
+    def _day(self, segment, now=None):
+        """Counters of the segment's current trading day, starting fresh after a rollover (lock held)"""
+        date = get_exchange_trading_date(segment, now, Config.RISK_DAY_START).isoformat()
+        day = self.days.get(segment)
+        if day is None or day['date'] != date:
+            day = self.days[segment] = {'date': date, 'trades': 0, 'loss': 0.0}
+        return day
+    
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.days, f)
+        os.replace(tmp_path, self.path)
+        self.file_stat = self._stat()
+    
+    def record_open(self, index_name):
+        with self.lock:
+            self._refresh()
+            self._day(self.segment(index_name))['trades'] += 1
+            self._save()
+    
+    def record_close(self, index_name, pnl):
+        if pnl >= 0:
+            return
+        with self.lock:
+            self._refresh()
+            self._day(self.segment(index_name))['loss'] += abs(pnl)
+            self._save()
+    
+    def totals(self):
+        """(trades, loss) of the current trading day, summed over segments"""
+        with self.lock:
+            self._refresh()
+            days = [self._day(segment) for segment in {info.get('segment', 'NSE') for info in Config.INDEX_MAP.values()}]
+        return sum(day['trades'] for day in days), sum(day['loss'] for day in days)
+    
+    def rebuild(self, trades):
+        """Seed the counters from the trade log, for a first run without saved counters"""
+        with self.lock:
+            self.days = {}
+            for trade in trades:
+                try:
+                    segment = self.segment(trade.get('index'))
+                    day = self._day(segment)
+                    entered = get_exchange_trading_date(segment, datetime.fromisoformat(trade['entry_time']),
+                                                        Config.RISK_DAY_START)
+                except Exception:
+                    continue
+                if entered.isoformat() == day['date']:
+                    day['trades'] += 1
+                    if trade.get('status') == 'CLOSED' and (trade.get('pnl') or 0) < 0:
+                        day['loss'] += abs(trade['pnl'])
+            self._save()
+            self.loaded = True
+
+@st.cache_resource
+def get_daily_risk(path):
+    return DailyRisk(path)
+
+# --- TRADE MANAGER ---
+class TradeManager:
+    CHILD_ORDER_WORKERS = 4
+    
+    def __init__(self, kite):
+        self.kite = kite
+        self.trading_date = datetime.now().date()
+        self.trade_store = get_record_store('trades')
+        self.order_store = get_record_store('orders')
+        self.risk = get_daily_risk(Config.RISK_FILE)
+        self.load_trades()
+        self.load_orders()
+        self.store_versions = self.record_store_versions()
+        if not self.risk.loaded:
+            self.risk.rebuild(st.session_state.trade_history)
+        self.update_stats()
+        self.track_open_orders()
+    
+    def record_store_versions(self):
+        return self.trade_store.version(), self.order_store.version()
+    
+    def is_stale(self):
+        """Whether the loaded working set is from an earlier day or the logs were written elsewhere"""
+        return self.trading_date != datetime.now().date() or self.record_store_versions() != self.store_versions
+    
+    def load_trades(self):
+        if self.trade_store.exists():
+            try:
+                trades = self.trade_store.load(since=self.trading_date.isoformat())
+                st.session_state.trade_history = trades
+                st.session_state.active_trades = [t for t in trades if t.get('status') == 'ACTIVE']
+            except:
+                st.session_state.trade_history = []
+                st.session_state.active_trades = []
+    
+    def load_orders(self):
+        if self.order_store.exists():
+            try:
+                orders = self.order_store.load(since=self.trading_date.isoformat())
+                st.session_state.order_history = orders
+            except:
+                st.session_state.order_history = []
+        self.index_orders()
+    
+    def index_orders(self):
+        st.session_state.order_index = {order_id: order for order in st.session_state.order_history
+                                        for order_id in self.order_children(order)}
+    
+    def track_open_orders(self):
+        """Keep following today's orders that were still open when the log was last written"""
+        tracker = get_order_tracker()
+        today = datetime.now().date().isoformat()
+        for order in st.session_state.order_history:
+            if (order.get('order_id') and order.get('status') not in OrderTracker.TERMINAL_STATUSES
+                    and str(order.get('entry_time', '')).startswith(today)):
+                for order_id, child in self.order_children(order).items():
+                    if child.get('status') not in OrderTracker.TERMINAL_STATUSES:
+                        tracker.track(self.kite, order_id, child.get('status'))
+    
+    def save_orders(self, orders):
+        """Journal new or changed order records"""
+        try:
+            self.order_store.save(orders)
+        except Exception as e:
+            print(f"Error saving orders: {e}")
+    
+    def update_stats(self):
+        st.session_state.today_trades_count, st.session_state.today_loss = self.risk.totals()
+    
+    def save_trades(self, trades):
+        """Journal new or changed trade records"""
+        try:
+            self.trade_store.save(trades)
+        except Exception as e:
+            print(f"Error saving trades: {e}")
+    
+    def calculate_quantity(self, index_name):
+        base_lot = get_base_lot_size(self.kite, index_name)
+        Config.BASE_LOT_SIZE = base_lot
+        
+        if Config.OVERRIDE_QUANTITY:
+            return Config.TOTAL_QUANTITY
+        else:
+            return base_lot * Config.NUMBER_OF_LOTS
+    
+    def can_trade(self, index_name=None):
+        """Whether a new entry is allowed now. With an index_name (the engine's scan), that
+        instrument's hours apply and only its own open or pending legs block an entry."""
+        if not st.session_state.bot_running:
+            return False, "Bot stopped"
+        
+        scanning = index_name is not None
+        index_name = index_name or st.session_state.selected_index
+        trade_start, entry_end, square_off_time = get_trading_hours(index_name)
+        
+        now_time = datetime.now().time()
+        
+        # Check if we're within trading hours for new entries
+        if not (trade_start <= now_time <= entry_end):
+            return False, f"Outside entry hours ({trade_start.strftime('%H:%M')}-{entry_end.strftime('%H:%M')})"
+        
+        # Check cooldown periods; each instrument has its own
+        cooldown_active, cooldown_msg = is_cooldown_active(index_name)
         if cooldown_active:
             return False, cooldown_msg
         
         # Check daily limits
-        if st.session_state.today_trades_count >= Config.MAX_TRADES_PER_DAY:
+        today_trades_count, today_loss = self.risk.totals()
+        if today_trades_count >= Config.MAX_TRADES_PER_DAY:
             return False, "Max trades reached"
         
-        if st.session_state.today_loss >= Config.MAX_LOSS_PER_DAY:
+        if today_loss >= Config.MAX_LOSS_PER_DAY:
             return False, "Max loss reached"
         
         # Check if there's already an active trade
-        if len(st.session_state.active_trades) > 0:
+        if any(not scanning or t['index'] == index_name for t in st.session_state.active_trades):
             return False, "Active trade exists"
         
+        if self.has_pending_entry(index_name if scanning else None):
+            return False, "Entry order pending"
+        
         return True, ""
     
     def place_order(self, index_name, signal_type, reference_price):
@@ -838,14 +2485,17 @@ class TradeManager:
             index_info = Config.INDEX_MAP.get(index_name, {})
             exchange = index_info.get("exchange", "NFO")
             
-            ltp_data = self.kite.ltp(f"{exchange}:{symbol}")
-            ltp = ltp_data[f"{exchange}:{symbol}"]["last_price"]
+            index = get_instrument_index(self.kite, index_name)
+            instrument_token = index.tokens.get(symbol) if index is not None else None
+            
+            ltp = get_ltp(self.kite, f"{exchange}:{symbol}", instrument_token)
             ltp = round_to_tick(ltp, index_name)
             
             quantity = self.calculate_quantity(index_name)
             
             order_type = self.kite.ORDER_TYPE_MARKET
             price = None
+            product = self.kite.PRODUCT_NRML if Config.PROTECTIVE_ORDER_MODE == "GTT" else self.kite.PRODUCT_MIS
             
             if exchange == "MCX":
                 order_type = self.kite.ORDER_TYPE_LIMIT
@@ -853,19 +2503,24 @@ class TradeManager:
                 price = round_to_tick(price, index_name)
             
             try:
-                order_id = self.kite.place_order(
+                children = self.place_children(
+                    self.child_quantities(index_name, quantity),
+                    PRIORITY_ORDER,
                     variety=self.kite.VARIETY_REGULAR,
                     exchange=exchange,
                     tradingsymbol=symbol,
                     transaction_type=self.kite.TRANSACTION_TYPE_BUY,
-                    quantity=quantity,
                     order_type=order_type,
                     price=price,
-                    product=self.kite.PRODUCT_MIS,
+                    product=product,
                     validity=self.kite.VALIDITY_DAY
                 )
+                placed = [c for c in children if c['order_id']]
+                if not placed:
+                    raise children[0]['error']
+                order_id = placed[0]['order_id']
                 
-                # Calculate initial SL/TP
+                # Calculate initial SL/TP (recomputed from the average fill once the order completes)
                 sl_price = ltp - Config.SL_POINTS
                 tp_price = ltp + Config.TP_POINTS
                 
@@ -877,21 +2532,29 @@ class TradeManager:
                 tsl_triggered = False
                 tsl_price = sl_price  # Initial TSL price = SL price
                 
+                failed = [c for c in children if not c['order_id']]
+                reason = 'Order placed successfully'
+                if failed:
+                    reason = f"{len(failed)} of {len(children)} child orders failed: {failed[0]['error']}"
+                
                 order_record = {
                     'order_id': order_id,
                     'symbol': symbol,
+                    'instrument_token': instrument_token,
                     'index': index_name,
                     'exchange': exchange,
                     'strike': strike,
                     'option_type': option_type,
                     'entry_price': ltp,
                     'entry_time': datetime.now().isoformat(),
-                    'quantity': quantity,
+                    'quantity': sum(c['quantity'] for c in placed),
+                    'product': product,
                     'status': 'PENDING',
                     'sl_price': sl_price,
                     'tp_price': tp_price,
                     'signal': signal_type,
-                    'reason': 'Order placed successfully',
+                    'reason': reason,
+                    'children': self.child_records(placed),
                     # TSL tracking fields
                     'highest_price': highest_price,
                     'tsl_triggered': tsl_triggered,
@@ -901,21 +2564,11 @@ class TradeManager:
                 
                 self.add_order_record(order_record)
                 
-                # Set last order time for cooldown
-                st.session_state.last_order_time = datetime.now()
+                # Set last order time for this instrument's cooldown
+                st.session_state.last_order_time[index_name] = datetime.now()
                 
-                time.sleep(2)
-                self.check_order_status(order_id)
-                
-                for order in st.session_state.order_history:
-                    if order.get('order_id') == order_id and order.get('status') == 'COMPLETE':
-                        trade = order.copy()
-                        trade['status'] = 'ACTIVE'
-                        st.session_state.active_trades.append(trade)
-                        st.session_state.trade_history.append(trade)
-                        st.session_state.today_trades_count += 1
-                        self.save_trades()
-                        break
+                # Fills are picked up by process_order_updates() on a later iteration
+                self.track_children(placed)
                 
                 return order_id
                 
@@ -959,57 +2612,176 @@ class TradeManager:
             })
             return None
     
+    def child_quantities(self, index_name, quantity):
+        freeze_quantity = Config.INDEX_MAP.get(index_name, {}).get('freeze_quantity')
+        return slice_quantity(quantity, get_base_lot_size(self.kite, index_name), freeze_quantity)
+    
+    def run_children(self, submit, items):
+        """Run submit(item) for every child; several children go out concurrently and the
+        API gateway paces them within the order rate limit"""
+        if len(items) == 1:
+            return [submit(items[0])]
+        with ThreadPoolExecutor(max_workers=min(len(items), self.CHILD_ORDER_WORKERS),
+                                thread_name_prefix="child-orders") as pool:
+            return list(pool.map(submit, items))
+    
+    def place_children(self, quantities, priority, **params):
+        """Place one order per child quantity; returns [{'quantity', 'order_id', 'error'}]"""
+        def submit(quantity):
+            child = {'quantity': quantity, 'order_id': None, 'error': None}
+            try:
+                with api_priority(priority):
+                    child['order_id'] = self.kite.place_order(quantity=quantity, **params)
+            except Exception as e:
+                child['error'] = e
+            return child
+        return self.run_children(submit, quantities)
+    
+    def child_records(self, children):
+        return {str(c['order_id']): {'quantity': c['quantity'], 'status': 'PENDING',
+                                     'filled_quantity': 0, 'average_price': None}
+                for c in children}
+    
+    def track_children(self, children):
+        tracker = get_order_tracker()
+        for child in children:
+            tracker.track(self.kite, child['order_id'], 'PENDING')
+    
+    def order_children(self, order):
+        """Child orders of a logical order; records without children are a single child"""
+        if 'children' not in order and order.get('order_id'):
+            order['children'] = {str(order['order_id']): {'quantity': order.get('quantity'), 'status': order.get('status'),
+                                                          'filled_quantity': 0, 'average_price': None}}
+        return order.get('children', {})
+    
     def add_order_record(self, order_record):
         order_record['record_id'] = f"{datetime.now().timestamp()}-{len(st.session_state.order_history)}"
         st.session_state.order_history.append(order_record)
-        self.save_orders()
+        for order_id in self.order_children(order_record):
+            st.session_state.order_index[order_id] = order_record
+        self.save_orders([order_record])
     
-    def check_order_status(self, order_id):
-        try:
-            if not order_id:
-                return
+    def has_pending_entry(self, index_name=None):
+        order_index = st.session_state.order_index
+        for order_id in get_order_tracker().pending_ids():
+            order = order_index.get(order_id, {})
+            if order.get('signal') not in (None, 'EXIT') and index_name in (None, order.get('index')):
+                return True
+        return False
+    
+    def process_order_updates(self):
+        """Apply status changes seen by the order tracker; filled entries become active trades"""
+        order_index = st.session_state.order_index
+        # Updates for orders this session does not know stay queued for the session that does
+        updates = get_order_tracker().drain(lambda kite_order: str(kite_order.get('order_id')) in order_index)
+        if not updates:
+            return False
+        
+        changed_orders = []
+        changed_trades = []
+        for kite_order in updates:
+            order = order_index[str(kite_order.get('order_id'))]
+            changed_orders.append(order)
+            trade = self.on_exit_update(kite_order)
+            if trade is not None:
+                changed_trades.append(trade)
+            if not self.apply_order_status(order, kite_order):
+                continue
             
-            orders = self.kite.orders()
-            for kite_order in orders:
-                if str(kite_order['order_id']) == str(order_id):
-                    for i, order in enumerate(st.session_state.order_history):
-                        if order.get('order_id') == order_id:
-                            st.session_state.order_history[i]['status'] = kite_order['status']
-                            st.session_state.order_history[i]['reason'] = kite_order.get('status_message', kite_order.get('rejection_reason', ''))
-                            
-                            if kite_order['status'] == 'REJECTED':
-                                st.session_state.order_history[i]['rejection_reason'] = kite_order.get('rejection_reason', '')
-                                st.session_state.order_history[i]['status_message'] = kite_order.get('status_message', '')
-                            
-                            self.save_orders()
-                            break
-                    break
-        except Exception as e:
-            print(f"Error checking order status: {e}")
+            if order['status'] == 'COMPLETE' and order.get('signal') != 'EXIT':
+                changed_trades.append(self.open_trade(order))
+            elif order.get('protects'):
+                trade = self.on_protective_update(order)
+                if trade is not None:
+                    changed_trades.append(trade)
+        
+        self.save_orders(changed_orders)
+        if changed_trades:
+            self.save_trades(changed_trades)
+        return True
     
-    def monitor_trades(self):
+    def apply_order_status(self, order, kite_order):
+        """Fold one child order's update into its logical order; True once every child is done"""
+        children = self.order_children(order)
+        status = kite_order['status']
+        child = children.setdefault(str(kite_order['order_id']), {'quantity': kite_order.get('quantity')})
+        child['status'] = status
+        child['filled_quantity'] = kite_order.get('filled_quantity') or (child['quantity'] if status == 'COMPLETE' else 0)
+        child['average_price'] = kite_order.get('average_price') or child.get('average_price')
+        
+        order['reason'] = kite_order.get('status_message') or kite_order.get('rejection_reason', '')
+        if status == 'REJECTED':
+            order['rejection_reason'] = kite_order.get('rejection_reason', '')
+            order['status_message'] = kite_order.get('status_message', '')
+        
+        if any(c.get('status') not in OrderTracker.TERMINAL_STATUSES for c in children.values()):
+            order['status'] = status if len(children) == 1 else 'OPEN'
+            return False
+        
+        was_done = order.get('status') in OrderTracker.TERMINAL_STATUSES
+        filled = [c for c in children.values() if c.get('filled_quantity')]
+        if filled:
+            filled_quantity = sum(c['filled_quantity'] for c in filled)
+            order['status'] = 'COMPLETE'
+            order['filled_quantity'] = filled_quantity
+            if all(c.get('average_price') for c in filled):
+                order['average_price'] = sum(c['filled_quantity'] * c['average_price'] for c in filled) / filled_quantity
+        else:
+            order['status'] = status
+        return not was_done
+    
+    def open_trade(self, order):
+        """Turn a filled entry into an active trade priced at its volume-weighted fill"""
+        trade = {key: value for key, value in order.items() if key != 'children'}
+        trade['status'] = 'ACTIVE'
+        trade['quantity'] = order.get('filled_quantity') or order['quantity']
+        
+        if order.get('average_price'):
+            entry_price = round_to_tick(order['average_price'], order['index'])
+            trade['entry_price'] = entry_price
+            trade['sl_price'] = round_to_tick(entry_price - Config.SL_POINTS, order['index'])
+            trade['tp_price'] = round_to_tick(entry_price + Config.TP_POINTS, order['index'])
+            trade['highest_price'] = entry_price
+            trade['tsl_triggered'] = False
+            trade['tsl_price'] = trade['sl_price']
+        
+        st.session_state.active_trades.append(trade)
+        st.session_state.trade_history.append(trade)
+        self.risk.record_open(trade['index'])
+        self.update_stats()
+        self.place_protective_order(trade)
+        return trade
+    
+    def monitor_trades(self, quotes=None):
         completed = []
+        if quotes is None:
+            with api_priority(PRIORITY_EXIT):
+                quotes = QuoteBatch(self.kite).add_trades(st.session_state.active_trades).fetch()
         
-        # First check if we need to square off before market close
-        if len(st.session_state.active_trades) > 0:
-            index_name = st.session_state.selected_index
-            if should_square_off_before_close(index_name) and not st.session_state.square_off_triggered:
-                st.warning(f"⚠️ Market closing soon! Squaring off all positions for {index_name}...")
-                self.square_off_all()
-                st.session_state.square_off_triggered = True
-                return completed
+        # First square off the legs of any instrument whose market is about to close
+        closing = {t['index'] for t in st.session_state.active_trades
+                   if should_square_off_before_close(t['index'])
+                   and not st.session_state.square_off_triggered.get(t['index'])}
+        for index_name in closing:
+            st.warning(f"⚠️ Market closing soon! Squaring off all positions for {index_name}...")
+            # Set first: a leg left partly unsold clears it so the next pass tries again
+            st.session_state.square_off_triggered[index_name] = True
+            self.square_off_all(quotes, index_name)
         
         # Monitor trades for SL/TP/TSL
+        moved = []
         for trade in st.session_state.active_trades[:]:
+            if trade.get('pending_exit'):
+                # Its exit orders are already working at the exchange
+                continue
             try:
-                exchange = trade.get('exchange', 'NFO')
-                ltp_data = self.kite.ltp(f"{exchange}:{trade['symbol']}")
-                current = ltp_data[f"{exchange}:{trade['symbol']}"]["last_price"]
+                current = quotes.ltp(*get_trade_instrument(self.kite, trade))
                 current = round_to_tick(current, trade['index'])
                 
                 # Update highest price if current is higher
                 if current > trade.get('highest_price', trade['entry_price']):
                     trade['highest_price'] = current
+                    moved.append(trade)
                     
                     # Check if TSL should be triggered (only if TSL is enabled)
                     if Config.TSL_ENABLED and not trade.get('tsl_triggered', False):
@@ -1025,10 +2797,7 @@ class TradeManager:
                             trade['tsl_price'] = round_to_tick(new_tsl_price, trade['index'])
                 
                 # Determine which SL to use (TSL if triggered and enabled, otherwise initial SL)
-                if Config.TSL_ENABLED and trade.get('tsl_triggered', False):
-                    effective_sl_price = trade.get('tsl_price', trade['sl_price'])
-                else:
-                    effective_sl_price = trade['sl_price']
+                effective_sl_price = self.effective_sl_price(trade)
                 
                 # Check exit conditions
                 exit_trade = False
@@ -1044,81 +2813,375 @@ class TradeManager:
                     exit_trade = True
                     exit_reason = "TP"
                 
+                if trade.get('protective_gtts'):
+                    # The exchange owns both legs; once the GTTs fire, their orders' fills close the trade
+                    if self.follow_protective_gtts(trade, current):
+                        moved.append(trade)
+                        continue
+                    if exit_trade:
+                        continue
+                
+                if exit_trade and exit_reason != "TP" and trade.get('protective_orders'):
+                    # The resting stop at the exchange takes this exit; its fill closes the trade
+                    continue
+                
                 if exit_trade:
                     self.exit_trade(trade, current, exit_reason)
-                    trade['exit_price'] = current
-                    trade['exit_time'] = datetime.now().isoformat()
-                    trade['exit_reason'] = exit_reason
-                    trade['status'] = 'CLOSED'
-                    trade['pnl'] = (current - trade['entry_price']) * trade['quantity']
-                    
-                    # Add TSL info to trade record
-                    if Config.TSL_ENABLED:
-                        trade['tsl_final_price'] = effective_sl_price
-                        trade['tsl_was_triggered'] = trade.get('tsl_triggered', False)
-                        trade['highest_reached'] = trade.get('highest_price', trade['entry_price'])
-                    
+                    self.close_trade(trade, current, exit_reason)
                     completed.append(trade)
-                    st.session_state.active_trades.remove(trade)
+                elif trade.get('protective_trigger') is not None:
+                    self.trail_protective_order(trade, effective_sl_price, current)
                     
             except Exception as e:
                 print(f"Error monitoring trade {trade.get('symbol', 'Unknown')}: {e}")
                 continue
         
-        if completed:
-            self.save_trades()
+        if completed or moved:
+            self.save_trades(moved + completed)
         return completed
     
-    def exit_trade(self, trade, price, reason):
+    def effective_sl_price(self, trade):
+        if Config.TSL_ENABLED and trade.get('tsl_triggered', False):
+            return trade.get('tsl_price', trade['sl_price'])
+        return trade['sl_price']
+    
+    def close_trade(self, trade, price, reason):
+        trade['exit_price'] = price
+        trade['exit_time'] = datetime.now().isoformat()
+        trade['exit_reason'] = reason
+        trade['status'] = 'CLOSED'
+        trade['pnl'] = (price - trade['entry_price']) * trade['quantity']
+        self.risk.record_close(trade['index'], trade['pnl'])
+        self.update_stats()
+        
+        # Add TSL info to trade record
+        if Config.TSL_ENABLED:
+            trade['tsl_final_price'] = self.effective_sl_price(trade)
+            trade['tsl_was_triggered'] = trade.get('tsl_triggered', False)
+            trade['highest_reached'] = trade.get('highest_price', trade['entry_price'])
+        
+        if trade in st.session_state.active_trades:
+            st.session_state.active_trades.remove(trade)
+    
+    def stop_order_params(self, trade, trigger):
+        if Config.PROTECTIVE_ORDER_MODE == "SL-M":
+            return {'order_type': self.kite.ORDER_TYPE_SLM, 'trigger_price': trigger}
+        
+        tick_size = Config.INDEX_MAP.get(trade['index'], {}).get('tick_size', 0.05)
+        limit_price = round_to_tick(max(trigger - Config.PROTECTIVE_LIMIT_BUFFER, tick_size), trade['index'])
+        return {'order_type': self.kite.ORDER_TYPE_SL, 'trigger_price': trigger, 'price': limit_price}
+    
+    def gtt_params(self, trade, trigger, last_price, quantity):
+        tick_size = Config.INDEX_MAP.get(trade['index'], {}).get('tick_size', 0.05)
+        leg = {
+            'transaction_type': self.kite.TRANSACTION_TYPE_SELL,
+            'quantity': quantity,
+            'order_type': self.kite.ORDER_TYPE_LIMIT,
+            'product': trade.get('product', self.kite.PRODUCT_NRML)
+        }
+        return {
+            'trigger_type': self.kite.GTT_TYPE_OCO,
+            'tradingsymbol': trade['symbol'],
+            'exchange': trade.get('exchange', 'NFO'),
+            'trigger_values': [trigger, trade['tp_price']],
+            'last_price': last_price,
+            'orders': [
+                dict(leg, price=round_to_tick(max(trigger - Config.PROTECTIVE_LIMIT_BUFFER, tick_size), trade['index'])),
+                dict(leg, price=trade['tp_price'])
+            ]
+        }
+    
+    def place_protective_order(self, trade):
+        """Rest a stop (or an OCO GTT for stop + target) at the exchange for a newly filled leg,
+        one per freeze-limit slice"""
+        mode = Config.PROTECTIVE_ORDER_MODE
+        if mode == "OFF":
+            return
+        
+        trigger = self.effective_sl_price(trade)
+        quantities = self.child_quantities(trade['index'], trade['quantity'])
         try:
-            exchange = trade.get('exchange', 'NFO')
-            order_type = self.kite.ORDER_TYPE_MARKET
-            exit_price = None
-            
-            if exchange == "MCX":
-                order_type = self.kite.ORDER_TYPE_LIMIT
-                exit_price = price
-                exit_price = round_to_tick(exit_price, trade['index'])
-            
-            exit_order_id = self.kite.place_order(
-                variety=self.kite.VARIETY_REGULAR,
-                exchange=exchange,
-                tradingsymbol=trade['symbol'],
-                transaction_type=self.kite.TRANSACTION_TYPE_SELL,
-                quantity=trade['quantity'],
-                order_type=order_type,
-                price=exit_price,
-                product=self.kite.PRODUCT_MIS,
-                validity=self.kite.VALIDITY_DAY
-            )
+            if mode == "GTT":
+                def submit(quantity):
+                    with api_priority(PRIORITY_EXIT):
+                        response = self.kite.place_gtt(**self.gtt_params(trade, trigger, trade['entry_price'], quantity))
+                    return response['trigger_id'], quantity
+                trade['protective_gtts'] = {str(gtt_id): quantity for gtt_id, quantity in self.run_children(submit, quantities)}
+            else:
+                children = self.place_children(
+                    quantities,
+                    PRIORITY_EXIT,
+                    variety=self.kite.VARIETY_REGULAR,
+                    exchange=trade.get('exchange', 'NFO'),
+                    tradingsymbol=trade['symbol'],
+                    transaction_type=self.kite.TRANSACTION_TYPE_SELL,
+                    product=trade.get('product', self.kite.PRODUCT_MIS),
+                    validity=self.kite.VALIDITY_DAY,
+                    **self.stop_order_params(trade, trigger)
+                )
+                placed = [c for c in children if c['order_id']]
+                if len(placed) < len(children):
+                    print(f"Error placing protective order for {trade['symbol']}: {children[0]['error']}")
+                if not placed:
+                    return
+                
+                trade['protective_orders'] = {str(c['order_id']): c['quantity'] for c in placed}
+                self.add_order_record({
+                    'order_id': placed[0]['order_id'],
+                    'symbol': trade['symbol'],
+                    'index': trade['index'],
+                    'exchange': trade.get('exchange', 'NFO'),
+                    'strike': trade.get('strike'),
+                    'option_type': trade['option_type'],
+                    'entry_price': trigger,
+                    'entry_time': datetime.now().isoformat(),
+                    'quantity': sum(c['quantity'] for c in placed),
+                    'status': 'PENDING',
+                    'signal': 'EXIT',
+                    'reason': f'Protective {mode} order',
+                    'protects': trade.get('order_id'),
+                    'children': self.child_records(placed)
+                })
+                self.track_children(placed)
             
-            exit_record = {
-                'order_id': exit_order_id,
-                'symbol': trade['symbol'],
-                'index': trade['index'],
-                'exchange': exchange,
-                'strike': trade.get('strike'),
-                'option_type': trade['option_type'],
-                'entry_price': price,
-                'entry_time': datetime.now().isoformat(),
-                'quantity': trade['quantity'],
-                'status': 'PENDING',
-                'signal': 'EXIT',
-                'reason': f'{reason} exit'
-            }
+            trade['protective_trigger'] = trigger
+            trade['protective_modified_at'] = time.time()
+        except Exception as e:
+            print(f"Error placing protective order for {trade['symbol']}: {e}")
+    
+    def trail_protective_order(self, trade, trigger, current):
+        """Move the exchange stop up to the trailing stop, at most once per step and interval"""
+        if trigger - trade['protective_trigger'] < Config.PROTECTIVE_MIN_STEP:
+            return
+        if time.time() - trade.get('protective_modified_at', 0) < Config.PROTECTIVE_MIN_INTERVAL:
+            return
+        
+        def modify(item):
+            child_id, quantity = item
+            with api_priority(PRIORITY_EXIT):
+                if trade.get('protective_gtts'):
+                    self.kite.modify_gtt(child_id, **self.gtt_params(trade, trigger, current, quantity))
+                else:
+                    self.kite.modify_order(
+                        variety=self.kite.VARIETY_REGULAR,
+                        order_id=child_id,
+                        **self.stop_order_params(trade, trigger)
+                    )
+        
+        try:
+            self.run_children(modify, list((trade.get('protective_gtts') or trade['protective_orders']).items()))
+            trade['protective_trigger'] = trigger
+            trade['protective_modified_at'] = time.time()
+        except Exception as e:
+            print(f"Error trailing protective order for {trade['symbol']}: {e}")
+    
+    def on_protective_update(self, order):
+        """Every stop of a trade reached a terminal status: close the trade, or fall back to local exits.
+        Returns the trade it changed, if any."""
+        child_ids = set(self.order_children(order))
+        for trade in st.session_state.active_trades:
+            if not child_ids & set(trade.get('protective_orders', {})):
+                continue
             
-            # Add TSL info to exit record if applicable
-            if Config.TSL_ENABLED and reason == 'TSL':
-                exit_record['tsl_info'] = {
-                    'triggered': trade.get('tsl_triggered', False),
-                    'final_tsl_price': trade.get('tsl_price'),
-                    'highest_price': trade.get('highest_price')
-                }
+            if order['status'] == 'COMPLETE':
+                price = order.get('average_price') or trade['protective_trigger']
+                reason = "TSL" if Config.TSL_ENABLED and trade.get('tsl_triggered', False) else "SL"
+                self.close_trade(trade, round_to_tick(price, trade['index']), reason)
+            else:
+                # Cancelled or rejected at the exchange; monitor_trades handles SL/TSL again
+                trade.pop('protective_orders', None)
+                trade.pop('protective_trigger', None)
+            return trade
+        return None
+    
+    def on_exit_update(self, kite_order):
+        """Settle a leg whose exit was still working when it was sent: close it once every
+        exit order is filled, or keep what was not sold. Returns the trade it changed, if any."""
+        if kite_order['status'] not in OrderTracker.TERMINAL_STATUSES:
+            return None
+        order_id = str(kite_order.get('order_id'))
+        for trade in st.session_state.active_trades:
+            pending = trade.get('pending_exit')
+            if not pending or order_id not in pending['orders']:
+                continue
             
-            self.add_order_record(exit_record)
+            quantity = pending['orders'].pop(order_id)
+            filled = kite_order.get('filled_quantity') or (quantity if kite_order['status'] == 'COMPLETE' else 0)
+            pending['filled_quantity'] += filled
+            pending['filled_value'] += filled * (kite_order.get('average_price') or pending['price'])
+            if pending['orders']:
+                return trade
             
+            trade.pop('pending_exit')
+            if pending['filled_quantity'] >= trade['quantity']:
+                price = pending['filled_value'] / pending['filled_quantity']
+                self.close_trade(trade, round_to_tick(price, trade['index']), pending['reason'])
+            else:
+                # Part of the leg was not sold; keep the rest open and let the next pass retry
+                trade['quantity'] -= pending['filled_quantity']
+                st.session_state.square_off_triggered[trade['index']] = False
+                print(f"Exit of {trade['symbol']} ended {kite_order['status']}; {trade['quantity']} still open")
+            return trade
+        return None
+    
+    def follow_protective_gtts(self, trade, current):
+        """Check the trade's GTTs at most every GTT_POLL_SECONDS, remembering the ones that fired.
+        Once all have, their orders become the trade's pending exit; returns True then."""
+        now = time.time()
+        if now - trade.get('gtt_checked_at', 0) < Config.GTT_POLL_SECONDS:
+            return False
+        trade['gtt_checked_at'] = now
+        
+        fired = trade.setdefault('gtt_orders', {})  # gtt_id -> (order_id, leg)
+        try:
+            for gtt_id in trade['protective_gtts']:
+                if gtt_id in fired:
+                    continue
+                with api_priority(PRIORITY_EXIT):
+                    gtt = self.kite.get_gtt(gtt_id)
+                if gtt['status'] != 'triggered':
+                    continue
+                leg = next((i for i, o in enumerate(gtt['orders']) if o.get('result')), None)
+                result = gtt['orders'][leg]['result'].get('order_result', {}) if leg is not None else {}
+                fired[gtt_id] = (result.get('order_id'), leg)
         except Exception as e:
-            print(f"Error exiting trade: {e}")
+            print(f"Error checking GTTs for {trade.get('symbol')}: {e}")
+            return False
+        if len(fired) < len(trade['protective_gtts']):
+            return False
+        
+        children = [{'quantity': trade['protective_gtts'][gtt_id], 'order_id': order_id, 'error': None}
+                    for gtt_id, (order_id, _) in fired.items() if order_id]
+        stop_hit = any(leg == 0 for _, leg in fired.values())
+        reason = ("TSL" if Config.TSL_ENABLED and trade.get('tsl_triggered', False) else "SL") if stop_hit else "TP"
+        self.release_protection(trade)
+        trade.pop('gtt_orders', None)
+        trade.pop('gtt_checked_at', None)
+        if not children:
+            # The GTTs fired but their orders failed; monitor_trades exits the leg itself
+            print(f"GTT orders for {trade['symbol']} were not placed; exiting locally")
+            return False
+        
+        trade['pending_exit'] = {
+            'orders': {str(c['order_id']): c['quantity'] for c in children},
+            'reason': reason,
+            'price': current,
+            'filled_quantity': 0,
+            'filled_value': 0.0
+        }
+        self.record_exit(trade, current, reason, children)
+        # The orders may have filled before they were tracked
+        get_order_tracker().request_reconcile()
+        return True
+    
+    def cancel_protective_gtts(self, trade):
+        """Delete still-active GTTs before a manual exit; refuse if any has already fired"""
+        for gtt_id in trade['protective_gtts']:
+            if self.kite.get_gtt(gtt_id)['status'] == 'triggered':
+                raise Exception(f"GTT {gtt_id} already triggered")
+        for gtt_id in list(trade['protective_gtts']):
+            self.kite.delete_gtt(gtt_id)
+    
+    def release_protection(self, trade):
+        """Forget the stops or GTTs of a leg once an exit has consumed them"""
+        trade.pop('protective_orders', None)
+        trade.pop('protective_gtts', None)
+        trade.pop('protective_trigger', None)
+    
+    def submit_exit(self, trade, price, quantity=None, fresh=False):
+        """Send the exit orders for up to quantity of one leg, sliced to the freeze limit;
+        fresh ignores stops or GTTs already released by an earlier attempt. Stops still
+        resting are converted, those already filled or converted count towards quantity,
+        and new orders cover whatever they do not.
+        
+        Returns [{'quantity', 'order_id', 'error'}] per child. Touches no session
+        state or trade, so the square-off engine can call it from worker threads.
+        """
+        exchange = trade.get('exchange', 'NFO')
+        order_type = self.kite.ORDER_TYPE_MARKET
+        exit_price = None
+        
+        if exchange == "MCX":
+            order_type = self.kite.ORDER_TYPE_LIMIT
+            exit_price = price
+            exit_price = round_to_tick(exit_price, trade['index'])
+        
+        quantity = quantity or trade['quantity']
+        children = []
+        if trade.get('protective_orders') and not fresh:
+            # Turn the resting stops into the exit itself so the leg can never be sold twice
+            tracker = get_order_tracker()
+            stops = []
+            for order_id, child_quantity in trade['protective_orders'].items():
+                status = tracker.status(order_id)
+                if status in OrderTracker.TERMINAL_STATUSES:
+                    # A stop that filled already sold its share; a cancelled one sold nothing
+                    update = tracker.wait_for(order_id, 0) or {}
+                    if status == 'COMPLETE':
+                        sold = min(update.get('filled_quantity') or child_quantity, quantity)
+                        children.append({'quantity': sold, 'order_id': order_id, 'error': None})
+                        quantity -= sold
+                elif status in (None, 'PENDING', 'TRIGGER PENDING'):
+                    stops.append((order_id, child_quantity))
+                else:
+                    # Converted by an earlier attempt and still working as the exit
+                    sold = min(child_quantity, quantity)
+                    children.append({'quantity': sold, 'order_id': order_id, 'error': None})
+                    quantity -= sold
+            
+            def convert(item):
+                order_id, child_quantity, exit_quantity = item
+                child = {'quantity': exit_quantity, 'order_id': order_id, 'error': None}
+                try:
+                    with api_priority(PRIORITY_EXIT):
+                        if not exit_quantity:
+                            # Nothing left for this stop to sell; leaving it would sell the leg twice
+                            self.kite.cancel_order(variety=self.kite.VARIETY_REGULAR, order_id=order_id)
+                            return None
+                        self.kite.modify_order(
+                            variety=self.kite.VARIETY_REGULAR,
+                            order_id=order_id,
+                            order_type=order_type,
+                            price=exit_price,
+                            quantity=exit_quantity if exit_quantity < child_quantity else None
+                        )
+                except Exception as e:
+                    child['order_id'] = None
+                    child['error'] = e
+                return child
+            items = []
+            for order_id, child_quantity in stops:
+                items.append((order_id, child_quantity, min(child_quantity, quantity)))
+                quantity -= items[-1][2]
+            if items:
+                children.extend(c for c in self.run_children(convert, items) if c is not None)
+            if quantity <= 0:
+                return children
+        
+        if trade.get('protective_gtts') and not fresh:
+            with api_priority(PRIORITY_EXIT):
+                self.cancel_protective_gtts(trade)
+        
+        return children + self.place_children(
+            self.child_quantities(trade['index'], quantity),
+            PRIORITY_EXIT,
+            variety=self.kite.VARIETY_REGULAR,
+            exchange=exchange,
+            tradingsymbol=trade['symbol'],
+            transaction_type=self.kite.TRANSACTION_TYPE_SELL,
+            order_type=order_type,
+            price=exit_price,
+            product=trade.get('product', self.kite.PRODUCT_MIS),
+            validity=self.kite.VALIDITY_DAY
+        )
+    
+    def record_exit(self, trade, price, reason, children=None, error=None):
+        exchange = trade.get('exchange', 'NFO')
+        placed = [c for c in children or [] if c['order_id']]
+        
+        if not placed:
+            if error is None and children:
+                error = children[0]['error']
             self.add_order_record({
                 'order_id': None,
                 'symbol': trade['symbol'],
@@ -1131,56 +3194,215 @@ class TradeManager:
                 'quantity': trade['quantity'],
                 'status': 'REJECTED',
                 'signal': 'EXIT',
-                'reason': f'Exit failed: {str(e)}'
+                'reason': f'Exit failed: {str(error)}'
             })
+            return
+        
+        # Converted protective stops already have a record; only new children need one
+        new_children = []
+        updated = []
+        for child in placed:
+            record = st.session_state.order_index.get(str(child['order_id']))
+            if record is None:
+                new_children.append(child)
+            else:
+                record['reason'] = f'{reason} exit'
+                record['entry_price'] = price
+                updated.append(record)
+        
+        if updated:
+            self.save_orders(updated)
+        if not new_children:
+            return
+        
+        exit_record = {
+            'order_id': new_children[0]['order_id'],
+            'symbol': trade['symbol'],
+            'index': trade['index'],
+            'exchange': exchange,
+            'strike': trade.get('strike'),
+            'option_type': trade['option_type'],
+            'entry_price': price,
+            'entry_time': datetime.now().isoformat(),
+            'quantity': sum(c['quantity'] for c in new_children),
+            'status': 'PENDING',
+            'signal': 'EXIT',
+            'reason': f'{reason} exit',
+            'children': self.child_records(new_children)
+        }
+        
+        # Add TSL info to exit record if applicable
+        if Config.TSL_ENABLED and reason == 'TSL':
+            exit_record['tsl_info'] = {
+                'triggered': trade.get('tsl_triggered', False),
+                'final_tsl_price': trade.get('tsl_price'),
+                'highest_price': trade.get('highest_price')
+            }
+        
+        self.add_order_record(exit_record)
+        self.track_children(new_children)
     
-    def square_off_all(self):
-        for trade in st.session_state.active_trades:
+    def exit_trade(self, trade, price, reason):
+        try:
+            children = self.submit_exit(trade, price)
+        except Exception as e:
+            print(f"Error exiting trade: {e}")
+            self.record_exit(trade, price, reason, error=e)
+            return
+        if trade.get('protective_gtts'):
+            self.release_protection(trade)
+        self.record_exit(trade, price, reason, children)
+    
+    def square_off_all(self, quotes=None, index_name=None):
+        """Exit every active leg (or every leg of one instrument) concurrently and return the per-leg report"""
+        trades = [t for t in st.session_state.active_trades
+                  if index_name in (None, t['index']) and not t.get('pending_exit')]
+        if quotes is None:
+            with api_priority(PRIORITY_EXIT):
+                quotes = QuoteBatch(self.kite).add_trades(trades).fetch()
+        
+        legs = []
+        for trade in trades:
             try:
-                exchange = trade.get('exchange', 'NFO')
-                ltp_data = self.kite.ltp(f"{exchange}:{trade['symbol']}")
-                current = ltp_data[f"{exchange}:{trade['symbol']}"]["last_price"]
-                current = round_to_tick(current, trade['index'])
-                self.exit_trade(trade, current, "Square Off")
-                trade['exit_price'] = current
-                trade['exit_time'] = datetime.now().isoformat()
-                trade['exit_reason'] = "Square Off"
-                trade['status'] = 'CLOSED'
-                trade['pnl'] = (current - trade['entry_price']) * trade['quantity']
+                current = quotes.ltp(*get_trade_instrument(self.kite, trade))
+                legs.append((trade, round_to_tick(current, trade['index'])))
             except Exception as e:
                 print(f"Error squaring off {trade.get('symbol')}: {e}")
+        
+        started = time.perf_counter()
+        reports = SquareOffEngine(self).run(legs)
+        
+        for (trade, current), report in zip(legs, reports):
+            if report['protection_released'] or report['status'] == 'OPEN':
+                self.release_protection(trade)
+            self.record_exit(trade, current, "Square Off", report['children'], report['error'])
+            if report['status'] == 'OPEN':
+                # The exit is still working; the tracker closes the leg once it fills
+                trade['pending_exit'] = {
+                    'orders': report['open_orders'],
+                    'reason': "Square Off",
+                    'price': current,
+                    'filled_quantity': report['filled_quantity'],
+                    'filled_value': report['filled_quantity'] * (report['fill_price'] or 0)
+                }
                 continue
+            if report['status'] != 'COMPLETE':
+                # Part of the leg was not sold; keep the rest open and let the next pass retry
+                trade['quantity'] -= report['filled_quantity']
+                report['unsold_quantity'] = trade['quantity']
+                st.session_state.square_off_triggered[trade['index']] = False
+                continue
+            exit_price = round_to_tick(report['fill_price'], trade['index']) if report['fill_price'] else current
+            self.close_trade(trade, exit_price, "Square Off")
         
-        st.session_state.active_trades.clear()
-        self.save_trades()
+        self.save_trades([trade for trade, _ in legs])
+        st.session_state.last_square_off = {
+            'time': datetime.now().isoformat(),
+            'total_ms': round((time.perf_counter() - started) * 1000, 1),
+            'legs': reports
+        }
+        print(f"Square off: {len(reports)} legs in {st.session_state.last_square_off['total_ms']} ms")
+        return reports
+
+def get_trade_manager(kite):
+    """This session's TradeManager, built again only for a new client, a new day or logs
+    changed by another process, so a rerun does not reload the working set"""
+    trade_manager = st.session_state.trade_manager
+    if trade_manager is None or trade_manager.kite is not kite or trade_manager.is_stale():
+        trade_manager = st.session_state.trade_manager = TradeManager(kite)
+    return trade_manager
+
+# --- SQUARE OFF ENGINE ---
+class SquareOffEngine:
+    """Flattens every leg at once from a bounded thread pool.
     
-    def refresh_order_statuses(self):
-        try:
-            kite_orders = self.kite.orders()
-            kite_orders_dict = {str(o['order_id']): o for o in kite_orders}
+    Each leg is submitted, retried and confirmed independently. Workers only
+    talk to Kite; all session-state bookkeeping stays with the caller.
+    """
+    MAX_WORKERS = 8
+    MAX_ATTEMPTS = 3
+    RETRY_SECONDS = 0.5
+    FILL_TIMEOUT = 10
+    
+    def __init__(self, trade_manager):
+        self.trade_manager = trade_manager
+    
+    def run(self, legs):
+        """legs is a list of (trade, price); returns one report per leg, in order"""
+        if not legs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(legs)),
+                                thread_name_prefix="square-off") as pool:
+            return list(pool.map(lambda leg: self._exit_leg(*leg), legs))
+    
+    def _exit_leg(self, trade, price):
+        report = {'symbol': trade['symbol'], 'order_id': None, 'children': [], 'open_orders': {}, 'status': None,
+                  'attempts': 0, 'filled_quantity': 0, 'fill_price': None, 'submit_ms': None, 'fill_ms': None,
+                  'error': None, 'protection_released': False, 'unsold_quantity': 0}
+        started = time.perf_counter()
+        tracker = get_order_tracker()
+        filled_value = 0.0
+        had_gtts = bool(trade.get('protective_gtts'))
+        
+        while report['attempts'] < self.MAX_ATTEMPTS and report['filled_quantity'] < trade['quantity']:
+            report['attempts'] += 1
+            try:
+                children = self.trade_manager.submit_exit(trade, price, trade['quantity'] - report['filled_quantity'],
+                                                          fresh=report['protection_released'])
+            except Exception as e:
+                report['error'] = str(e)
+                time.sleep(self.RETRY_SECONDS)
+                continue
             
-            updated = False
-            for i, order in enumerate(st.session_state.order_history):
-                order_id = order.get('order_id')
-                if order_id and order_id in kite_orders_dict:
-                    kite_order = kite_orders_dict[order_id]
-                    if order.get('status') != kite_order['status']:
-                        st.session_state.order_history[i]['status'] = kite_order['status']
-                        st.session_state.order_history[i]['reason'] = kite_order.get('status_message', kite_order.get('rejection_reason', ''))
-                        
-                        if kite_order['status'] == 'REJECTED':
-                            st.session_state.order_history[i]['rejection_reason'] = kite_order.get('rejection_reason', '')
-                            st.session_state.order_history[i]['status_message'] = kite_order.get('status_message', '')
-                        
-                        updated = True
+            if had_gtts:
+                # The GTTs were deleted; a retry places fresh orders
+                report['protection_released'] = True
+            placed = [c for c in children if c['order_id']]
+            report['children'].extend(placed)
+            report['error'] = None if len(placed) == len(children) else str(children[0]['error'])
+            if not placed:
+                time.sleep(self.RETRY_SECONDS)
+                continue
+            
+            report['order_id'] = report['order_id'] or placed[0]['order_id']
+            report['submit_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            
+            for child in placed:
+                tracker.track(self.trade_manager.kite, child['order_id'], 'PENDING')
+            
+            deadline = time.monotonic() + self.FILL_TIMEOUT
+            for child in placed:
+                update = tracker.wait_for(child['order_id'], max(0.0, deadline - time.monotonic()))
+                if update is None:
+                    report['open_orders'][str(child['order_id'])] = child['quantity']
+                    continue
+                report['status'] = update['status']
+                quantity = update.get('filled_quantity') or (child['quantity'] if update['status'] == 'COMPLETE' else 0)
+                if quantity:
+                    report['filled_quantity'] += quantity
+                    filled_value += quantity * (update.get('average_price') or price)
+                elif update['status'] != 'COMPLETE':
+                    report['error'] = update.get('status_message') or update.get('rejection_reason') or update['status']
+            
+            if report['filled_quantity']:
+                report['fill_price'] = filled_value / report['filled_quantity']
             
-            if updated:
-                self.save_orders()
-                return True
-        except Exception as e:
-            print(f"Error refreshing order statuses: {e}")
+            if report['open_orders']:
+                # Still working at the exchange: resending could sell the leg twice
+                report['status'] = 'OPEN'
+                return report
+            
+            # Whatever is unfilled was rejected or cancelled, stops included; retry it with fresh orders
+            report['protection_released'] = True
+            if report['filled_quantity'] < trade['quantity']:
+                time.sleep(self.RETRY_SECONDS)
         
-        return False
+        if report['filled_quantity'] >= trade['quantity']:
+            report['status'] = 'COMPLETE'
+            report['fill_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        elif report['status'] in (None, 'COMPLETE'):
+            report['status'] = 'REJECTED'
+        return report
 
 # --- AUTHENTICATION ---
 def render_login_screen():
@@ -1213,13 +3435,7 @@ def render_login_screen():
         # Auto-login button
         if st.button("🔓 AUTO LOGIN", type="primary", use_container_width=True):
             try:
-                kite = KiteConnect(api_key=saved_api_key)
-                
-                with open(Config.TOKEN_FILE, "r") as f:
-                    saved_token = f.read().strip()
-                
-                kite.set_access_token(saved_token)
-                profile = kite.profile()
+                kite, profile = restore_session(saved_api_key)
                 
                 st.session_state.auth_status = True
                 st.session_state.kite = kite
@@ -1275,7 +3491,7 @@ def render_login_screen():
             st.info("Step 2: Get Request Token from Zerodha")
             
             try:
-                kite = KiteConnect(api_key=st.session_state.api_key)
+                kite = KiteGateway(KiteConnect(api_key=st.session_state.api_key))
                 login_url = kite.login_url()
                 
                 st.markdown(f'''
@@ -1301,7 +3517,7 @@ def render_login_screen():
                                 with open(Config.TOKEN_FILE, "w") as f:
                                     f.write(data["access_token"])
                                 
-                                kite.set_access_token(data["access_token"])
+                                kite = get_kite_client(st.session_state.api_key, data["access_token"])
                                 profile = kite.profile()
                                 
                                 st.session_state.auth_status = True
@@ -1330,6 +3546,21 @@ def render_login_screen():
                     st.session_state.login_step = 'initial'
                     st.rerun()
     
+    # Paper trading needs no Zerodha account: orders and prices come from the local simulator
+    if not st.session_state.auth_status:
+        if st.button("📝 PAPER TRADING", use_container_width=True):
+            try:
+                kite = start_paper_trading()
+                profile = kite.profile()
+                
+                st.session_state.auth_status = True
+                st.session_state.kite = kite
+                st.session_state.user_name = profile['user_name']
+                st.rerun()
+            
+            except Exception as e:
+                st.error(f"Paper trading failed to start: {str(e)}")
+    
     st.markdown("""
         <div style="margin-top: 2rem; padding-top: 1rem; border-top: 1px solid #E5E7EB; text-align: center;">
             <p style="color: #6B7280; font-size: 0.8rem;">
@@ -1338,98 +3569,347 @@ def render_login_screen():
         </div>
     """, unsafe_allow_html=True)
 
+# --- INDICATORS ---
+def fused_multiply_add(a, b, c):
+    """a * b + c with a single rounding, computed exactly on the floats' integer ratios"""
+    an, ad = float(a).as_integer_ratio()
+    bn, bd = float(b).as_integer_ratio()
+    cn, cd = float(c).as_integer_ratio()
+    return (an * bn * cd + cn * ad * bd) / (ad * bd * cd)
+
+@st.cache_resource
+def talib_ema_is_fused():
+    """Whether the installed TA-Lib build contracts its EMA step into a fused multiply-add.
+    
+    Decided once, when the first EMA is built, by replaying each step of a TA-Lib EMA
+    over large random moves both ways and keeping the steps where the two disagree;
+    a build matching neither gets the plain step.
+    """
+    rng = np.random.default_rng(0)
+    probe = 1000.0 * np.exp(np.cumsum(rng.normal(0.0, 0.5, 500)))
+    period = 8
+    expected = talib.EMA(probe, period)[period - 1:].tolist()
+    
+    k = 2.0 / (period + 1)
+    votes = {'plain': 0, 'fused': 0, 'neither': 0}
+    for prev, x, want in zip(expected, probe[period:].tolist(), expected[1:]):
+        plain = ((x - prev) * k) + prev
+        fused = fused_multiply_add(x - prev, k, prev)
+        if plain != fused:
+            votes['plain' if plain == want else 'fused' if fused == want else 'neither'] += 1
+    if votes['neither'] or (votes['plain'] and votes['fused']):
+        print(f"Warning: TA-Lib EMA arithmetic not recognised ({votes}); using the plain step")
+        return False
+    return votes['fused'] > 0
+
+class StreamingEMA:
+    """EMA updated one value at a time with TA-Lib's seeding and arithmetic.
+    
+    Like TA-Lib, the first value is the simple average of the first `period`
+    inputs and every later value is ((x - prev) * k) + prev with k = 2 / (period + 1),
+    fused into one rounding when the TA-Lib build does the same.
+    """
+    def __init__(self, period):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.fused = talib_ema_is_fused()
+        self.count = 0
+        self.seed_total = 0.0
+        self.value = None
+    
+    def peek(self, x):
+        """Value the EMA would take if x were appended, without committing it"""
+        if self.value is not None:
+            if self.fused:
+                return fused_multiply_add(x - self.value, self.k, self.value)
+            return ((x - self.value) * self.k) + self.value
+        if self.count + 1 == self.period:
+            return (self.seed_total + x) / self.period
+        return None
+    
+    def update(self, x):
+        value = self.peek(x)
+        if self.value is None:
+            self.seed_total += x
+        self.count += 1
+        self.value = value
+        return value
+
+class StreamingSMA:
+    """SMA keeping TA-Lib's running total, so rounding matches TA-Lib bit for bit"""
+    def __init__(self, period):
+        self.period = period
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+        self.value = None
+    
+    def peek(self, x):
+        if len(self.window) + 1 < self.period:
+            return None
+        return (self.total + x) / self.period
+    
+    def update(self, x):
+        self.total += x
+        self.window.append(x)
+        if len(self.window) < self.period:
+            return None
+        
+        self.value = self.total / self.period
+        self.total -= self.window[0]
+        return self.value
+
+class StreamingStochastic:
+    """Slow Stochastic (TA-Lib STOCH with SMA smoothing) updated one bar at a time"""
+    def __init__(self, fastk_period=14, slowk_period=3, slowd_period=3):
+        self.highs = deque(maxlen=fastk_period)
+        self.lows = deque(maxlen=fastk_period)
+        self.slowk = StreamingSMA(slowk_period)
+        self.slowd = StreamingSMA(slowd_period)
+    
+    @staticmethod
+    def _fastk(highest, lowest, close):
+        diff = highest - lowest
+        if diff != 0.0:
+            return (close - lowest) / diff * 100.0
+        return 0.0
+    
+    def peek(self, high, low, close):
+        """(slowk, slowd) if this bar were appended, without committing it"""
+        if len(self.highs) + 1 < self.highs.maxlen:
+            return None, None
+        
+        # The oldest bar drops out of a full window once the new one is added
+        skip = 1 if len(self.highs) == self.highs.maxlen else 0
+        highest = max(high, max(islice(self.highs, skip, None)))
+        lowest = min(low, min(islice(self.lows, skip, None)))
+        
+        slowk = self.slowk.peek(self._fastk(highest, lowest, close))
+        slowd = self.slowd.peek(slowk) if slowk is not None else None
+        return slowk, slowd
+    
+    def update(self, high, low, close):
+        self.highs.append(high)
+        self.lows.append(low)
+        if len(self.highs) < self.highs.maxlen:
+            return None, None
+        
+        slowk = self.slowk.update(self._fastk(max(self.highs), min(self.lows), close))
+        slowd = self.slowd.update(slowk) if slowk is not None else None
+        return slowk, slowd
+
+class IndicatorEngine:
+    """EMA 5/8/13 and Stochastic 14-3-3 for one instrument, updated per bar in constant time.
+    
+    Closed bars are committed with update(); the forming bar is evaluated with
+    peek() on every tick without changing state. Fed the same bars from the same
+    first bar, the outputs equal talib.EMA / talib.STOCH exactly.
+    
+    Unlike the TA-Lib call it replaces, which ran over a fresh 5-day window on
+    every rerun, sync() does not re-seed as the window slides: the values are
+    those of TA-Lib over the whole history since the first bar synced. Against
+    a windowed run the Stochastic, which only looks back 18 bars, differs by
+    rounding alone, and the EMAs only by what is left of the window's SMA seed,
+    which has decayed below float rounding over a 5-day window.
+    """
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.ema5 = StreamingEMA(5)
+        self.ema8 = StreamingEMA(8)
+        self.ema13 = StreamingEMA(13)
+        self.stoch = StreamingStochastic(14, 3, 3)
+        self.last_bar_time = None
+        self.values = None
+    
+    def _values(self, close, ema5, ema8, ema13, slowk, slowd):
+        if None in (ema5, ema8, ema13, slowk, slowd):
+            return None
+        return {
+            'close': close,
+            'ema5': ema5,
+            'ema8': ema8,
+            'ema13': ema13,
+            'slowk': slowk,
+            'slowd': slowd
+        }
+    
+    def update(self, bar):
+        """Commit a closed bar and return the indicator values at its close"""
+        close = bar['close']
+        slowk, slowd = self.stoch.update(bar['high'], bar['low'], close)
+        self.values = self._values(close, self.ema5.update(close), self.ema8.update(close),
+                                   self.ema13.update(close), slowk, slowd)
+        self.last_bar_time = bar['date']
+        return self.values
+    
+    def peek(self, bar):
+        """Indicator values for a still-forming bar, leaving the engine untouched"""
+        close = bar['close']
+        slowk, slowd = self.stoch.peek(bar['high'], bar['low'], close)
+        return self._values(close, self.ema5.peek(close), self.ema8.peek(close),
+                            self.ema13.peek(close), slowk, slowd)
+    
+    def sync(self, candles, bar_close=None):
+        """Commit every closed bar not seen yet and return values for the last (forming) candle.
+        
+        With bar_close (the exchange time of a bar close) the bars starting before it are the
+        closed ones, whether or not a tick has opened the next bar yet, and the values returned
+        are those committed for the bar that just closed.
+        """
+        if not candles:
+            return None
+        
+        closed = candles[:-1] if bar_close is None else [c for c in candles if c['date'] < bar_close]
+        if self.last_bar_time is not None and (not closed or closed[0]['date'] > self.last_bar_time):
+            # History no longer overlaps what was committed; start over from this series
+            self.reset()
+        
+        start = len(closed)
+        while start > 0 and (self.last_bar_time is None or closed[start - 1]['date'] > self.last_bar_time):
+            start -= 1
+        for bar in closed[start:]:
+            self.update(bar)
+        
+        if bar_close is not None:
+            return self.values
+        return self.peek(candles[-1])
+
+@st.cache_resource
+def get_indicator_engines():
+    return {}
+
+def get_indicator_engine(token):
+    engines = get_indicator_engines()
+    engine = engines.get(token)
+    if engine is None:
+        engine = engines.setdefault(token, IndicatorEngine())
+    return engine
+
 # --- MARKET DATA ---
-def fetch_market_data(kite, index_name):
-    """Fetch historical data and calculate indicators using Stochastic instead of ADX"""
+def fetch_historical_candles(kite, token, from_date, to_date, interval="5minute"):
+    """Fetch historical candles, retrying once with continuous/oi disabled.
+    
+    Candle dates are returned as naive local (exchange) datetimes, like datetime.now().
+    """
     try:
-        index_info = Config.INDEX_MAP.get(index_name, {})
-        
-        if index_name == "CRUDEOIL":
-            exchange = "MCX"
-            df = load_instruments(kite, exchange)
-            
-            if df is None:
-                return False
+        hist = kite.historical_data(instrument_token=token, 
+                                    from_date=from_date, 
+                                    to_date=to_date, 
+                                    interval=interval)
+    except Exception as e:
+        print(f"Error fetching historical data: {e}")
+        try:
+            hist = kite.historical_data(instrument_token=token, 
+                                        from_date=from_date, 
+                                        to_date=to_date, 
+                                        interval=interval,
+                                        continuous=False,
+                                        oi=False)
+        except Exception as e2:
+            print(f"Error fetching historical data (2nd attempt): {e2}")
+            return None
+    
+    for candle in hist:
+        candle['date'] = candle['date'].replace(tzinfo=None)
+    return hist
+
+class CandleStore:
+    """Per-instrument candle history kept across reruns.
+    
+    The first call for a token loads the full lookback window. Later calls only
+    request bars from the last stored timestamp onwards, which replaces the
+    still-forming last bar and appends anything newer.
+    """
+    def __init__(self, interval="5minute", lookback_days=5):
+        self.interval = interval
+        self.lookback_days = lookback_days
+        self._lock = threading.Lock()
+        self._token_locks = {}
+        self._candles = {}
+    
+    def _token_lock(self, token):
+        with self._lock:
+            return self._token_locks.setdefault(token, threading.Lock())
+    
+    def get_candles(self, kite, token):
+        with self._token_lock(token):
+            candles = self._candles.get(token)
+            now = datetime.now()
+            window_start = now - timedelta(days=self.lookback_days)
             
-            if 'instrument_type' in df.columns:
-                futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df['instrument_type'] == 'FUT')].copy()
+            if candles:
+                from_date = max(candles[-1]['date'], window_start)
             else:
-                futures = df[(df['name'].str.contains('CRUDEOIL', case=False, na=False)) & 
-                            (df.iloc[:, 9] == 'FUT')].copy()
+                from_date = window_start
             
-            if len(futures) == 0:
-                return False
+            hist = fetch_historical_candles(kite, token, from_date, now, self.interval)
+            if hist is None:
+                return list(candles) if candles else None
             
-            if 'expiry' in futures.columns:
-                futures['expiry_dt'] = pd.to_datetime(futures['expiry'])
-            else:
-                futures['expiry_dt'] = pd.to_datetime(futures.iloc[:, 5])
+            if not candles:
+                candles = list(hist)
+            elif hist:
+                # Drop the stored bars the new response covers, including the forming one
+                first_new = hist[0]['date']
+                while candles and candles[-1]['date'] >= first_new:
+                    candles.pop()
+                candles.extend(hist)
             
-            nearest_fut = futures.loc[futures['expiry_dt'].idxmin()]
+            if candles:
+                cutoff = candles[-1]['date'] - timedelta(days=self.lookback_days)
+                if candles[0]['date'] < cutoff:
+                    candles = [c for c in candles if c['date'] >= cutoff]
             
-            if 'instrument_token' in nearest_fut:
-                token = nearest_fut['instrument_token']
+            self._candles[token] = candles
+            return list(candles)
+    
+    def clear(self, token=None):
+        with self._lock:
+            if token is None:
+                self._candles.clear()
             else:
-                token = nearest_fut.iloc[0]
-                
-        else:
-            token = index_info.get("spot_token")
+                self._candles.pop(token, None)
+
+@st.cache_resource
+def get_candle_store():
+    return CandleStore()
+
+def compute_market_data(kite, index_name, quotes=None, bar_close=None):
+    """Fetch historical data and calculate indicators using Stochastic instead of ADX.
+    
+    Returns the instrument's market data, or None. Touches no session state, so the
+    engine can run it for several instruments at once. With bar_close the signal is
+    that of the bar closed at that time; without it, of the bar still forming.
+    """
+    try:
+        _, token = get_reference_instrument(kite, index_name)
         
         if not token:
-            return False
+            return None
         
-        now = datetime.now()
-        from_date = now - timedelta(days=5)
+        engine = get_indicator_engine(token)
         
-        try:
-            hist = kite.historical_data(instrument_token=token, 
-                                       from_date=from_date, 
-                                       to_date=now, 
-                                       interval="5minute")
-        except Exception as e:
-            print(f"Error fetching historical data: {e}")
-            try:
-                hist = kite.historical_data(instrument_token=token, 
-                                           from_date=from_date, 
-                                           to_date=now, 
-                                           interval="5minute",
-                                           continuous=False,
-                                           oi=False)
-            except Exception as e2:
-                print(f"Error fetching historical data (2nd attempt): {e2}")
-                return False
+        # Bars come from the tick-built ring; REST candles are only the fallback without a live feed
+        hist = get_bar_builder().get_candles(kite, token, "5minute", since=engine.last_bar_time)
+        if hist is None:
+            hist = get_candle_store().get_candles(kite, token)
+        if hist is None:
+            return None
         
-        if len(hist) < 50:
+        if engine.last_bar_time is None and len(hist) < 50:
             print(f"Insufficient historical data: {len(hist)} records")
-            return False
-        
-        df = pd.DataFrame(hist)
-        
-        # Calculate EMAs
-        df['ema5'] = talib.EMA(df['close'], 5)
-        df['ema8'] = talib.EMA(df['close'], 8)
-        df['ema13'] = talib.EMA(df['close'], 13)
-        
-        # Calculate Stochastic indicator (14,3,3 is standard)
-        df['slowk'], df['slowd'] = talib.STOCH(df['high'], df['low'], df['close'],
-                                               fastk_period=14,
-                                               slowk_period=3,
-                                               slowk_matype=0,
-                                               slowd_period=3,
-                                               slowd_matype=0)
-        
-        # Remove NaN values
-        df = df.dropna()
+            return None
         
-        if len(df) == 0:
-            print("No valid data after removing NaN")
-            return False
+        # Indicators are updated incrementally; only new closed bars are fed in
+        last = engine.sync(hist, bar_close)
         
-        last = df.iloc[-1]
+        if last is None:
+            print("Not enough bars to seed indicators")
+            return None
         
         # Get current price
-        current_price = get_reference_price(kite, index_name)
+        current_price = get_reference_price(kite, index_name, quotes)
         
         # Generate signal based on EMA alignment and Stochastic position
         bullish_ema = (last['close'] > last['ema5'] > last['ema8'] > last['ema13'])
@@ -1476,8 +3956,7 @@ def fetch_market_data(kite, index_name):
             signal = "No Trade"
             signal_reason = "No clear signal"
         
-        # Store in session state
-        st.session_state.market_data = {
+        return {
             'current_price': current_price,
             'stoch_k': stoch_k,
             'stoch_d': stoch_d,
@@ -1491,17 +3970,48 @@ def fetch_market_data(kite, index_name):
             'stoch_bearish_cross': stoch_bearish_cross
         }
         
-        # Set last signal time for cooldown
-        if signal != "No Trade":
-            st.session_state.last_signal_time = datetime.now()
-        
-        return True
-        
     except Exception as e:
-        print(f"Error in fetch_market_data: {e}")
+        print(f"Error in compute_market_data for {index_name}: {e}")
         import traceback
         traceback.print_exc()
+        return None
+
+def store_market_data(index_name, data):
+    """Keep an instrument's market data; the selected instrument's also drives the dashboard cards"""
+    st.session_state.market_data_by_index[index_name] = data
+    if index_name == st.session_state.selected_index:
+        st.session_state.market_data = data
+    
+    # Set last signal time for this instrument's cooldown
+    if data['signal'] != "No Trade":
+        st.session_state.last_signal_time[index_name] = datetime.now()
+
+def fetch_market_data(kite, index_name, quotes=None, bar_close=None):
+    data = compute_market_data(kite, index_name, quotes, bar_close)
+    if data is None:
         return False
+    store_market_data(index_name, data)
+    return True
+
+def scan_market_data(kite, index_names, pool, quotes=None, bar_close=None):
+    """Market data for several instruments, fetched and computed in parallel on the pool"""
+    if quotes is None:
+        # One batched request prices every reference instrument for all the workers
+        quotes = QuoteBatch(kite)
+        for index_name in index_names:
+            quotes.add(*get_reference_instrument(kite, index_name))
+        quotes.add_trades(st.session_state.active_trades).fetch()
+    
+    futures = {index_name: pool.submit(compute_market_data, kite, index_name, quotes, bar_close)
+               for index_name in index_names}
+    results = {}
+    for index_name, future in futures.items():
+        data = future.result()
+        if data is not None:
+            store_market_data(index_name, data)
+            results[index_name] = data
+    return results, quotes
+
 def reset_market_data():
     """Reset market data when instrument changes"""
     st.session_state.market_data = {
@@ -1519,13 +4029,663 @@ def reset_market_data():
         'ltp': 0
     }
     st.session_state.last_signal = None
+# --- ENGINE ---
+# Session state the engine publishes for dashboards to render
+ENGINE_STATE_KEYS = [
+    'bot_running', 'selected_index', 'user_name', 'market_data', 'market_data_by_index', 'last_signal',
+    'active_trades', 'today_trades_count', 'today_loss', 'last_order_time', 'last_signal_time',
+    'last_square_off'
+]
+
+def engine_json_default(value):
+    """JSON for the numpy scalars and datetimes kept in session state"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+class EngineChannel:
+    """Command queue from the dashboards to a headless engine, in a shared SQLite file.
+    The engine runs queued commands at the start of every loop and records the result."""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS engine_commands (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "command TEXT NOT NULL, payload TEXT, created_at REAL NOT NULL, done_at REAL, result TEXT)")
+    
+    def send(self, command, payload=None):
+        """Queue a command for the engine and return its id"""
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT INTO engine_commands (command, payload, created_at) VALUES (?, ?, ?)",
+                                     (command, json.dumps(payload, default=engine_json_default), time.time()))
+        return cursor.lastrowid
+    
+    def wait_for(self, command_id, timeout=5.0):
+        """The result of a command once the engine has run it, or None on timeout"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                row = self.db.execute("SELECT done_at, result FROM engine_commands WHERE id = ?", (command_id,)).fetchone()
+            if row and row[0] is not None:
+                return json.loads(row[1]) if row[1] else None
+            time.sleep(0.1)
+        return None
+    
+    def pending_commands(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, command, payload FROM engine_commands "
+                                   "WHERE done_at IS NULL ORDER BY id").fetchall()
+        return [(command_id, command, json.loads(payload) if payload else None)
+                for command_id, command, payload in rows]
+    
+    def complete(self, command_id, result=None):
+        with self.lock, self.db:
+            self.db.execute("UPDATE engine_commands SET done_at = ?, result = ? WHERE id = ?",
+                            (time.time(), json.dumps(result, default=engine_json_default), command_id))
+    
+    def discard_pending(self):
+        """Drop commands queued while no engine was running"""
+        with self.lock, self.db:
+            self.db.execute("UPDATE engine_commands SET done_at = ?, result = ? WHERE done_at IS NULL",
+                            (time.time(), json.dumps({'error': "Engine was not running"})))
+
+@st.cache_resource
+def get_engine_channel(path):
+    return EngineChannel(path)
+
+class StateSnapshot:
+    """The engine's state in a memory-mapped file, written by the engine and read by
+    any number of dashboards without touching Kite, the logs or each other.
+    
+    A seqlock guards the payload: the single writer makes the sequence number odd,
+    writes the payload and its length, then makes it even again. A reader copies
+    the payload between two reads of the sequence and retries if they differ or
+    are odd, so it takes no lock and never holds up the engine. A snapshot older
+    than HEARTBEAT_SECONDS means no engine is running.
+    """
+    MAGIC = b'OBS1'
+    HEADER = struct.Struct('<4sQdII')  # magic, sequence, updated_at, pid, payload length
+    SEQUENCE = struct.Struct('<Q')
+    STAMP = struct.Struct('<dII')
+    CAPACITY = 1 << 20
+    HEARTBEAT_SECONDS = 15
+    READ_RETRIES = 100
+    
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.writable = False
+        self.sequence = 0
+    
+    def _open_writer(self):
+        size = self.HEADER.size + self.CAPACITY
+        with open(self.path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        self.writable = True
+        magic, sequence, _, _, _ = self.HEADER.unpack_from(self.map)
+        # Carry on from the last sequence number so readers of the old one see the change
+        self.sequence = sequence + sequence % 2 if magic == self.MAGIC else 0
+        self.map[:4] = self.MAGIC
+    
+    def _open_reader(self):
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.HEADER.size + self.CAPACITY:
+                    return False
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return True
+        except OSError:
+            return False
+    
+    @contextmanager
+    def _writing(self, updated_at, length):
+        self.sequence += 1
+        self.SEQUENCE.pack_into(self.map, 4, self.sequence)
+        yield
+        self.STAMP.pack_into(self.map, 12, updated_at, os.getpid(), length)
+        self.sequence += 1
+        self.SEQUENCE.pack_into(self.map, 4, self.sequence)
+    
+    def write(self, state):
+        """Publish a new snapshot; the order-log tail is shortened if it does not fit"""
+        payload = json.dumps(state, default=engine_json_default, separators=(',', ':')).encode()
+        while len(payload) > self.CAPACITY and state.get('recent_orders'):
+            state['recent_orders'] = state['recent_orders'][:len(state['recent_orders']) // 2]
+            payload = json.dumps(state, default=engine_json_default, separators=(',', ':')).encode()
+        if len(payload) > self.CAPACITY:
+            raise ValueError(f"State snapshot of {len(payload)} bytes exceeds {self.CAPACITY}")
+        
+        if not self.writable:
+            self._open_writer()
+        with self._writing(time.time(), len(payload)):
+            self.map[self.HEADER.size:self.HEADER.size + len(payload)] = payload
+    
+    def clear(self):
+        """Mark the snapshot stale when the engine stops"""
+        if self.writable:
+            with self._writing(0.0, 0):
+                pass
+    
+    def read(self):
+        """The latest snapshot, or None if no engine has published one recently"""
+        if self.map is None and not self._open_reader():
+            return None
+        
+        for _ in range(self.READ_RETRIES):
+            magic, sequence, updated_at, pid, length = self.HEADER.unpack_from(self.map)
+            if magic != self.MAGIC:
+                return None
+            if sequence % 2 == 0:
+                payload = self.map[self.HEADER.size:self.HEADER.size + length]
+                if self.SEQUENCE.unpack_from(self.map, 4)[0] == sequence:
+                    break
+            time.sleep(0.001)
+        else:
+            return None
+        
+        if time.time() - updated_at > self.HEARTBEAT_SECONDS:
+            if not self.writable:
+                # Map the file afresh next time in case a new engine recreated it
+                self.map = None
+            return None
+        state = json.loads(payload)
+        state['engine_pid'] = pid
+        return state
+
+@st.cache_resource
+def get_state_snapshot(path):
+    return StateSnapshot(path)
+
+def apply_engine_state(state):
+    """Copy an engine snapshot into this session for the dashboard to render"""
+    for key in ENGINE_STATE_KEYS:
+        value = state.get(key)
+        if key in ('last_order_time', 'last_signal_time'):
+            value = {index_name: datetime.fromisoformat(stamp) for index_name, stamp in (value or {}).items()}
+        st.session_state[key] = value
+    st.session_state.engine_pid = state['engine_pid']
+
+def update_reference_ltp(kite, quotes):
+    try:
+        ref_price = get_reference_price(kite, st.session_state.selected_index, quotes)
+        st.session_state.market_data['ltp'] = ref_price
+    except:
+        st.session_state.market_data['ltp'] = 0.0
+
+def run_trading_iteration(kite, trade_manager, quotes, notify):
+    """One pass of the bot: evaluate the signal, enter if allowed, then manage the open legs"""
+    evaluate_signal(kite, trade_manager, quotes, notify)
+    manage_positions(kite, trade_manager, quotes)
+
+def reset_daily_flags():
+    # Reset square off flags at the start of each day
+    now = datetime.now()
+    if now.hour == 0 and now.minute < 5:  # Reset at midnight
+        st.session_state.square_off_triggered = {}
+
+def evaluate_signal(kite, trade_manager, quotes, notify, entry_lock=None, bar_close=None):
+    reset_daily_flags()
+    
+    # Fetch market data and generate signals; only the entry holds entry_lock
+    if fetch_market_data(kite, st.session_state.selected_index, quotes, bar_close):
+        with entry_lock or nullcontext():
+            enter_on_signal(kite, trade_manager, st.session_state.selected_index, quotes, notify)
+
+def scan_signals(kite, trade_manager, pool, notify, entry_lock=None, bar_close=None):
+    """Evaluate every configured instrument at once and enter on each one's own signal"""
+    reset_daily_flags()
+    results, quotes = scan_market_data(kite, list(Config.INDEX_MAP), pool, bar_close=bar_close)
+    with entry_lock or nullcontext():
+        for index_name in results:
+            enter_on_signal(kite, trade_manager, index_name, quotes, notify, scanning=True)
+
+def enter_on_signal(kite, trade_manager, index_name, quotes, notify, scanning=False):
+    market_data = st.session_state.market_data_by_index[index_name]
+    signal = market_data.get('signal', 'No Trade')
+    signal_reason = market_data.get('signal_reason', '')
+    
+    # Update last signal
+    if index_name == st.session_state.selected_index:
+        st.session_state.last_signal = f"{signal} - {signal_reason}"
+    
+    # Check if we should place a trade
+    can_trade, reason = trade_manager.can_trade(index_name if scanning else None)
+    
+    if can_trade and ("Bullish" in signal or "Bearish" in signal):
+        # Determine signal type
+        signal_type = "BUY" if "Bullish" in signal else "SELL"
+        
+        # Get reference price
+        ref_price = get_reference_price(kite, index_name, quotes)
+        
+        # Place order
+        order_id = trade_manager.place_order(
+            index_name, 
+            signal_type, 
+            ref_price
+        )
+        
+        if order_id:
+            notify(f"Order placed: {signal_type} {index_name}")
+        else:
+            notify(f"Failed to place order for {signal_type} signal")
+    elif not can_trade and reason:
+        # Show why we can't trade
+        notify(f"Not trading {index_name}: {reason}" if scanning else f"Not trading: {reason}")
+
+def manage_positions(kite, trade_manager, quotes=None):
+    # Monitor active trades for SL/TP/TSL
+    trade_manager.monitor_trades(quotes)
+    sync_market_feed(kite)
+    trade_manager.update_stats()
+
+def square_off_summary(reports):
+    if not reports:
+        return None
+    return {
+        'legs': len(reports),
+        'unsold': sum(r['unsold_quantity'] for r in reports),
+        'total_ms': st.session_state.last_square_off['total_ms'],
+        'slowest_ms': max((r['fill_ms'] or r['submit_ms'] or 0) for r in reports)
+    }
+
+class ExchangeClock:
+    """Offset of the exchange clock from ours, smoothed over the exchange timestamps of ticks"""
+    SMOOTHING = 0.05
+    MAX_OFFSET = 60  # ignore ticks that are simply old, e.g. an index after the close
+    
+    def __init__(self):
+        self.offset = 0.0
+        self.samples = 0
+    
+    def on_ticks(self, ticks):
+        now = datetime.now()
+        for tick in ticks:
+            stamp = tick.get('exchange_timestamp')
+            if not stamp:
+                continue
+            sample = (stamp - now).total_seconds()
+            if abs(sample) > self.MAX_OFFSET:
+                continue
+            self.offset = sample if self.samples == 0 else self.offset + self.SMOOTHING * (sample - self.offset)
+            self.samples += 1
+
+def every(seconds):
+    """Schedule: a fixed rate, measured from the previous slot"""
+    return lambda after: after + seconds
+
+def on_bar_close(interval, delay, clock):
+    """Schedule: `delay` seconds after each close of an `interval`-second bar on the exchange clock"""
+    def next_due(after):
+        moment = datetime.fromtimestamp(after + clock.offset - delay)
+        midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = (moment - midnight).total_seconds()
+        close = midnight + timedelta(seconds=(elapsed // interval + 1) * interval)
+        return close.timestamp() - clock.offset + delay
+    return next_due
+
+def daily(times):
+    """Schedule: the next of the given times of day"""
+    def next_due(after):
+        moment = datetime.fromtimestamp(after)
+        runs = []
+        for time_of_day in times:
+            run_at = datetime.combine(moment.date(), time_of_day)
+            if run_at <= moment:
+                run_at += timedelta(days=1)
+            runs.append(run_at)
+        return min(runs).timestamp()
+    return next_due
+
+class ScheduledJob:
+    """One engine job, its next due time and its timing metrics"""
+    def __init__(self, name, func, schedule, due, lane):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.due = due
+        self.lane = lane
+        self.runs = 0
+        self.overruns = 0  # runs still going when the job's next slot came
+        self.skipped = 0  # slots dropped because the job ran or started late
+        self.errors = 0
+        self.drift_ms = 0.0
+        self.max_drift_ms = 0.0
+        self.total_drift_ms = 0.0
+        self.duration_ms = 0.0
+        self.max_duration_ms = 0.0
+        self.total_duration_ms = 0.0
+    
+    def metrics(self):
+        runs = max(self.runs, 1)
+        return {
+            'job': self.name,
+            'lane': self.lane,
+            'runs': self.runs,
+            'next_in_s': round(max(0.0, self.due - time.time()), 1),
+            'drift_ms': round(self.drift_ms, 1),
+            'avg_drift_ms': round(self.total_drift_ms / runs, 1),
+            'max_drift_ms': round(self.max_drift_ms, 1),
+            'avg_duration_ms': round(self.total_duration_ms / runs, 1),
+            'max_duration_ms': round(self.max_duration_ms, 1),
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'errors': self.errors
+        }
+
+class TaskScheduler:
+    """Runs each engine job at its own cadence, one at a time per lane.
+    
+    A job comes due at the times its schedule gives (a fixed rate, each bar
+    close, a daily time) or at once when trigger() is called from another
+    thread, e.g. by a tick. Each lane is one thread (the main lane is the
+    caller's), so a slow job only delays the jobs that share its lane. How late
+    a job starts is recorded as drift. A job still running when its next slot
+    passes counts an overrun; slots missed for that or for a late start are
+    skipped rather than run back to back.
+    """
+    MAIN_LANE = "main"
+    
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.triggered = set()
+        self._wakes = {self.MAIN_LANE: threading.Event()}
+        self.stopped = threading.Event()
+    
+    def add(self, name, func, schedule, run_now=True, lane=MAIN_LANE):
+        now = time.time()
+        self.jobs[name] = ScheduledJob(name, func, schedule, now if run_now else schedule(now), lane)
+        self._wakes.setdefault(lane, threading.Event())
+    
+    def trigger(self, name):
+        """Make a job due now; safe to call from any thread"""
+        with self.lock:
+            self.triggered.add(name)
+        job = self.jobs.get(name)
+        if job is not None:
+            self._wakes[job.lane].set()
+    
+    def stop(self):
+        self.stopped.set()
+        for wake in self._wakes.values():
+            wake.set()
+    
+    def run(self):
+        """Run the main lane on this thread and every other lane on its own until stop()"""
+        threads = [threading.Thread(target=self._run_lane, args=(lane,), name=f"engine-{lane}", daemon=True)
+                   for lane in self._wakes if lane != self.MAIN_LANE]
+        for thread in threads:
+            thread.start()
+        try:
+            self._run_lane(self.MAIN_LANE)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+    
+    def _run_lane(self, lane):
+        jobs = [job for job in self.jobs.values() if job.lane == lane]
+        names = {job.name for job in jobs}
+        wake = self._wakes[lane]
+        if not jobs:
+            self.stopped.wait()
+            return
+        
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.lock:
+                triggered = self.triggered & names
+                self.triggered -= triggered
+            for name in triggered:
+                job = self.jobs[name]
+                if job.due > now:
+                    job.due = now
+            
+            job = min(jobs, key=lambda j: j.due)
+            if job.due > now:
+                wake.wait(job.due - now)
+                wake.clear()
+                continue
+            self._run_job(job, now)
+    
+    def _run_job(self, job, started):
+        drift = (started - job.due) * 1000
+        clock = time.perf_counter()
+        try:
+            job.func()
+        except Exception as e:
+            job.errors += 1
+            print(f"Error in engine job {job.name}: {e}")
+        duration = (time.perf_counter() - clock) * 1000
+        
+        job.runs += 1
+        job.drift_ms = drift
+        job.max_drift_ms = max(job.max_drift_ms, drift)
+        job.total_drift_ms += drift
+        job.duration_ms = duration
+        job.max_duration_ms = max(job.max_duration_ms, duration)
+        job.total_duration_ms += duration
+        
+        now = time.time()
+        due = job.schedule(job.due)
+        if due <= now:
+            if started < due:
+                job.overruns += 1  # it was still running at its next slot, not just started late
+            while due <= now:
+                due = job.schedule(due)
+                job.skipped += 1
+        job.due = due
+    
+    def metrics(self):
+        return [job.metrics() for job in self.jobs.values()]
+
+class TradingEngine:
+    """The bot without the dashboard: owns the Kite session, TradeManager and market
+    data, and takes start / stop / square off / config commands from an EngineChannel.
+    
+    Its work is split into jobs on a TaskScheduler: the signal on each bar close,
+    position checks on every tick, order reconciliation, commands, the state
+    snapshot and the daily instrument refresh each run at their own cadence.
+    The slow jobs (signal and instruments, commands such as a square off) get
+    lanes of their own so position checks and the heartbeat are never queued
+    behind them; positions_lock keeps their trade bookkeeping apart.
+    """
+    CLOSE_SLACK_SECONDS = 5  # a signal run this late after its slot still counts as the bar close
+    
+    def __init__(self, kite, channel, snapshot):
+        self.kite = kite
+        self.channel = channel
+        self.snapshot = snapshot
+        self.clock = ExchangeClock()
+        self.scheduler = TaskScheduler()
+        self.trade_manager = TradeManager(kite)
+        self.scan_pool = ThreadPoolExecutor(max_workers=Config.SCAN_WORKERS, thread_name_prefix="scan")
+        self.positions_lock = threading.RLock()
+        
+        scheduler = self.scheduler
+        scheduler.add('commands', self.handle_commands, every(Config.COMMAND_POLL_SECONDS), lane="commands")
+        scheduler.add('instruments', self.refresh_instruments, daily(Config.INSTRUMENT_REFRESH_TIME.values()),
+                      lane="market")
+        scheduler.add('signal', self.evaluate_signal,
+                      on_bar_close(Config.SIGNAL_INTERVAL, Config.SIGNAL_CLOSE_DELAY, self.clock), lane="market")
+        scheduler.add('monitor', self.monitor, every(Config.MONITOR_SECONDS))
+        scheduler.add('orders', self.reconcile_orders, every(Config.ORDER_RECONCILE_SECONDS))
+        scheduler.add('publish', self.publish, every(Config.PUBLISH_SECONDS))
+        
+        feed = start_market_feed(kite)
+        if feed is not None:
+            feed.add_listener(self.on_ticks)
+    
+    def run(self):
+        self.channel.discard_pending()
+        try:
+            self.scheduler.run()
+        finally:
+            self.scan_pool.shutdown(wait=False)
+            self.snapshot.clear()
+    
+    def stop(self):
+        self.scheduler.stop()
+    
+    def on_ticks(self, ticks):
+        # Runs on the ticker thread: only note the clock and wake the position check
+        self.clock.on_ticks(ticks)
+        self.scheduler.trigger('monitor')
+    
+    def evaluate_signal(self):
+        if not st.session_state.bot_running:
+            return
+        bar_close = self.bar_close()
+        if Config.SCAN_ALL_INDICES:
+            scan_signals(self.kite, self.trade_manager, self.scan_pool, print, self.positions_lock, bar_close)
+        else:
+            quotes = build_iteration_quotes(self.kite, st.session_state.selected_index)
+            evaluate_signal(self.kite, self.trade_manager, quotes, print, self.positions_lock, bar_close)
+    
+    def bar_close(self):
+        """Exchange time of the bar close this signal run follows, or None when it runs
+        mid-bar (after a start or a config change) and should look at the forming bar"""
+        now = datetime.now() + timedelta(seconds=self.clock.offset)
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = (now - midnight).total_seconds()
+        close = midnight + timedelta(seconds=elapsed // Config.SIGNAL_INTERVAL * Config.SIGNAL_INTERVAL)
+        if (now - close).total_seconds() <= Config.SIGNAL_CLOSE_DELAY + self.CLOSE_SLACK_SECONDS:
+            return close
+        return None
+    
+    def monitor(self):
+        with self.positions_lock:
+            self.trade_manager.process_order_updates()
+            if st.session_state.bot_running and st.session_state.active_trades:
+                manage_positions(self.kite, self.trade_manager)
+    
+    def reconcile_orders(self):
+        with self.positions_lock:
+            if self.trade_manager.is_stale():
+                self.trade_manager = TradeManager(self.kite)
+        get_order_tracker().request_reconcile()
+        sync_market_feed(self.kite)
+        self.trade_manager.update_stats()
+    
+    def refresh_instruments(self):
+        registry = get_instrument_registry()
+        for exchange in {info.get("exchange", "NFO") for info in Config.INDEX_MAP.values()}:
+            if not registry.is_fresh(exchange):
+                with api_priority(PRIORITY_BACKGROUND):
+                    registry.refresh(self.kite, exchange)
+    
+    def handle_commands(self):
+        for command_id, command, payload in self.channel.pending_commands():
+            try:
+                result = self.execute(command, payload or {})
+            except Exception as e:
+                print(f"Error running engine command {command}: {e}")
+                result = {'error': str(e)}
+            self.channel.complete(command_id, result)
+    
+    def execute(self, command, payload):
+        if command == 'start':
+            st.session_state.bot_running = True
+            self.scheduler.trigger('signal')
+        elif command == 'stop':
+            st.session_state.bot_running = False
+        elif command == 'square_off':
+            with self.positions_lock:
+                return {'ok': True, 'summary': square_off_summary(self.trade_manager.square_off_all())}
+        elif command == 'config':
+            self.apply_config(payload)
+        else:
+            return {'error': f"Unknown command: {command}"}
+        return {'ok': True}
+    
+    def apply_config(self, values):
+        editable = config_values()
+        for key, value in values.items():
+            if key == 'INDEX':
+                if value in Config.INDEX_MAP and value != st.session_state.selected_index:
+                    st.session_state.selected_index = value
+                    reset_market_data()
+                    if value in st.session_state.market_data_by_index:
+                        st.session_state.market_data = st.session_state.market_data_by_index[value]
+                    self.scheduler.trigger('signal')
+            elif key in editable:
+                setattr(Config, key, value)
+    
+    def publish(self):
+        update_reference_ltp(self.kite, None)
+        state = {key: st.session_state[key] for key in ENGINE_STATE_KEYS}
+        state['recent_orders'] = self.trade_manager.order_store.recent(50)
+        state['scheduler'] = self.scheduler.metrics()
+        self.snapshot.write(state)
+
+def run_engine(paper=False):
+    """Entry point of `python app.py --engine [--paper]`: log in from the saved session
+    (or the simulator) and trade until interrupted"""
+    init_session_state()
+    snapshot = get_state_snapshot(Config.SNAPSHOT_FILE)
+    running = snapshot.read()
+    if running is not None:
+        print(f"An engine is already running (pid {running['engine_pid']})")
+        return 1
+    
+    if paper:
+        kite = start_paper_trading()
+        profile = kite.profile()
+    else:
+        api_key, _ = load_credentials()
+        if not api_key or not os.path.exists(Config.TOKEN_FILE):
+            print("No saved session found. Log in once from the dashboard first.")
+            return 1
+        try:
+            kite, profile = restore_session(api_key)
+        except Exception as e:
+            print(f"Error restoring session: {e}")
+            return 1
+    
+    st.session_state.auth_status = True
+    st.session_state.kite = kite
+    st.session_state.user_name = profile['user_name']
+    
+    engine = TradingEngine(kite, get_engine_channel(Config.ENGINE_FILE), snapshot)
+    os_signal.signal(os_signal.SIGTERM, lambda *_: engine.stop())
+    print(f"Engine running for {profile['user_name']} (pid {os.getpid()})")
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 # --- MAIN APP ---
 def main():
     init_session_state()
     
-    if st.session_state.auth_status and st.session_state.kite:
+    # With a headless engine running, this page only renders its snapshot and sends it commands
+    remote = get_state_snapshot(Config.SNAPSHOT_FILE).read()
+    channel = None
+    if remote is not None:
+        channel = get_engine_channel(Config.ENGINE_FILE)
+        apply_engine_state(remote)
+    elif st.session_state.engine_pid:
+        # The engine went away; don't let this session pick up trading where it left off
+        st.session_state.engine_pid = None
+        st.session_state.bot_running = False
+    
+    # Driving the engine trades the account, so it needs the same Zerodha login as trading here
+    if st.session_state.auth_status and (remote is not None or st.session_state.kite):
         kite = st.session_state.kite
-        trade_manager = TradeManager(kite)
+        trade_manager = None
+        if remote is None:
+            start_instrument_refresher(kite)
+            start_market_feed(kite)
+            trade_manager = get_trade_manager(kite)
+            trade_manager.process_order_updates()
         
         # --- TOP NAVIGATION & HEADER ---
         col_h1, col_h2 = st.columns([3, 1])
@@ -1534,16 +4694,18 @@ def main():
             st.markdown('<p class="subheading">Trade Banknifty, Nifty & MCX Options</p>', unsafe_allow_html=True)
         with col_h2:
             st.markdown(f"👤 **{st.session_state.user_name}**")
-            if st.button("Logout", use_container_width=True):
-                clear_access_token()
+            if remote is not None:
+                st.caption(f"Connected to trading engine (pid {remote['engine_pid']})")
+            elif st.button("Logout", use_container_width=True):
+                end_session()
                 st.rerun()
 
         # --- LIVE DATA SYNC ---
-        try:
-            ref_price = get_reference_price(kite, st.session_state.selected_index)
-            st.session_state.market_data['ltp'] = ref_price
-        except:
-            st.session_state.market_data['ltp'] = 0.0
+        # One batched quote request covers the LTP card, the signal and every open leg
+        quotes = None
+        if remote is None:
+            quotes = build_iteration_quotes(kite, st.session_state.selected_index)
+            update_reference_ltp(kite, quotes)
 
         # --- COMPACT METRICS BAR (LTP & SIGNAL) ---
         m1, m2, m3, m4, m5, m6 = st.columns(6)
@@ -1610,30 +4772,71 @@ def main():
                         st.warning(f"⚠️ Market closing soon! All positions will be squared off by {square_off_time.strftime('%H:%M')}")
                 else:
                     st.info("No active trades. Waiting for signal...")
+                
+                # Every instrument the engine is scanning, when it scans more than the selected one
+                if len(st.session_state.market_data_by_index) > 1:
+                    st.markdown("#### Instrument Scan")
+                    scan_data = []
+                    for index_name, data in st.session_state.market_data_by_index.items():
+                        scan_data.append({
+                            'Instrument': index_name,
+                            'Price': f"₹{data.get('current_price') or 0:,.2f}",
+                            'Signal': data.get('signal', ''),
+                            'Stoch K/D': f"{data.get('stoch_k', 0):.1f} / {data.get('stoch_d', 0):.1f}",
+                            'EMA 5/8/13': f"{data.get('ema5', 0):.1f} / {data.get('ema8', 0):.1f} / {data.get('ema13', 0):.1f}"
+                        })
+                    st.dataframe(pd.DataFrame(scan_data), use_container_width=True)
             
             with col_r:
                 st.markdown("#### Trading Controls")
                 # START/STOP BUTTONS
                 if not st.session_state.bot_running:
                     if st.button("▶️ START BOT", type="primary", use_container_width=True):
+                        if remote is not None:
+                            channel.wait_for(channel.send('start'))
                         st.session_state.bot_running = True
                         st.rerun()
                 else:
                     if st.button("⏹️ STOP BOT", type="secondary", use_container_width=True):
+                        if remote is not None:
+                            channel.wait_for(channel.send('stop'))
                         st.session_state.bot_running = False
                         st.rerun()
                 
                 # SQUARE OFF BUTTON
                 if st.button("🚨 SQUARE OFF ALL", type="primary", use_container_width=True):
-                    trade_manager.square_off_all()
-                    st.warning("All active positions have been squared off.")
+                    if remote is not None:
+                        result = channel.wait_for(channel.send('square_off'), timeout=30)
+                        summary = result.get('summary') if result else None
+                    else:
+                        result = {'ok': True}
+                        summary = square_off_summary(trade_manager.square_off_all(quotes))
+                    if result is None:
+                        st.error("No confirmation from the engine; positions may still be open.")
+                    elif result.get('error'):
+                        st.error(f"Square off failed: {result['error']}")
+                    elif summary and summary['unsold']:
+                        st.error(f"Square off left {summary['unsold']} qty unsold; those legs are still open.")
+                    else:
+                        st.warning("All active positions have been squared off.")
+                    if summary:
+                        st.caption(f"{summary['legs']} legs in {summary['total_ms']} ms "
+                                   f"(slowest leg {summary['slowest_ms']} ms)")
+                
+                if remote is not None and remote.get('scheduler'):
+                    with st.expander("Engine jobs"):
+                        st.dataframe(pd.DataFrame(remote['scheduler']), use_container_width=True)
 
         with tabs[1]:
             st.markdown("#### Activity & Order History")
-            if st.session_state.order_history:
+            if remote is not None:
+                recent_orders = remote['recent_orders']
+            else:
+                recent_orders = trade_manager.order_store.recent(50)  # Show last 50 orders
+            if recent_orders:
                 # Create a formatted dataframe for order history
                 log_data = []
-                for order in reversed(st.session_state.order_history[-50:]):  # Show last 50 orders
+                for order in recent_orders:
                     row = {
                         'Time': order.get('entry_time', ''),
                         'Symbol': order.get('symbol', ''),
@@ -1672,6 +4875,8 @@ def main():
             
             # Check if instrument changed and reset market data
             if st.session_state.selected_index != previous_index:
+                if remote is not None:
+                    channel.send('config', {'INDEX': st.session_state.selected_index})
                 reset_market_data()
                 st.toast(f"Switched to {st.session_state.selected_index}. Market data reset.")
 
@@ -1694,62 +4899,43 @@ def main():
                     if Config.TSL_STEP >= Config.TSL_TRIGGER:
                         st.warning("⚠️ TSL Step should be less than TSL Trigger for proper trailing.")
                 
+                protective_modes = ["OFF", "SL", "SL-M", "GTT"]
+                Config.PROTECTIVE_ORDER_MODE = st.selectbox(
+                    "Exchange Stop Order",
+                    options=protective_modes,
+                    index=protective_modes.index(Config.PROTECTIVE_ORDER_MODE),
+                    help="Rest the stop loss at the exchange (GTT also covers the target) and trail it with modify_order"
+                )
+                if Config.PROTECTIVE_ORDER_MODE != "OFF":
+                    Config.PROTECTIVE_MIN_STEP = st.number_input("Min Trail Step (Points)", 1, 100, Config.PROTECTIVE_MIN_STEP)
+                
                 Config.MAX_TRADES_PER_DAY = st.number_input("Max Trades/Day", 1, 50, Config.MAX_TRADES_PER_DAY)
                 Config.COOLDOWN_AFTER_SIGNAL = st.number_input("Signal Cooldown (seconds)", 5, 120, Config.COOLDOWN_AFTER_SIGNAL)
+                Config.SCAN_ALL_INDICES = st.checkbox(
+                    "Engine: scan every instrument",
+                    value=Config.SCAN_ALL_INDICES,
+                    help="A running engine evaluates all instruments on each bar close, one position per instrument"
+                )
             
             if st.button("Apply & Save Settings", use_container_width=True):
                 # Validate TSL settings
                 if Config.TSL_ENABLED and Config.TSL_STEP >= Config.TSL_TRIGGER:
                     st.error("TSL Step must be less than TSL Trigger. Please adjust values.")
                 else:
+                    if remote is not None:
+                        channel.send('config', config_values())
                     if save_config():
                         st.success("Configuration updated and saved to bot_config.json")
                     else:
                         st.error("Failed to save configuration")
 
         # --- BOT LOGIC LOOP ---
-        if st.session_state.bot_running:
-            # Reset square off flag at the start of each day
-            now = datetime.now()
-            if now.hour == 0 and now.minute < 5:  # Reset at midnight
-                st.session_state.square_off_triggered = False
-            
-            # Fetch market data and generate signals
-            if fetch_market_data(kite, st.session_state.selected_index):
-                signal = st.session_state.market_data.get('signal', 'No Trade')
-                signal_reason = st.session_state.market_data.get('signal_reason', '')
-                
-                # Update last signal
-                st.session_state.last_signal = f"{signal} - {signal_reason}"
-                
-                # Check if we should place a trade
-                can_trade, reason = trade_manager.can_trade()
-                
-                if can_trade and ("Bullish" in signal or "Bearish" in signal):
-                    # Determine signal type
-                    signal_type = "BUY" if "Bullish" in signal else "SELL"
-                    
-                    # Get reference price
-                    ref_price = get_reference_price(kite, st.session_state.selected_index)
-                    
-                    # Place order
-                    order_id = trade_manager.place_order(
-                        st.session_state.selected_index, 
-                        signal_type, 
-                        ref_price
-                    )
-                    
-                    if order_id:
-                        st.toast(f"Order placed: {signal_type} {st.session_state.selected_index}")
-                    else:
-                        st.toast(f"Failed to place order for {signal_type} signal")
-                elif not can_trade and reason:
-                    # Show why we can't trade
-                    st.toast(f"Not trading: {reason}")
-            
-            # Monitor active trades for SL/TP/TSL
-            trade_manager.monitor_trades()
-            trade_manager.update_stats()
+        if remote is not None:
+            # The engine trades; keep polling its state
+            time.sleep(2)
+            st.rerun()
+        elif st.session_state.bot_running:
+            run_trading_iteration(kite, trade_manager, quotes, st.toast)
             
             # Small delay before next refresh
             time.sleep(2)
@@ -1760,4 +4946,6 @@ def main():
         render_login_screen()
 
 if __name__ == "__main__":
+    if "--engine" in sys.argv:
+        sys.exit(run_engine(paper="--paper" in sys.argv))
     main()
@@ -0,0 +1,346 @@
+"""Local stand-in for the Kite ticker websocket (wss://ws.kite.trade).
+
+Speaks enough of the Kite streaming protocol for an unmodified KiteTicker to
+connect: subscribe / unsubscribe / mode messages in, binary tick packets out.
+Prices random-walk on every interval unless set explicitly, and order updates
+can be pushed with send_order_update(), so the bot can be exercised without
+network access:
+
+    python fake_ticker.py --port 8765
+
+and set Config.TICKER_ROOT = "ws://127.0.0.1:8765" (or pass root= to KiteTicker).
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# Segment ids carried in the low byte of an instrument token, as in KiteTicker.EXCHANGE_MAP
+SEGMENT_CDS = 3
+SEGMENT_BCD = 6
+SEGMENT_INDICES = 9
+SEGMENT_NCO = 12
+
+MODE_LTP = "ltp"
+MODE_QUOTE = "quote"
+MODE_FULL = "full"
+
+
+def price_divisor(token):
+    segment = token & 0xff
+    if segment == SEGMENT_CDS:
+        return 10000000.0
+    if segment in (SEGMENT_BCD, SEGMENT_NCO):
+        return 10000.0
+    return 100.0
+
+
+def pack_tick(token, tick, mode):
+    """Encode one tick as a Kite binary packet for the given streaming mode"""
+    divisor = price_divisor(token)
+
+    def p(value):
+        return int(round(value * divisor))
+
+    price = tick['last_price']
+    timestamp = int(tick.get('timestamp', time.time()))
+
+    if mode == MODE_LTP:
+        return struct.pack(">II", token, p(price))
+
+    if token & 0xff == SEGMENT_INDICES:
+        change = p(price - tick['close'])
+        packet = struct.pack(">IIIIIIi", token, p(price), p(tick['high']), p(tick['low']),
+                             p(tick['open']), p(tick['close']), change)
+        if mode == MODE_FULL:
+            packet += struct.pack(">I", timestamp)
+        return packet
+
+    packet = struct.pack(">IIIIIIIIIII", token, p(price), tick.get('last_quantity', 1), p(price),
+                         tick.get('volume', 0), 0, 0, p(tick['open']), p(tick['high']),
+                         p(tick['low']), p(tick['close']))
+    if mode == MODE_FULL:
+        packet += struct.pack(">IIIII", timestamp, 0, 0, 0, timestamp)
+        packet += b"".join(struct.pack(">IIH2x", 0, 0, 0) for _ in range(10))
+    return packet
+
+
+def pack_message(packets):
+    """Frame a list of tick packets the way Kite batches them in one binary message"""
+    message = struct.pack(">H", len(packets))
+    for packet in packets:
+        message += struct.pack(">H", len(packet)) + packet
+    return message
+
+
+def _recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        data += chunk
+    return data
+
+
+class _Client:
+    """One connected websocket client and the tokens it subscribed to"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.modes = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack(">H", length)
+        else:
+            header += bytes([127]) + struct.pack(">Q", length)
+
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def read_frame(self):
+        b1, b2 = _recv_exact(self.sock, 2)
+        opcode = b1 & 0x0f
+        length = b2 & 0x7f
+        if length == 126:
+            length = struct.unpack(">H", _recv_exact(self.sock, 2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", _recv_exact(self.sock, 8))[0]
+
+        mask = _recv_exact(self.sock, 4) if b2 & 0x80 else None
+        payload = _recv_exact(self.sock, length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+class FakeTickerServer:
+    """Threaded websocket server emitting Kite-format ticks for subscribed tokens"""
+    def __init__(self, host="127.0.0.1", port=0, interval=1.0, volatility=0.0005, seed=None):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.volatility = volatility
+        self.random = random.Random(seed)
+        self.ticks = {}
+        self.clients = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sock = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen()
+        self.port = self._sock.getsockname()[1]
+
+        threading.Thread(target=self._accept_loop, name="fake-ticker-accept", daemon=True).start()
+        threading.Thread(target=self._tick_loop, name="fake-ticker-ticks", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.drop_connections()
+        if self._sock:
+            self._sock.close()
+
+    def drop_connections(self):
+        """Abort every client connection, e.g. to exercise reconnect handling"""
+        with self._lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+
+    def set_price(self, token, price, push=True):
+        """Set the last price of a token and, by default, push it to subscribers immediately"""
+        with self._lock:
+            tick = self._tick(token, price)
+            tick['last_price'] = price
+            tick['high'] = max(tick['high'], price)
+            tick['low'] = min(tick['low'], price)
+            tick['volume'] += tick['last_quantity']
+            tick['timestamp'] = time.time()
+        if push:
+            self._broadcast([token])
+
+    def send_text(self, message):
+        """Send a JSON text message (e.g. an order update) to every client"""
+        payload = json.dumps(message, default=str).encode()
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send(OPCODE_TEXT, payload)
+
+    def send_order_update(self, order):
+        """Push an order update the way Kite does on the ticker's text channel"""
+        self.send_text({"type": "order", "data": order})
+
+    def _tick(self, token, price=100.0):
+        tick = self.ticks.get(token)
+        if tick is None:
+            tick = self.ticks[token] = {
+                'last_price': price, 'open': price, 'high': price, 'low': price,
+                'close': price, 'volume': 0, 'last_quantity': 1, 'timestamp': time.time()
+            }
+        return tick
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock,), name="fake-ticker-client", daemon=True).start()
+
+    def _handshake(self, sock):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("socket closed during handshake")
+            request += chunk
+
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest())
+        sock.sendall(b"HTTP/1.1 101 Switching Protocols\r\n"
+                     b"Upgrade: websocket\r\n"
+                     b"Connection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+    def _serve(self, sock):
+        client = _Client(sock)
+        try:
+            self._handshake(sock)
+            with self._lock:
+                self.clients.append(client)
+
+            while not client.closed:
+                opcode, payload = client.read_frame()
+                if opcode == OPCODE_TEXT:
+                    self._handle_message(client, payload)
+                elif opcode == OPCODE_PING:
+                    client.send(OPCODE_PONG, payload)
+                elif opcode == OPCODE_CLOSE:
+                    client.send(OPCODE_CLOSE, payload[:2])
+                    break
+        except (ConnectionError, OSError, KeyError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            client.close()
+
+    def _handle_message(self, client, payload):
+        message = json.loads(payload)
+        action, value = message.get("a"), message.get("v")
+
+        if action == "subscribe":
+            for token in value:
+                client.modes.setdefault(int(token), MODE_QUOTE)
+            self._broadcast([int(t) for t in value], clients=[client])
+        elif action == "unsubscribe":
+            for token in value:
+                client.modes.pop(int(token), None)
+        elif action == "mode":
+            mode, tokens = value
+            for token in tokens:
+                client.modes[int(token)] = mode
+            self._broadcast([int(t) for t in tokens], clients=[client])
+
+    def _broadcast(self, tokens=None, clients=None):
+        with self._lock:
+            clients = list(clients if clients is not None else self.clients)
+            snapshot = {token: dict(self._tick(token)) for token in (tokens or self.ticks)}
+
+        for client in clients:
+            packets = [pack_tick(token, tick, client.modes[token])
+                       for token, tick in snapshot.items() if token in client.modes]
+            if packets:
+                client.send(OPCODE_BINARY, pack_message(packets))
+
+    def _tick_loop(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                subscribed = set()
+                for client in self.clients:
+                    subscribed.update(client.modes)
+                for token in subscribed:
+                    tick = self._tick(token)
+                    price = round(tick['last_price'] * (1 + self.random.gauss(0, self.volatility)), 2)
+                    tick['last_price'] = price
+                    tick['high'] = max(tick['high'], price)
+                    tick['low'] = min(tick['low'], price)
+                    tick['volume'] += tick['last_quantity']
+                    tick['timestamp'] = time.time()
+            self._broadcast()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Kite ticker websocket server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between random-walk ticks")
+    parser.add_argument("--price", action="append", default=[], metavar="TOKEN=PRICE",
+                        help="initial price for a token, e.g. 260105=48000")
+    args = parser.parse_args()
+
+    server = FakeTickerServer(args.host, args.port, args.interval)
+    for item in args.price:
+        token, price = item.split("=")
+        server.set_price(int(token), float(price), push=False)
+    server.start()
+    print(f"Fake ticker listening on {server.url}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
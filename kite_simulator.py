@@ -0,0 +1,856 @@
+"""In-process stand-in for the Kite Connect REST API, for paper trading and load tests.
+
+KiteSimulator subclasses KiteConnect, so it carries the same constants, and it
+overrides the calls the bot makes: ltp / quote / ohlc, historical_data,
+instruments, place_order / modify_order / cancel_order, orders / order_history,
+the GTT calls and profile. Prices come from one PricePath per underlying (a
+seeded random walk, or a recorded CSV of `timestamp,price` rows); option
+premiums are derived from the underlying. Orders fill after a configurable
+latency with adverse slippage in ticks, and a configurable share of them is
+rejected. Order updates are pushed to listeners the way MarketFeed pushes
+ticker order updates, so the simulator can also stand in as the order stream:
+
+    kite = KiteSimulator(fill_latency=0.2, slippage_ticks=2, reject_rate=0.01).start()
+
+With the default zero latency orders are matched inline, which is what the
+throughput benchmark measures:
+
+    python kite_simulator.py --orders 20000
+
+--trade-manager measures the bot's own path instead: entries placed through
+app.py's TradeManager on the paper gateway, until each fill is an open trade.
+"""
+import argparse
+import csv
+import heapq
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone, time as dtime
+from itertools import count
+
+import numpy as np
+from kiteconnect import KiteConnect, exceptions
+
+IST = timezone(timedelta(hours=5, minutes=30))
+IST_OFFSET = 19800
+SECONDS_PER_YEAR = 365 * 86400
+
+# Segment ids carried in the low byte of an instrument token, as in KiteTicker.EXCHANGE_MAP
+SEGMENT_IDS = {"NSE": 1, "NFO": 2, "MCX": 7, "INDICES": 9}
+
+SESSIONS = {
+    "NSE": (dtime(9, 15), dtime(15, 30)),
+    "MCX": (dtime(9, 0), dtime(23, 30))
+}
+
+UNDERLYINGS = {
+    "NIFTY": {"tradingsymbol": "NIFTY 50", "instrument_token": 256265, "price": 24000.0, "exchange": "NFO",
+              "session": "NSE", "step": 50, "strikes": 40, "lot_size": 75, "tick_size": 0.05,
+              "freeze_quantity": 1800, "volatility": 0.14},
+    "BANKNIFTY": {"tradingsymbol": "NIFTY BANK", "instrument_token": 260105, "price": 52000.0, "exchange": "NFO",
+                  "session": "NSE", "step": 100, "strikes": 40, "lot_size": 30, "tick_size": 0.05,
+                  "freeze_quantity": 900, "volatility": 0.16},
+    "CRUDEOIL": {"price": 6000.0, "exchange": "MCX", "session": "MCX", "step": 50, "strikes": 30,
+                 "lot_size": 1, "tick_size": 0.1, "freeze_quantity": 100, "volatility": 0.35}
+}
+
+INTERVAL_SECONDS = {
+    "minute": 60, "3minute": 180, "5minute": 300, "10minute": 600, "15minute": 900,
+    "30minute": 1800, "60minute": 3600, "day": 86400
+}
+
+MONTH_CODES = "123456789OND"
+TERMINAL_STATUSES = {"COMPLETE", "REJECTED", "CANCELLED"}
+
+
+def round_to_tick(prices, tick_size):
+    return np.round(np.round(np.asarray(prices) / tick_size) * tick_size, 2)
+
+
+def option_price(spot, strike, option_type, years, volatility, tick_size):
+    """Intrinsic value plus a time value that peaks at the money and decays towards expiry"""
+    spot = np.asarray(spot, dtype=np.float64)
+    intrinsic = np.maximum(spot - strike, 0) if option_type == "CE" else np.maximum(strike - spot, 0)
+    spread = spot * volatility * np.sqrt(years)  # one standard deviation move before expiry
+    time_value = 0.4 * spread * np.exp(-0.5 * ((spot - strike) / spread) ** 2)
+    return np.maximum(round_to_tick(intrinsic + time_value, tick_size), tick_size)
+
+
+def to_epoch(value, end_of_day=False):
+    """Epoch seconds for a datetime, date or "YYYY-MM-DD[ HH:MM:SS]" string; naive values are IST"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value) if len(value) > 10 else date.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, dtime(23, 59, 59) if end_of_day else dtime(0, 0))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=IST)
+    return value.timestamp()
+
+
+def ist_datetime(epoch):
+    """Naive IST datetime, the form Kite uses for order timestamps"""
+    return datetime.fromtimestamp(epoch, IST).replace(tzinfo=None)
+
+
+class SimulatedClock:
+    """Manually advanced clock for deterministic runs; pass as clock= and call advance()"""
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class PricePath:
+    """Price of one underlying over time, linearly interpolated between samples.
+
+    Synthetic paths are a seeded geometric random walk that extends itself as the
+    clock moves past its end; recorded paths hold their last price.
+    """
+    def __init__(self, times, prices, step_volatility=None, step_seconds=None, seed=None):
+        self._data = (np.asarray(times, dtype=np.float64), np.asarray(prices, dtype=np.float64))
+        self.step_volatility = step_volatility
+        self.step_seconds = step_seconds
+        self.random = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def random_walk(cls, start_price, start_time, end_time, volatility=0.15, step_seconds=60, seed=None):
+        """Random walk with the given annualised volatility, sampled every step_seconds"""
+        step_volatility = volatility * np.sqrt(step_seconds / SECONDS_PER_YEAR)
+        path = cls([start_time], [start_price], step_volatility, step_seconds, seed)
+        path.extend_to(end_time)
+        return path
+
+    @classmethod
+    def load(cls, filename):
+        """Recorded path from a CSV of `timestamp,price` rows (epoch seconds or ISO datetimes)"""
+        times, prices = [], []
+        with open(filename, newline="") as f:
+            for row in csv.reader(f):
+                if not row or row[0].strip().lower() == "timestamp":
+                    continue
+                try:
+                    times.append(float(row[0]))
+                except ValueError:
+                    times.append(to_epoch(row[0].strip()))
+                prices.append(float(row[1]))
+        order = np.argsort(times)
+        return cls(np.asarray(times)[order], np.asarray(prices)[order])
+
+    @property
+    def end(self):
+        return self._data[0][-1]
+
+    def extend_to(self, t):
+        if self.step_volatility is None or t <= self.end:
+            return
+        with self.lock:
+            times, prices = self._data
+            if t <= times[-1]:
+                return
+            steps = int(np.ceil((t - times[-1]) / self.step_seconds)) + 1
+            returns = self.random.normal(0.0, self.step_volatility, steps)
+            self._data = (np.concatenate([times, times[-1] + self.step_seconds * np.arange(1, steps + 1)]),
+                          np.concatenate([prices, prices[-1] * np.exp(np.cumsum(returns))]))
+
+    def price_at(self, t):
+        """Price at epoch time t; accepts a scalar or an array"""
+        self.extend_to(np.max(t))
+        times, prices = self._data
+        return np.interp(t, times, prices)
+
+
+class KiteSimulator(KiteConnect):
+    """KiteConnect look-alike with a local matching engine; see the module docstring"""
+    is_simulator = True
+
+    def __init__(self, api_key="paper", access_token="paper", fill_latency=0.0, slippage_ticks=0,
+                 reject_rate=0.0, paths=None, clock=None, seed=None, history_days=10,
+                 match_interval=0.25, underlyings=None):
+        super().__init__(api_key, access_token=access_token)
+        self.fill_latency = fill_latency  # seconds, or a (low, high) range
+        self.slippage_ticks = slippage_ticks
+        self.reject_rate = reject_rate
+        self.clock = clock or time.time
+        self.match_interval = match_interval
+        self.underlyings = underlyings or UNDERLYINGS
+        self.random = random.Random(seed)
+
+        now = self.clock()
+        self.paths = dict(paths or {})
+        for offset, (name, spec) in enumerate(self.underlyings.items()):
+            if name not in self.paths:
+                self.paths[name] = PricePath.random_walk(
+                    spec["price"], now - history_days * 86400, now + 86400, spec["volatility"],
+                    seed=None if seed is None else seed + offset)
+
+        self.instrument_rows = {}  # exchange -> kite.instruments() rows for the current listing
+        self.by_key = {}  # "EXCHANGE:SYMBOL" -> instrument
+        self.by_token = {}
+        self.listing_date = None
+        self._exchange_tokens = count(100000)
+
+        self.order_book = {}
+        self.history = {}
+        self.gtts = {}
+        self.order_listeners = []
+        self.connect_listeners = []
+        self.connected = True
+        self.counters = {"placed": 0, "filled": 0, "rejected": 0, "cancelled": 0, "modified": 0}
+
+        self.lock = threading.Lock()
+        self._wake = threading.Condition(self.lock)
+        self._due = []  # (due_time, seq, order_id) of orders still inside their fill latency
+        self._working = {}  # accepted orders waiting for the market to reach them
+        self._sequence = count(1)
+        self._gtt_ids = count(1)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._ensure_listing()
+
+    # --- session ---
+    def generate_session(self, request_token, api_secret):
+        self.set_access_token(self.access_token)
+        return dict(self.profile(), access_token=self.access_token, request_token=request_token)
+
+    def profile(self):
+        return {
+            "user_id": "PAPER", "user_name": "Paper Trader", "user_shortname": "Paper",
+            "user_type": "individual", "email": "", "broker": "SIMULATOR",
+            "exchanges": ["NSE", "NFO", "MCX"], "products": ["MIS", "NRML", "CNC"],
+            "order_types": ["MARKET", "LIMIT", "SL", "SL-M"]
+        }
+
+    # --- order stream (the MarketFeed listener interface) ---
+    def add_order_listener(self, callback):
+        """Call callback(order) for every order status change"""
+        if callback not in self.order_listeners:
+            self.order_listeners.append(callback)
+
+    def add_connect_listener(self, callback):
+        """The simulator is always connected, so connect listeners are never called"""
+        if callback not in self.connect_listeners:
+            self.connect_listeners.append(callback)
+
+    def _publish(self, events):
+        for order in events:
+            for callback in self.order_listeners:
+                try:
+                    callback(order)
+                except Exception as e:
+                    print(f"Error in order listener: {e}")
+
+    # --- instruments ---
+    def _ensure_listing(self):
+        """(Re)build the instrument dump when the trading date changes; old contracts stay quotable"""
+        today = datetime.fromtimestamp(self.clock(), IST).date()
+        if self.listing_date == today:
+            return
+        rows = {}
+        for name, spec in self.underlyings.items():
+            for exchange, row, instrument in self._contracts(name, spec, today):
+                rows.setdefault(exchange, []).append(row)
+                key = f"{exchange}:{row['tradingsymbol']}"
+                instrument = self.by_key.get(key) or dict(instrument, row=row, key=key)
+                self.by_key[key] = self.by_token[row["instrument_token"]] = instrument
+        self.instrument_rows = rows
+        self.listing_date = today
+
+    def _token(self, key, exchange):
+        instrument = self.by_key.get(key)
+        if instrument is not None:
+            return instrument["row"]["instrument_token"], instrument["row"]["exchange_token"]
+        exchange_token = next(self._exchange_tokens)
+        return (exchange_token << 8) | SEGMENT_IDS[exchange], exchange_token
+
+    def _row(self, exchange, tradingsymbol, name, segment, instrument_type, spec, last_price,
+             expiry=None, strike=0.0, token=None):
+        if token is None:
+            token, exchange_token = self._token(f"{exchange}:{tradingsymbol}", exchange)
+        else:
+            exchange_token = token >> 8
+        return {
+            "instrument_token": token, "exchange_token": exchange_token, "tradingsymbol": tradingsymbol,
+            "name": name, "last_price": last_price, "expiry": expiry, "strike": strike,
+            "tick_size": spec["tick_size"], "lot_size": 0 if instrument_type == "EQ" else spec["lot_size"],
+            "instrument_type": instrument_type, "segment": segment, "exchange": exchange
+        }
+
+    def _contracts(self, name, spec, today):
+        """Yield (exchange, instruments() row, pricing info) for the index, futures and options"""
+        spot = float(self.paths[name].price_at(self.clock()))
+        exchange = spec["exchange"]
+        base = {"underlying": name, "tick_size": spec["tick_size"], "session": spec["session"],
+                "lot_size": spec["lot_size"], "freeze_quantity": spec["freeze_quantity"],
+                "volatility": spec["volatility"]}
+
+        if exchange == "NFO":
+            row = self._row("NSE", spec["tradingsymbol"], spec["tradingsymbol"], "INDICES", "EQ", spec,
+                            round(spot, 2), token=spec["instrument_token"])
+            yield "NSE", row, dict(base, kind="index", lot_size=0)
+            # Two weekly expiries, on Thursdays
+            first = today + timedelta(days=(3 - today.weekday()) % 7)
+            option_expiries = [first, first + timedelta(days=7)]
+            symbol_formats = [f"{name}{e:%y}{MONTH_CODES[e.month - 1]}{e:%d}" for e in option_expiries]
+        else:
+            # Monthly futures expiring on the 19th, options a few days before their future
+            month = today.replace(day=1)
+            if today.day > 19:
+                month = (month + timedelta(days=32)).replace(day=1)
+            future_expiries = [month.replace(day=19), (month + timedelta(days=32)).replace(day=19)]
+            for expiry in future_expiries:
+                symbol = f"{name}{expiry:%y%b}FUT".upper()
+                row = self._row(exchange, symbol, name, "MCX-FUT", "FUT", spec, round(spot, 2), expiry)
+                yield exchange, row, dict(base, kind="future", expiry=expiry)
+            option_expiries = [e - timedelta(days=3) for e in future_expiries]
+            option_expiries = [e for e in option_expiries if e >= today] or future_expiries
+            symbol_formats = [f"{name}{e:%y%b}".upper() for e in option_expiries]
+
+        close = SESSIONS[spec["session"]][1]
+        atm = round(spot / spec["step"]) * spec["step"]
+        strikes = atm + spec["step"] * np.arange(-spec["strikes"], spec["strikes"] + 1)
+        for expiry, prefix in zip(option_expiries, symbol_formats):
+            expires_at = to_epoch(datetime.combine(expiry, close))
+            for strike in strikes.tolist():
+                for option_type in ("CE", "PE"):
+                    symbol = f"{prefix}{strike:g}{option_type}"
+                    row = self._row(exchange, symbol, name, f"{exchange}-OPT", option_type, spec, 0.0,
+                                    expiry, float(strike))
+                    yield exchange, row, dict(base, kind="option", expiry=expiry, expires_at=expires_at,
+                                              strike=float(strike), option_type=option_type)
+
+    def instruments(self, exchange=None):
+        self._ensure_listing()
+        if exchange:
+            return [dict(row) for row in self.instrument_rows.get(exchange, [])]
+        return [dict(row) for rows in self.instrument_rows.values() for row in rows]
+
+    def _instrument(self, exchange, tradingsymbol):
+        instrument = self.by_key.get(f"{exchange}:{tradingsymbol}")
+        if instrument is None:
+            raise exceptions.InputException(f"Invalid instrument: {exchange}:{tradingsymbol}")
+        return instrument
+
+    # --- prices ---
+    def prices_at(self, instrument, t):
+        """Price of an instrument at epoch time(s) t"""
+        spot = self.paths[instrument["underlying"]].price_at(t)
+        if instrument["kind"] != "option":
+            return round_to_tick(spot, instrument["tick_size"])
+        years = np.maximum(instrument["expires_at"] - np.asarray(t), 60) / SECONDS_PER_YEAR
+        return option_price(spot, instrument["strike"], instrument["option_type"], years,
+                            instrument["volatility"], instrument["tick_size"])
+
+    def last_price(self, instrument, now=None):
+        return float(self.prices_at(instrument, self.clock() if now is None else now))
+
+    def _lookup(self, instruments):
+        if len(instruments) == 1 and isinstance(instruments[0], (list, tuple, set)):
+            instruments = instruments[0]
+        self._ensure_listing()
+        for key in instruments:
+            instrument = self.by_key.get(key) if isinstance(key, str) else self.by_token.get(int(key))
+            if instrument is not None:
+                yield key, instrument
+
+    def ltp(self, *instruments):
+        now = self.clock()
+        return {key: {"instrument_token": instrument["row"]["instrument_token"],
+                      "last_price": self.last_price(instrument, now)}
+                for key, instrument in self._lookup(instruments)}
+
+    def _day_ohlc(self, instrument, now, last_price):
+        day_start = to_epoch(datetime.fromtimestamp(now, IST).date())
+        bars = self._bars(instrument, day_start, now, INTERVAL_SECONDS["day"])
+        if not bars:
+            return {"open": last_price, "high": last_price, "low": last_price, "close": last_price}
+        bar = bars[-1]
+        return {"open": bar["open"], "high": bar["high"], "low": bar["low"],
+                "close": float(self.prices_at(instrument, day_start - 1))}
+
+    def ohlc(self, *instruments):
+        now = self.clock()
+        quotes = {}
+        for key, instrument in self._lookup(instruments):
+            last_price = self.last_price(instrument, now)
+            quotes[key] = {"instrument_token": instrument["row"]["instrument_token"], "last_price": last_price,
+                           "ohlc": self._day_ohlc(instrument, now, last_price)}
+        return quotes
+
+    def quote(self, *instruments):
+        now = self.clock()
+        quotes = {}
+        for key, instrument in self._lookup(instruments):
+            last_price = self.last_price(instrument, now)
+            tick_size = instrument["tick_size"]
+            ohlc = self._day_ohlc(instrument, now, last_price)
+            quotes[key] = {
+                "instrument_token": instrument["row"]["instrument_token"],
+                "timestamp": ist_datetime(now), "last_trade_time": ist_datetime(now),
+                "last_price": last_price, "last_quantity": instrument["lot_size"], "volume": 0,
+                "buy_quantity": 0, "sell_quantity": 0, "average_price": last_price, "oi": 0,
+                "net_change": round(last_price - ohlc["close"], 2),
+                "lower_circuit_limit": 0.0, "upper_circuit_limit": 0.0, "ohlc": ohlc,
+                "depth": {
+                    "buy": [{"price": round(last_price - tick_size * (i + 1), 2), "quantity": 0, "orders": 0}
+                            for i in range(5)],
+                    "sell": [{"price": round(last_price + tick_size * (i + 1), 2), "quantity": 0, "orders": 0}
+                             for i in range(5)]
+                }
+            }
+        return quotes
+
+    def historical_data(self, instrument_token, from_date, to_date, interval, continuous=False, oi=False):
+        instrument = self.by_token.get(int(instrument_token))
+        if instrument is None:
+            raise exceptions.InputException(f"Invalid instrument token: {instrument_token}")
+        if interval not in INTERVAL_SECONDS:
+            raise exceptions.InputException(f"Invalid interval: {interval}")
+
+        start = to_epoch(from_date)
+        end = min(to_epoch(to_date, end_of_day=True), self.clock())
+        bars = self._bars(instrument, start, end, INTERVAL_SECONDS[interval])
+        if oi:
+            for bar in bars:
+                bar["oi"] = 0
+        return bars
+
+    def _bars(self, instrument, start, end, seconds):
+        """OHLC bars aligned to the session open, from the price path sampled inside session hours"""
+        if end <= start:
+            return []
+        session_open, session_close = (t.hour * 3600 + t.minute * 60 for t in SESSIONS[instrument["session"]])
+        step = max(min(seconds, 3600) / 12, 5)
+        t = np.arange(np.floor(start / step) * step, end, step)
+        local = t + IST_OFFSET
+        day = np.floor(local / 86400)
+        second_of_day = local - day * 86400
+        weekday = (day + 3) % 7  # 1970-01-01 was a Thursday
+        mask = (t >= start) & (second_of_day >= session_open) & (second_of_day < session_close) & (weekday < 5)
+        t, day, second_of_day = t[mask], day[mask], second_of_day[mask]
+        if len(t) == 0:
+            return []
+
+        if seconds >= 86400:
+            buckets = day * 86400 - IST_OFFSET
+        else:
+            buckets = (day * 86400 + session_open - IST_OFFSET
+                       + np.floor((second_of_day - session_open) / seconds) * seconds)
+        prices = self.prices_at(instrument, t)
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(t)]
+        highs = np.maximum.reduceat(prices, starts)
+        lows = np.minimum.reduceat(prices, starts)
+        volume_per_sample = 0 if instrument["kind"] == "index" else 100 * max(instrument["lot_size"], 1)
+
+        return [{
+            "date": datetime.fromtimestamp(buckets[s], IST),
+            "open": float(prices[s]), "high": float(h), "low": float(l), "close": float(prices[e - 1]),
+            "volume": int((e - s) * volume_per_sample)
+        } for s, e, h, l in zip(starts.tolist(), ends.tolist(), highs.tolist(), lows.tolist())]
+
+    # --- orders ---
+    def _latency(self):
+        if isinstance(self.fill_latency, (tuple, list)):
+            return self.random.uniform(*self.fill_latency)
+        return self.fill_latency
+
+    def _validate(self, instrument, transaction_type, quantity, order_type, price, trigger_price):
+        if transaction_type not in (self.TRANSACTION_TYPE_BUY, self.TRANSACTION_TYPE_SELL):
+            raise exceptions.InputException(f"Invalid transaction type: {transaction_type}")
+        if order_type not in (self.ORDER_TYPE_MARKET, self.ORDER_TYPE_LIMIT, self.ORDER_TYPE_SL, self.ORDER_TYPE_SLM):
+            raise exceptions.InputException(f"Invalid order type: {order_type}")
+        if instrument["kind"] == "index":
+            raise exceptions.InputException("Indices cannot be traded")
+        if quantity <= 0 or quantity % instrument["lot_size"]:
+            raise exceptions.InputException(f"Quantity should be a multiple of lot size {instrument['lot_size']}")
+        if quantity > instrument["freeze_quantity"]:
+            raise exceptions.InputException(f"Quantity exceeds the freeze limit of {instrument['freeze_quantity']}")
+        if order_type in (self.ORDER_TYPE_LIMIT, self.ORDER_TYPE_SL) and not price:
+            raise exceptions.InputException("Price is required for LIMIT and SL orders")
+        if order_type in (self.ORDER_TYPE_SL, self.ORDER_TYPE_SLM) and not trigger_price:
+            raise exceptions.InputException("Trigger price is required for SL and SL-M orders")
+
+    def place_order(self, variety, exchange, tradingsymbol, transaction_type, quantity, product, order_type,
+                    price=None, validity=None, validity_ttl=None, disclosed_quantity=None, trigger_price=None,
+                    iceberg_legs=None, iceberg_quantity=None, auction_number=None, tag=None):
+        instrument = self._instrument(exchange, tradingsymbol)
+        quantity = int(quantity)
+        self._validate(instrument, transaction_type, quantity, order_type, price, trigger_price)
+
+        events = []
+        with self.lock:
+            order = self._submit(instrument, events, variety=variety, transaction_type=transaction_type,
+                                 quantity=quantity, product=product, order_type=order_type, price=price,
+                                 trigger_price=trigger_price, validity=validity or self.VALIDITY_DAY,
+                                 disclosed_quantity=disclosed_quantity, tag=tag)
+        self._publish(events)
+        return order["order_id"]
+
+    def _submit(self, instrument, events, **params):
+        """Create an order and either queue it for its fill latency or match it now (lock held)"""
+        now = self.clock()
+        sequence = next(self._sequence)
+        order_id = f"{ist_datetime(now):%y%m%d}{sequence:09d}"
+        stop = params["order_type"] in (self.ORDER_TYPE_SL, self.ORDER_TYPE_SLM)
+        order = {
+            "order_id": order_id, "parent_order_id": None, "exchange_order_id": None, "placed_by": "PAPER",
+            "variety": params["variety"], "status": "TRIGGER PENDING" if stop else "OPEN", "status_message": None,
+            "order_timestamp": ist_datetime(now), "exchange_timestamp": None,
+            "exchange": instrument["row"]["exchange"], "tradingsymbol": instrument["row"]["tradingsymbol"],
+            "instrument_token": instrument["row"]["instrument_token"],
+            "transaction_type": params["transaction_type"], "order_type": params["order_type"],
+            "product": params["product"], "validity": params["validity"],
+            "price": float(params["price"] or 0), "trigger_price": float(params["trigger_price"] or 0),
+            "quantity": params["quantity"], "pending_quantity": params["quantity"], "filled_quantity": 0,
+            "cancelled_quantity": 0, "average_price": 0.0,
+            "disclosed_quantity": params["disclosed_quantity"] or 0, "tag": params["tag"]
+        }
+        self.order_book[order_id] = order
+        self.history[order_id] = []
+        self.counters["placed"] += 1
+        events.append(self._record(order))
+
+        latency = self._latency()
+        if latency > 0:
+            heapq.heappush(self._due, (now + latency, sequence, order_id))
+            self._wake.notify()
+        else:
+            self._activate(order, now, {}, events)
+        return order
+
+    def _record(self, order):
+        snapshot = dict(order)
+        self.history[order["order_id"]].append(snapshot)
+        return snapshot
+
+    def _activate(self, order, now, prices, events):
+        """The exchange has the order: reject it at the configured rate, otherwise start matching it"""
+        order["exchange_order_id"] = order["order_id"]
+        if self.reject_rate and self.random.random() < self.reject_rate:
+            self._finish(order, "REJECTED", now, events, "RMS: simulated rejection")
+            return
+        self._working[order["order_id"]] = order
+        self._match_order(order, now, prices, events)
+
+    def _finish(self, order, status, now, events, message=None):
+        self._working.pop(order["order_id"], None)
+        order["status"] = status
+        order["status_message"] = message
+        order["exchange_timestamp"] = ist_datetime(now)
+        if status != "COMPLETE":
+            order["cancelled_quantity"] = order["pending_quantity"]
+            order["pending_quantity"] = 0
+        self.counters["filled" if status == "COMPLETE" else status.lower()] += 1
+        events.append(self._record(order))
+
+    def _match_order(self, order, now, prices, events):
+        token = order["instrument_token"]
+        last_price = prices.get(token)
+        if last_price is None:
+            last_price = prices[token] = self.last_price(self.by_token[token], now)
+
+        buy = order["transaction_type"] == self.TRANSACTION_TYPE_BUY
+        order_type = order["order_type"]
+        if order["status"] == "TRIGGER PENDING":
+            trigger = order["trigger_price"]
+            if (buy and last_price < trigger) or (not buy and last_price > trigger):
+                return
+            order["status"] = "OPEN"
+            if order_type == self.ORDER_TYPE_SL:
+                events.append(self._record(order))
+
+        limited = order_type in (self.ORDER_TYPE_LIMIT, self.ORDER_TYPE_SL)
+        if limited and ((buy and last_price > order["price"]) or (not buy and last_price < order["price"])):
+            return
+
+        tick_size = self.by_token[token]["tick_size"]
+        slippage = self.random.randint(0, self.slippage_ticks) * tick_size if self.slippage_ticks else 0.0
+        fill_price = last_price + slippage if buy else max(last_price - slippage, tick_size)
+        if limited:
+            fill_price = min(fill_price, order["price"]) if buy else max(fill_price, order["price"])
+
+        order["filled_quantity"] = order["quantity"]
+        order["pending_quantity"] = 0
+        order["average_price"] = round(fill_price, 2)
+        self._finish(order, "COMPLETE", now, events)
+
+    def match(self):
+        """Accept orders whose latency has elapsed, then fill every working order and GTT the market reaches"""
+        events = []
+        with self.lock:
+            now = self.clock()
+            prices = {}
+            while self._due and self._due[0][0] <= now:
+                _, _, order_id = heapq.heappop(self._due)
+                order = self.order_book[order_id]
+                if order["status"] not in TERMINAL_STATUSES:
+                    self._activate(order, now, prices, events)
+            for order in list(self._working.values()):
+                self._match_order(order, now, prices, events)
+            self._match_gtts(now, prices, events)
+        self._publish(events)
+
+    def advance(self, seconds):
+        """Move a SimulatedClock forward and match at the new time"""
+        self.clock.advance(seconds)
+        self.match()
+
+    def start(self):
+        """Match in a background thread, for real-time paper trading with a non-zero latency"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="kite-simulator", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self.lock:
+            self._wake.notify()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.match()
+            with self.lock:
+                timeout = self.match_interval if (self._working or self._due or self.gtts) else None
+                if self._due:
+                    timeout = min(timeout, max(self._due[0][0] - self.clock(), 0))
+                if not self._stopped.is_set():
+                    self._wake.wait(timeout)
+
+    def _order(self, order_id):
+        order = self.order_book.get(str(order_id))
+        if order is None:
+            raise exceptions.InputException(f"Invalid order id: {order_id}")
+        return order
+
+    def modify_order(self, variety, order_id, parent_order_id=None, quantity=None, price=None, order_type=None,
+                     trigger_price=None, validity=None, disclosed_quantity=None):
+        events = []
+        with self.lock:
+            order = self._order(order_id)
+            if order["status"] in TERMINAL_STATUSES:
+                raise exceptions.InputException(f"Order cannot be modified as it is {order['status'].lower()}")
+
+            new_type = order_type or order["order_type"]
+            new_quantity = int(quantity) if quantity else order["quantity"]
+            new_price = order["price"] if price is None else float(price)
+            new_trigger = order["trigger_price"] if trigger_price is None else float(trigger_price)
+            self._validate(self.by_token[order["instrument_token"]], order["transaction_type"], new_quantity,
+                           new_type, new_price, new_trigger)
+
+            order.update(order_type=new_type, quantity=new_quantity, pending_quantity=new_quantity,
+                         price=new_price, trigger_price=new_trigger)
+            if validity:
+                order["validity"] = validity
+            if new_type in (self.ORDER_TYPE_SL, self.ORDER_TYPE_SLM):
+                order["status"] = "TRIGGER PENDING"
+            elif order["status"] == "TRIGGER PENDING":
+                order["status"] = "OPEN"
+            self.counters["modified"] += 1
+            events.append(self._record(order))
+            if order["order_id"] in self._working:
+                self._match_order(order, self.clock(), {}, events)
+        self._publish(events)
+        return order["order_id"]
+
+    def cancel_order(self, variety, order_id, parent_order_id=None):
+        events = []
+        with self.lock:
+            order = self._order(order_id)
+            if order["status"] in TERMINAL_STATUSES:
+                raise exceptions.InputException(f"Order cannot be cancelled as it is {order['status'].lower()}")
+            self._finish(order, "CANCELLED", self.clock(), events)
+        self._publish(events)
+        return order["order_id"]
+
+    def orders(self):
+        with self.lock:
+            return [dict(order) for order in self.order_book.values()]
+
+    def order_history(self, order_id):
+        with self.lock:
+            self._order(order_id)
+            return [dict(snapshot) for snapshot in self.history[str(order_id)]]
+
+    # --- GTT ---
+    def _gtt(self, trigger_id):
+        gtt = self.gtts.get(int(trigger_id))
+        if gtt is None:
+            raise exceptions.InputException(f"Invalid trigger id: {trigger_id}")
+        return gtt
+
+    def _gtt_body(self, trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders):
+        instrument = self._instrument(exchange, tradingsymbol)
+        expected_legs = 2 if trigger_type == self.GTT_TYPE_OCO else 1
+        if len(trigger_values) != expected_legs or len(orders) != expected_legs:
+            raise exceptions.InputException(f"{trigger_type} GTTs need {expected_legs} trigger value(s) and order(s)")
+        return {
+            "type": trigger_type,
+            "condition": {"exchange": exchange, "tradingsymbol": tradingsymbol,
+                          "instrument_token": instrument["row"]["instrument_token"],
+                          "trigger_values": [float(v) for v in trigger_values], "last_price": float(last_price)},
+            "orders": [dict(o, exchange=exchange, tradingsymbol=tradingsymbol, result=None) for o in orders]
+        }
+
+    def place_gtt(self, trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders):
+        body = self._gtt_body(trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders)
+        with self.lock:
+            trigger_id = next(self._gtt_ids)
+            now = ist_datetime(self.clock())
+            self.gtts[trigger_id] = dict(body, id=trigger_id, user_id="PAPER", status="active",
+                                         created_at=now, updated_at=now, expires_at=now + timedelta(days=365))
+            self._wake.notify()
+        return {"trigger_id": trigger_id}
+
+    def modify_gtt(self, trigger_id, trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders):
+        body = self._gtt_body(trigger_type, tradingsymbol, exchange, trigger_values, last_price, orders)
+        with self.lock:
+            gtt = self._gtt(trigger_id)
+            if gtt["status"] != "active":
+                raise exceptions.InputException(f"GTT cannot be modified as it is {gtt['status']}")
+            gtt.update(body, updated_at=ist_datetime(self.clock()))
+        return {"trigger_id": gtt["id"]}
+
+    def get_gtt(self, trigger_id):
+        with self.lock:
+            return dict(self._gtt(trigger_id))
+
+    def get_gtts(self):
+        with self.lock:
+            return [dict(gtt) for gtt in self.gtts.values()]
+
+    def delete_gtt(self, trigger_id):
+        with self.lock:
+            gtt = self._gtt(trigger_id)
+            gtt["status"] = "deleted"
+        return {"trigger_id": gtt["id"]}
+
+    def _match_gtts(self, now, prices, events):
+        for gtt in self.gtts.values():
+            if gtt["status"] != "active":
+                continue
+            condition = gtt["condition"]
+            token = condition["instrument_token"]
+            last_price = prices.get(token)
+            if last_price is None:
+                last_price = prices[token] = self.last_price(self.by_token[token], now)
+
+            values = condition["trigger_values"]
+            if gtt["type"] == self.GTT_TYPE_OCO:
+                leg = 0 if last_price <= values[0] else 1 if last_price >= values[1] else None
+            else:
+                rising = condition["last_price"] < values[0]
+                leg = 0 if (last_price >= values[0] if rising else last_price <= values[0]) else None
+            if leg is None:
+                continue
+
+            leg_order = gtt["orders"][leg]
+            result = {"triggered_at": last_price, "timestamp": ist_datetime(now)}
+            try:
+                instrument = self.by_token[token]
+                self._validate(instrument, leg_order["transaction_type"], int(leg_order["quantity"]),
+                               leg_order["order_type"], leg_order.get("price"), None)
+                order = self._submit(instrument, events, variety=self.VARIETY_REGULAR,
+                                     transaction_type=leg_order["transaction_type"],
+                                     quantity=int(leg_order["quantity"]), product=leg_order["product"],
+                                     order_type=leg_order["order_type"], price=leg_order.get("price"),
+                                     trigger_price=None, validity=self.VALIDITY_DAY, disclosed_quantity=None,
+                                     tag=None)
+                result["order_result"] = {"order_id": order["order_id"], "status": "success", "rejection_reason": ""}
+            except exceptions.InputException as e:
+                result["order_result"] = {"order_id": None, "status": "failed", "rejection_reason": str(e)}
+            leg_order["result"] = result
+            gtt["status"] = "triggered"
+            gtt["updated_at"] = ist_datetime(now)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, working=len(self._working), latent=len(self._due))
+
+
+def benchmark_trade_manager(args):
+    """Entries placed through app.py's TradeManager on the paper gateway, timed until every
+    one is filled and opened as a trade (or rejected)"""
+    import tempfile
+    import app  # app imports this module; only this benchmark needs the reverse
+
+    app.Config.USE_TICKER = False
+    app.Config.PAPER_DATA_DIR = tempfile.mkdtemp(prefix="paper-benchmark-")
+    app.Config.PAPER_FILL_LATENCY = args.latency
+    app.Config.PAPER_SLIPPAGE_TICKS = args.slippage
+    app.Config.PAPER_REJECT_RATE = args.reject_rate
+    app.init_session_state()
+    state = app.st.session_state
+
+    kite = app.start_paper_trading()
+    app.start_market_feed(kite)
+    trade_manager = app.TradeManager(kite)
+    reference = app.get_reference_price(kite, "NIFTY")
+
+    started = time.perf_counter()
+    for i in range(args.orders):
+        trade_manager.place_order("NIFTY", "BUY" if i % 2 == 0 else "SELL", reference)
+    placed = time.perf_counter() - started
+
+    deadline = time.monotonic() + 60 + args.latency
+    entries = [order for order in state.order_history if order.get("signal") in ("BUY", "SELL")]
+    while time.monotonic() < deadline:
+        trade_manager.process_order_updates()
+        if all(order["status"] in ("COMPLETE", "REJECTED", "CANCELLED") for order in entries):
+            break
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.orders} entries placed in {placed:.3f}s ({args.orders / placed:,.0f}/s), "
+          f"{len(state.active_trades)} open as trades after {elapsed:.3f}s "
+          f"({args.orders / elapsed:,.0f}/s): {kite.kite.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for the local Kite simulator")
+    parser.add_argument("--orders", type=int, default=10000, help="number of market orders to place")
+    parser.add_argument("--latency", type=float, default=0.0, help="fill latency in (simulated) seconds")
+    parser.add_argument("--slippage", type=int, default=1, help="maximum adverse slippage in ticks")
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--path", action="append", default=[], metavar="NAME=CSV",
+                        help="recorded price path for an underlying, e.g. NIFTY=nifty.csv")
+    parser.add_argument("--trade-manager", action="store_true",
+                        help="place entries through app.py's TradeManager and paper gateway instead")
+    args = parser.parse_args()
+
+    if args.trade_manager:
+        benchmark_trade_manager(args)
+        return
+
+    paths = {}
+    for item in args.path:
+        name, filename = item.split("=", 1)
+        paths[name] = PricePath.load(filename)
+
+    clock = SimulatedClock() if args.latency else None
+    kite = KiteSimulator(fill_latency=args.latency, slippage_ticks=args.slippage, reject_rate=args.reject_rate,
+                         paths=paths, clock=clock, seed=args.seed)
+    options = [row for row in kite.instruments("NFO") if row["name"] == "NIFTY"][:100]
+
+    started = time.perf_counter()
+    for i in range(args.orders):
+        row = options[i % len(options)]
+        kite.place_order(variety=kite.VARIETY_REGULAR, exchange=row["exchange"], tradingsymbol=row["tradingsymbol"],
+                         transaction_type=kite.TRANSACTION_TYPE_BUY if i % 2 == 0 else kite.TRANSACTION_TYPE_SELL,
+                         quantity=row["lot_size"], product=kite.PRODUCT_MIS, order_type=kite.ORDER_TYPE_MARKET)
+    if clock is not None:
+        kite.advance(args.latency)
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.orders} orders in {elapsed:.3f}s ({args.orders / elapsed:,.0f} orders/s): {kite.stats()}")
+
+
+if __name__ == "__main__":
+    main()
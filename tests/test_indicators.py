@@ -0,0 +1,122 @@
+"""IndicatorEngine against TA-Lib: the same bars must give the same values at every bar"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+import talib
+
+from app import IndicatorEngine
+
+
+def make_bars(count, seed, start=50000.0, step=0.002):
+    rng = np.random.default_rng(seed)
+    closes = start * np.exp(np.cumsum(rng.normal(0.0, step, count)))
+    opens = np.concatenate([[start], closes[:-1]])
+    highs = np.maximum(opens, closes) * (1 + rng.uniform(0.0, step, count))
+    lows = np.minimum(opens, closes) * (1 - rng.uniform(0.0, step, count))
+    first = datetime(2026, 10, 16, 9, 15)
+    return [
+        {'date': first + timedelta(minutes=5 * i), 'open': float(o), 'high': float(h),
+         'low': float(l), 'close': float(c), 'volume': 0}
+        for i, (o, h, l, c) in enumerate(zip(opens, highs, lows, closes))
+    ]
+
+
+def talib_values(bars):
+    high = np.array([b['high'] for b in bars], dtype=np.float64)
+    low = np.array([b['low'] for b in bars], dtype=np.float64)
+    close = np.array([b['close'] for b in bars], dtype=np.float64)
+    slowk, slowd = talib.STOCH(high, low, close, fastk_period=14, slowk_period=3, slowk_matype=0,
+                               slowd_period=3, slowd_matype=0)
+    return {
+        'close': close,
+        'ema5': talib.EMA(close, 5),
+        'ema8': talib.EMA(close, 8),
+        'ema13': talib.EMA(close, 13),
+        'slowk': slowk,
+        'slowd': slowd
+    }
+
+
+def assert_matches(values, expected, i):
+    if any(np.isnan(expected[key][i]) for key in expected):
+        assert values is None, f"bar {i}: values before TA-Lib has them"
+        return
+    assert values is not None, f"bar {i}: no values once TA-Lib has them"
+    for key, series in expected.items():
+        assert values[key] == series[i], f"bar {i}: {key} {values[key]!r} != {series[i]!r}"
+
+
+@pytest.mark.parametrize("seed", [1, 7, 42])
+def test_update_matches_talib_at_every_bar(seed):
+    bars = make_bars(300, seed)
+    expected = talib_values(bars)
+    engine = IndicatorEngine()
+    for i, bar in enumerate(bars):
+        assert_matches(engine.update(bar), expected, i)
+    # The series got past the warm-up: slowd starts after 14 bars of %K and 2 + 2 of smoothing
+    assert np.isnan(expected['slowd'][16]) and not np.isnan(expected['slowd'][17])
+
+
+@pytest.mark.parametrize("seed", [3, 11])
+def test_peek_matches_talib_for_the_forming_bar(seed):
+    bars = make_bars(120, seed)
+    expected = talib_values(bars)
+    engine = IndicatorEngine()
+    for i, bar in enumerate(bars):
+        assert_matches(engine.peek(bar), expected, i)
+        # Peeking must not move the engine: committing the same bar gives the same values
+        assert engine.peek(bar) == engine.update(bar)
+
+
+@pytest.mark.parametrize("seed", [2, 8])
+def test_large_moves_match_talib(seed):
+    # Big bar-to-bar moves are where a fused and a plain EMA step round differently
+    bars = make_bars(300, seed, step=0.5)
+    expected = talib_values(bars)
+    engine = IndicatorEngine()
+    for i, bar in enumerate(bars):
+        assert_matches(engine.update(bar), expected, i)
+
+
+def test_flat_bars_match_talib():
+    bars = make_bars(60, 5, step=0.0)
+    expected = talib_values(bars)
+    engine = IndicatorEngine()
+    for i, bar in enumerate(bars):
+        assert_matches(engine.update(bar), expected, i)
+
+
+def test_sync_matches_full_history_talib_as_the_window_slides():
+    bars = make_bars(200, 9)
+    engine = IndicatorEngine()
+    for end in range(1, len(bars) + 1):
+        # Like the candle store: the history so far with the last bar still forming
+        window = bars[max(0, end - 100):end]
+        # The engine is not re-seeded as the window slides: it is TA-Lib over everything since the first bar
+        assert_matches(engine.sync(window), talib_values(bars[:end]), end - 1)
+
+
+def test_sync_stays_with_talib_over_a_five_day_window():
+    window_bars = 5 * 75  # five sessions of 5-minute bars
+    bars = make_bars(window_bars + 200, 17)
+    engine = IndicatorEngine()
+    for end in range(window_bars, len(bars) + 1, 10):
+        # The baseline ran TA-Lib over just the lookback window on every rerun
+        window = bars[end - window_bars:end]
+        values = engine.sync(window)
+        expected = talib_values(window)
+        for key, series in expected.items():
+            assert values[key] == pytest.approx(series[-1], rel=1e-12), f"bar {end - 1}: {key}"
+
+
+@pytest.mark.parametrize("next_bar_started", [False, True])
+def test_sync_at_bar_close_returns_the_closed_bar(next_bar_started):
+    bars = make_bars(150, 13)
+    expected = talib_values(bars)
+    engine = IndicatorEngine()
+    for i in range(len(bars) - 1):
+        bar_close = bars[i]['date'] + timedelta(minutes=5)
+        # A tick may or may not have opened the next bar by the time the signal runs
+        candles = bars[:i + 2] if next_bar_started else bars[:i + 1]
+        assert_matches(engine.sync(candles, bar_close), expected, i)